@@ -1,10 +1,88 @@
-from typing import Dict, List, Optional, Any, TypedDict, Literal
+from typing import Dict, List, Optional, Any, TypedDict, Literal, Type, TypeVar
 from langgraph.graph import MessagesState
+from langchain_core.messages import HumanMessage
+from pydantic import BaseModel, Field, ValidationError
+import json
+import re
+
+Model = TypeVar("Model", bound=BaseModel)
 
 class AgentState(MessagesState):
     """State for each agent node in the graph"""
     next: str  # Where to route to next
     thought_step: Optional[int] = 0  # Current step in chain of thought
     caller: Optional[str] = None  # Who called the agent
+    summary: Optional[str] = None  # Running summary of the transcript, see core.context.ContextCompactor
+    summarized: Optional[int] = 0  # Number of leading messages covered by the summary
+    context_stats: Optional[dict] = None  # Estimated prompt tokens sent and saved, per agent
+    parallel_research: Optional[bool] = False  # Retriever and web searcher asked at once, see TrialWorkflow
+    research: Optional[dict] = None  # Requests of the current research fan-out, see ResearchRequests
+    judge_mode: Optional[str] = None  # 'stepwise' or 'fused', overrides the JudgeAgent's mode for a trial
+    judge_stats: Optional[dict] = None  # Calls, tokens and latency of the judge per mode, see agents.judge.judge_report
+
+
+def structured_output_instructions(model: Type[BaseModel]) -> str:
+    """Prompt asking for a JSON object with the fields of `model`, for models without native structured output"""
+    fields = "\n".join(
+        f'"{name}": {field.description}' for name, field in model.model_fields.items()
+    )
+    return f"Respond with only a JSON object with these fields, no other text:\n{fields}"
+
+
+def parse_structured_output(text: str, model: Type[Model]) -> Optional[Model]:
+    """
+    Parse the JSON object in an LLM response into `model`, tolerating code fences and text around it.
+    Returns None if there is no JSON object or it does not match the model.
+    """
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        return None
+    try:
+        return model.model_validate(json.loads(match.group(0)))
+    except (ValueError, ValidationError):
+        return None
+
+
+RESEARCH_STEP = 1  # thought step in which the lawyer, prosecutor and judge ask for legal data
+AFTER_RESEARCH_STEP = 3  # thought step following the web search decision
+
+
+class ResearchRequests(BaseModel):
+    """Both research requests of a turn, planned in one step"""
+    legal_request: str = Field(description="Request to the law retriever for laws, IPC sections or precedents, 'none' if not needed")
+    web_request: str = Field(description="Request to the web searcher for real-world information, 'none' if not needed")
+
+
+RESEARCH_TASK = (
+    "2. Determine the legal information (e.g., laws, IPCs, precedents) and the information from the web needed at this point, "
+    "and ask the law retriever and the web searcher for it at once, with specific details. "
+    + structured_output_instructions(ResearchRequests)
+)
+
+
+def current_task(thought_steps: List[str], state: AgentState) -> str:
+    """Task of the state's thought step, both research requests at once in parallel research mode"""
+    if state.get("parallel_research") and state["thought_step"] == RESEARCH_STEP:
+        return RESEARCH_TASK
+    return thought_steps[state["thought_step"]]
 
 
+def research_response(content: str, caller: str) -> Dict[str, Any]:
+    """
+    Response of a parallel research step: the retriever and the web searcher get their requests
+    at once, and the caller resumes after the web search decision it no longer needs to make.
+    """
+    requests = parse_structured_output(content, ResearchRequests)
+    if requests is None:
+        # a free-text answer asks for legal data, like the sequential step
+        requests = ResearchRequests(legal_request=content.strip(), web_request="none")
+    return {
+        "messages": [HumanMessage(
+            content=f"Request to the law retriever: {requests.legal_request}\nRequest to the web searcher: {requests.web_request}",
+            name=caller,
+        )],
+        "next": "research",
+        "research": requests.model_dump(),
+        "thought_step": AFTER_RESEARCH_STEP,
+        "caller": caller,
+    }
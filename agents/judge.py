@@ -1,16 +1,37 @@
-from typing import Dict, Any, List, Optional, Literal, TypedDict
+from typing import Dict, Any, List, Optional, Literal, Tuple, TypedDict
 from langchain_core.messages import HumanMessage
 from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
-from agents.base import AgentState
+from agents.base import (
+    AgentState, RESEARCH_STEP, current_task, research_response,
+    parse_structured_output, structured_output_instructions,
+)
+from core.llm_gateway import as_gateway
+from core.context import ContextCompactor, count_tokens, estimate_tokens
 import re
+import time
 
-# class JudgeDecision(BaseModel):
-#     """Judge's structured decision output"""
-#     response: str = Field(description="The judge's response and comments")
-#     next_agent: Literal["lawyer", "prosecutor", "END"] = Field(
-#         description="Next agent to speak in the trial or END if verdict is given in response"
-#     )
+JUDGE_MODES = ("stepwise", "fused")
+FUSED_RULING_STEP = 6  # fused mode: ruling after the research asked for by the fused review
+
+
+class JudgeRuling(BaseModel):
+    """Judge's structured decision output"""
+    ready_for_verdict: bool = Field(description="true only if no new points are being raised and at least 10 arguments were made")
+    response: str = Field(description=(
+        "Constructive feedback on logical flaws, factual inconsistencies or unsupported claims, as live dialogue with an impartial tone. "
+        "If ready for verdict ask for final statements, if they were already given summarize the case and deliver the verdict with the keyphrase 'Given Verdict'"
+    ))
+    next_agent: Literal["lawyer", "prosecutor", "END"] = Field(
+        description="Next agent to speak in the trial or END if verdict is given in response"
+    )
+
+
+class JudgeTurn(JudgeRuling):
+    """Whole judge turn in one call, the ruling only counts when no research is asked for"""
+    review: str = Field(description="Key points of the latest arguments, and hallucinations, logical or factual errors in them")
+    legal_request: str = Field(description="Request to the law retriever for the laws, IPCs or precedents needed to verify the errors, 'none' if not needed")
+    web_request: str = Field(description="Request to the web searcher for real-world information, 'none' if not needed")
 
 class JudgeAgent:
     """Agent representing the judge who manages the trial flow"""
@@ -19,10 +40,23 @@ class JudgeAgent:
         self,  
         llms,
         tools: Optional[List[BaseTool]] = None,
+        context_budget: int = 8000,
+        mode: Literal["stepwise", "fused"] = "stepwise",
     ):
+        """
+        Args:
+            llms: shared LLMGateway, or LLMs to use in order of fallback
+            tools: tools of the judge
+            context_budget: estimated tokens of transcript sent per call, older turns are summarized over it
+            mode: 'stepwise', one call per thought step, or 'fused', the whole turn in one structured call
+                (a second one after research), stepwise when its answer does not parse. A trial may
+                override it with the state's judge_mode.
+        """
         # self.llm = llm or ChatGroq(model="llama3-8b-8192", api_key=os.getenv('GROQ_API_KEY'))
-        self.llms = llms # Multiple LLMs for fallback redundancy
+        self.llm = as_gateway(llms)  # shared gateway, fallback ordered by model health
+        self.context = ContextCompactor(self.llm, budget=context_budget)  # estimated tokens of transcript per call
         self.tools = tools or []
+        self.mode = mode
         
         # Comprehensive system prompt defining the judge's role and responsibilities
         self.system_prompt = """
@@ -62,31 +96,50 @@ IMPORTANT NOTE: Do ONLY 'current_task', other task will be done in next steps or
         ]
 
     async def process(self, state: AgentState) -> AgentState:
+        """
+        Process the current state in the judge's mode, fused or stepwise.
+
+        Args:
+            state: Current state of the trial containing messages and thought step
+
+        Returns:
+            Updated state with judge's response and next action
+        """
+        mode = state.get("judge_mode") or self.mode
+        if mode == "fused" and state["thought_step"] in (0, FUSED_RULING_STEP):
+            response, stats, compacted = await self._fused(state)
+            if response is not None:
+                return response
+            # not the structure asked for, the turn goes on step by step with the transcript already compacted
+            stats["fused"]["fallbacks"] += 1
+            state = {**state, "thought_step": 0 if state["thought_step"] == 0 else 3, "judge_stats": stats}
+            return await self._stepwise(state, compacted)
+        return await self._stepwise(state)
+
+    async def _stepwise(self, state: AgentState, compacted: Optional[Tuple[list, dict]] = None) -> AgentState:
         """
         Process the current state and generate the next state based on judge's logic.
         
         Args:
             state: Current state of the trial containing messages and thought step
+            compacted: history and context update of the transcript compacted for this turn already, if any
             
         Returns:
             Updated state with judge's response and next action
             
         """
         
-        # Prepare messages for LLM processing
+        # Prepare messages for LLM processing, older turns summarized and old evidence referenced
+        history, context = compacted or await self.context.compact("judge", state)
         messages = [
             {"role": "system", "content": self.system_prompt}
-        ] + state["messages"] + [{"role": "system", "content": f"current_task: {self.get_thought_steps()[state['thought_step']]}" }]
+        ] + history + [{"role": "system", "content": f"current_task: {current_task(self.get_thought_steps(), state)}" }]
         # print(messages)
-        # Process through LLMs with fallback mechanism
+        # Process through the LLM gateway, falls back across LLMs ordered by health
         # if state["thought_step"] != 4:
-        for i, llm in enumerate(self.llms):
-            try:
-                result = llm.invoke(messages)
-                break
-            except Exception as e:
-                print(f"LLM {i} failed with error: {e}")
-                continue
+        started = time.monotonic()
+        result = await self.llm.ainvoke(messages)
+        stats = self._record_call(state, "stepwise", messages, result, started, turn_done=state["thought_step"] == 5)
 
         #     # result = self.llm.invoke(messages)
         # else:
@@ -108,6 +161,9 @@ IMPORTANT NOTE: Do ONLY 'current_task', other task will be done in next steps or
                 "thought_step": state["thought_step"]+1,
                 "caller": "judge"
             }
+        elif state["thought_step"] == RESEARCH_STEP and state.get("parallel_research"):
+            # Legal data and web search requests at once
+            response = research_response(result.content, "judge")
         elif state["thought_step"] == 1:
             # Legal data retrieval step
             response = {
@@ -135,7 +191,99 @@ IMPORTANT NOTE: Do ONLY 'current_task', other task will be done in next steps or
         else:
             raise ValueError("Invalid thought step")
 
+        response.update(context)
+        response["judge_stats"] = stats
         return response
+
+    async def _fused(self, state: AgentState) -> Tuple[Optional[AgentState], dict, Optional[Tuple[list, dict]]]:
+        """
+        Whole turn in one structured call: review, research requests, readiness, response and next speaker.
+        When research is asked for, the ruling is made by a second call once it is back.
+        Returns the response, None if the answer does not parse, the judge_stats, and for the stepwise
+        fallback the compacted history and context update the call was made with.
+        """
+        ruling = state["thought_step"] == FUSED_RULING_STEP
+        research = state.get("research") or {}
+        if ruling and not state.get("parallel_research") and not _is_none(research.get("web_request")):
+            # sequential graph: the retriever answered, the web searcher is asked next
+            return {
+                "messages": [HumanMessage(content=f"Request to the web searcher: {research['web_request']}", name="judge")],
+                "next": "web_searcher",
+                "thought_step": FUSED_RULING_STEP,
+                "caller": "judge",
+                "research": {**research, "web_request": "none"},
+            }, self._stats(state), None
+
+        model = JudgeRuling if ruling else JudgeTurn
+        task = (
+            "Review the arguments, and the retrieved data if any, decide if the trial is ready for a verdict, "
+            "respond and determine the next speaker. Do not give a verdict before at least 10 arguments. "
+            + structured_output_instructions(model)
+        )
+        history, context = await self.context.compact("judge", state)
+        messages = [
+            {"role": "system", "content": self.system_prompt}
+        ] + history + [{"role": "system", "content": f"current_task: {task}"}]
+        started = time.monotonic()
+        result = await self.llm.ainvoke(messages)
+        decision = parse_structured_output(result.content, model)
+        research_needed = (
+            decision is not None and not ruling
+            and not (_is_none(decision.legal_request) and _is_none(decision.web_request))
+        )
+        stats = self._record_call(state, "fused", messages, result, started, turn_done=decision is not None and not research_needed)
+        if decision is None:
+            print(f"Judge fused answer did not parse, continuing stepwise: {result.content[:200]}")
+            return None, stats, (history, context)
+
+        if research_needed:
+            if state.get("parallel_research"):
+                next_node = "research"
+            else:
+                next_node = "web_searcher" if _is_none(decision.legal_request) else "retriever"
+            response = {
+                "messages": [HumanMessage(
+                    content=f"{decision.review}\nRequest to the law retriever: {decision.legal_request}"
+                            f"\nRequest to the web searcher: {decision.web_request}",
+                    name="judge",
+                )],
+                "next": next_node,
+                "thought_step": FUSED_RULING_STEP,
+                "caller": "judge",
+                "research": {
+                    "legal_request": decision.legal_request,
+                    # asked for already when it is the only request
+                    "web_request": "none" if next_node == "web_searcher" else decision.web_request,
+                },
+            }
+        else:
+            response = {
+                "messages": [
+                    HumanMessage(content=decision.response, name="judge"),
+                    HumanMessage(content=f"next speaker: {decision.next_agent}", name="judge"),
+                ],
+                "next": decision.next_agent,
+                "thought_step": 0,
+                "caller": "judge",
+                "research": None,
+            }
+        response.update(context)
+        response["judge_stats"] = stats
+        return response, stats, None
+
+    @staticmethod
+    def _stats(state: AgentState) -> dict:
+        return {mode: dict(values) for mode, values in (state.get("judge_stats") or {}).items()}
+
+    def _record_call(self, state: AgentState, mode: str, messages, result, started: float, turn_done: bool) -> dict:
+        """Calls, estimated tokens and latency of the judge in this trial, per mode"""
+        stats = self._stats(state)
+        mode_stats = stats.setdefault(mode, {"turns": 0, "calls": 0, "tokens": 0, "latency_s": 0.0, "fallbacks": 0})
+        mode_stats["calls"] += 1
+        mode_stats["tokens"] += count_tokens(messages) + estimate_tokens(result.content)
+        mode_stats["latency_s"] = round(mode_stats["latency_s"] + time.monotonic() - started, 3)
+        mode_stats["turns"] += turn_done
+        return stats
     
     def is_web_search_needed(self, content: str) -> Literal["self", "web_searcher"]:
         """
@@ -157,3 +305,22 @@ IMPORTANT NOTE: Do ONLY 'current_task', other task will be done in next steps or
             return "END"
         else:
             return "prosecutor"
+
+
+
+def _is_none(request: Optional[str]) -> bool:
+    return not request or request.strip().lower().startswith("none")
+
+
+def judge_report(judge_stats: Optional[dict]) -> dict:
+    """Per mode totals and per turn averages of the judge's calls, tokens and latency in a trial"""
+    report = {}
+    for mode, values in (judge_stats or {}).items():
+        turns = values["turns"] or 1
+        report[mode] = {
+            **values,
+            "calls_per_turn": round(values["calls"] / turns, 2),
+            "tokens_per_turn": round(values["tokens"] / turns),
+            "latency_s_per_turn": round(values["latency_s"] / turns, 2),
+        }
+    return report
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import time
 from typing import Dict, Any, List, Optional
@@ -5,6 +6,9 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from .base import AgentState
 from .misc.filestorage import FileStorage
 from .misc.ik import IKApi
+from .misc.kanoon_text import migrate_json_dumps
+from .misc.dedup import shared_registry
+from core.llm_gateway import as_gateway
 import argparse
 import json
 import shutil
@@ -17,7 +21,7 @@ class KeywordExtractorAgent:
         llms
     ):
         self.documents = documents
-        self.llms = llms
+        self.llm = as_gateway(llms)
 
         # Define the system prompt for the task
         self.system_prompt = {
@@ -52,26 +56,20 @@ Based on the above user case and documents, extract a list of relevant keywords,
 
 Provide the list of keywords in bullet point format.
 """
-        response = self._get_llm_response(prompt)
+        response = await self._get_llm_response(prompt)
         keywords = self._parse_keywords(response)
         return keywords
 
-    def _get_llm_response(self, prompt: str) -> str:
+    async def _get_llm_response(self, prompt: str) -> str:
         """Get response from the LLM."""
         # response = self.llm.invoke([
         #     {"role": "system", "content": self.system_prompt['content']},
         #     {"role": "user", "content": prompt}
         # ])
-        for i,llm in enumerate(self.llms):
-            try:
-                response = llm.invoke([
-                    {"role": "system", "content": self.system_prompt['content']},
-                    {"role": "user", "content": prompt}
-                ])
-                break
-            except Exception as e:
-                print(f"LLM {i} failed with error: {e}")
-                continue
+        response = await self.llm.ainvoke([
+            {"role": "system", "content": self.system_prompt['content']},
+            {"role": "user", "content": prompt}
+        ])
         return response.content
 
     def _parse_keywords(self, response: str) -> Dict[str, Any]:
@@ -88,6 +86,11 @@ Provide the list of keywords in bullet point format.
 
 load_dotenv()
 
+# raw API responses and search TOCs, kept out of the indexed directories
+KANOON_RAW_DIR = os.getenv("KANOON_RAW_DIR", "kanoon_raw")
+# clean judgment text, one file per docid, picked up by the public collection
+KANOON_TEXT_DIR = os.path.join("public_documents", "kanoon")
+
 
 class Document:
     def __init__(self, content: str):
@@ -97,7 +100,7 @@ class FetchingAgent:
     """Agent responsible for fetching relevant docs from the kanoon api"""
     
     def __init__(self, llms):
-        self.llms = llms
+        self.llm = as_gateway(llms)
         print("initialised kanoon fetcher...")
         # super().__init__(**kwargs)
 
@@ -108,13 +111,21 @@ class FetchingAgent:
         if not kanoon_api_key:
             raise ValueError("KANOON_API_KEY not found in environment variables.")
 
-        data_directory = "public_documents"
-        os.makedirs(data_directory, exist_ok=True)
-        filestorage = FileStorage(data_directory)
+        os.makedirs(KANOON_RAW_DIR, exist_ok=True)
+        os.makedirs(KANOON_TEXT_DIR, exist_ok=True)
+        filestorage = FileStorage(KANOON_RAW_DIR)
+
+        dedup = await asyncio.to_thread(shared_registry, os.path.join(KANOON_RAW_DIR, "dedup.json"), KANOON_TEXT_DIR)
+
+        # JSON dumps written into public_documents by earlier versions would be embedded with their markup
+        migrated = await asyncio.to_thread(migrate_json_dumps, "public_documents", KANOON_RAW_DIR, KANOON_TEXT_DIR, dedup)
+        if migrated:
+            print(f"Converted {migrated} Kanoon JSON documents to text")
 
         args = argparse.Namespace(
             token=kanoon_api_key,
-            datadir=data_directory,
+            datadir=KANOON_RAW_DIR,
+            textdir=KANOON_TEXT_DIR,
             maxpages=2,  # Limit number of pages
             maxcites=0,
             maxcitedby=0,
@@ -123,7 +134,7 @@ class FetchingAgent:
         )
 
         # Initialize Indian Kanoon API client
-        ikapi = IKApi(args, filestorage)
+        ikapi = IKApi(args, filestorage, dedup)
 
         # List to store the content of the text files uploaded by user
         folder_path = 'private_documents'
@@ -141,7 +152,7 @@ class FetchingAgent:
                     documents.append(content)
 
         # Extract Keywords
-        agent = KeywordExtractorAgent(documents=documents, llms=self.llms)
+        agent = KeywordExtractorAgent(documents=documents, llms=self.llm)
         keywords_result = await agent.extract_keywords(user_case=state["messages"][-1].content)  # Await the coroutine
 
         # Step 2: Use Extracted Keywords for Searching Relevant Cases
@@ -156,77 +167,10 @@ class FetchingAgent:
         all_doc_ids = []
         for keyword in keywords[:5]: # Use only the first 5 keywords
             print(f"Searching for keyword: {keyword}")
-            doc_ids = ikapi.save_search_results(keyword, max_docs=MAX_DOCS_PER_KEYWORD)
+            # the Kanoon client is blocking, keep it off the event loop serving the other trials
+            doc_ids = await asyncio.to_thread(ikapi.save_search_results, keyword, max_docs=MAX_DOCS_PER_KEYWORD)
             all_doc_ids.extend(doc_ids)
             
         # Print the total number of documents fetched
         print(f"Total documents fetched: {len(all_doc_ids)}")
-
-        # converting fetched json data from the API to texts, not doing it 
-        # Path to the 'public' directory
-        # base_path = "public_documents"
-
-        # # Loop through all unique subfolders, created by the storage utility, in the base directory
-        # for unique_folder in os.listdir(base_path):
-        #     unique_folder_path = os.path.join(base_path, unique_folder)
-            
-        #     # Skip if not a folder
-        #     if not os.path.isdir(unique_folder_path):
-        #         continue
-            
-        #     # Text content to combine for the current unique folder
-        #     combined_text = []
-            
-        #     # Traverse the hierarchy within the unique folder
-        #     for court_folder in os.listdir(unique_folder_path):
-        #         court_folder_path = os.path.join(unique_folder_path, court_folder)
-                
-        #         if not os.path.isdir(court_folder_path):
-        #             continue
-                
-        #         for year_folder in os.listdir(court_folder_path):
-        #             year_folder_path = os.path.join(court_folder_path, year_folder)
-                    
-        #             if not os.path.isdir(year_folder_path):
-        #                 continue
-                    
-        #             for date_folder in os.listdir(year_folder_path):
-        #                 date_folder_path = os.path.join(year_folder_path, date_folder)
-                        
-        #                 if not os.path.isdir(date_folder_path):
-        #                     continue
-                        
-        #                 # Process each JSON file in the date folder
-        #                 for file_name in os.listdir(date_folder_path):
-        #                     file_path = os.path.join(date_folder_path, file_name)
-                            
-        #                     # Skip if not a JSON file
-        #                     if not file_name.endswith(".json"):
-        #                         continue
-                            
-        #                     try:
-        #                         # Load and extract JSON content
-        #                         with open(file_path, "r", encoding="utf-8") as json_file:
-        #                             data = json.load(json_file)
-                                    
-        #                             # Convert JSON content to string and append to combined_text
-        #                             combined_text.append(json.dumps(data, indent=4))
-        #                     except Exception as e:
-        #                         print(f"Error processing file {file_path}: {e}")
-            
-        #     # Write the combined text to a single file named after the unique folder
-        #     if combined_text:
-        #         output_file_path = os.path.join(base_path, f"{unique_folder}.txt")
-        #         with open(output_file_path, "w", encoding="utf-8") as output_file:
-        #             output_file.write("\n\n".join(combined_text))
-        #         print(f"Created combined text file: {output_file_path}")
-
-        #         # Delete the unique folder after successful processing
-        #         try:
-        #             shutil.rmtree(unique_folder_path)
-        #             print(f"Deleted folder: {unique_folder_path}")
-        #         except Exception as e:
-        #             print(f"Error deleting folder {unique_folder_path}: {e}")
-
-        # time.sleep(10)
-
+        print(f"Dedup report: {dedup.report()}")
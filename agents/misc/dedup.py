@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import tempfile
+import threading
+
+import numpy as np
+
+logger = logging.getLogger('ikapi')
+
+PRIME = (1 << 31) - 1  # MinHash permutations are a * h + b mod PRIME, fits in uint64 for 31 bit hashes
+WORD_RE = re.compile(r'\w+')
+
+
+def shingles(text, size=5):
+    """Set of `size`-word shingles of a text, case and punctuation insensitive"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def body_of(text):
+    """Judgment text without the Title/Court/Date/Docid header, which differs between copies"""
+    head, sep, body = text.partition('\n\n')
+    return body if sep else head
+
+
+class MinHasher:
+    """MinHash signatures of shingle sets, their agreement estimates the Jaccard similarity"""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.a = np.array([rng.randrange(1, PRIME) for _ in range(num_perm)], dtype=np.uint64)
+        self.b = np.array([rng.randrange(0, PRIME) for _ in range(num_perm)], dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, shingle_set):
+        if not shingle_set:
+            return [PRIME] * self.num_perm
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little') % PRIME
+             for s in shingle_set],
+            dtype=np.uint64,
+        )
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % PRIME
+        return permuted.min(axis=1).tolist()
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+
+class DedupRegistry:
+    """
+    Registry of the Kanoon documents already ingested, persisted as JSON next to the raw documents.
+
+    Catches a judgment found again by another keyword or a later trial by its docid before it is
+    fetched, and a different docid carrying the same judgment (reported copies, re-uploads) by
+    MinHash near-duplicate detection before it is written to the indexed directory and embedded.
+    Near-duplicate candidates are found with LSH over `bands` bands of the signature.
+    """
+
+    def __init__(self, path, threshold=0.85, num_perm=64, bands=16, chunk_size=5000):
+        """
+        Args:
+            path (str): JSON file the registry is kept in
+            threshold (float): estimated Jaccard similarity above which a document is a duplicate
+            num_perm (int): length of the MinHash signatures, a multiple of `bands`
+            bands (int): number of LSH bands
+            chunk_size (int): chunk size of the index splitter, to report the chunks saved
+        """
+        self.path = path
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+        self.docs = {}  # docid -> {'bytes': int, 'duplicate_of': docid or None}
+        self.signatures = {}  # docid -> MinHash signature, indexed documents only
+        self.stats = {'fetches_skipped': 0, 'near_duplicates': 0, 'bytes_saved': 0, 'chunks_saved': 0}
+        self._buckets = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as registry_file:
+                saved = json.load(registry_file)
+            self.docs = saved.get('docs', {})
+            self.signatures = saved.get('signatures', {})
+            self.stats.update(saved.get('stats', {}))
+        for docid, signature in self.signatures.items():
+            self._index(docid, signature)
+
+    def _band_keys(self, signature):
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def _index(self, docid, signature):
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, set()).add(docid)
+
+    def _chunks(self, num_bytes):
+        return max(1, math.ceil(num_bytes / self.chunk_size))
+
+    def save(self):
+        """Write the registry, called with the lock held"""
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # a temp file of its own, a registry of another process may be saving next to it
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as registry_file:
+                json.dump({'docs': self.docs, 'signatures': self.signatures, 'stats': self.stats}, registry_file)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+    def has_doc(self, docid):
+        """
+        True if the document was ingested or rejected as a duplicate before, counted as a skipped fetch.
+        The counters are written with the next admitted document.
+        """
+        docid = str(docid)
+        with self._lock:
+            known = self.docs.get(docid)
+            if known is None:
+                return False
+            self.stats['fetches_skipped'] += 1
+            self.stats['bytes_saved'] += known['bytes']
+            self.stats['chunks_saved'] += self._chunks(known['bytes'])
+            return True
+
+    def admit(self, docid, text, save=True):
+        """
+        Register a converted document.
+
+        Args:
+            save (bool): write the registry, False when registering a batch saved at its end
+
+        Returns:
+            str: docid of the indexed document this one duplicates, None if it should be indexed
+        """
+        docid = str(docid)
+        num_bytes = len(text.encode('utf-8'))
+        signature = self.hasher.signature(shingles(body_of(text)))
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            candidates.discard(docid)
+            duplicate_of = max(
+                candidates, default=None,
+                key=lambda other: self.hasher.similarity(signature, self.signatures[other]),
+            )
+            if duplicate_of is not None and self.hasher.similarity(signature, self.signatures[duplicate_of]) < self.threshold:
+                duplicate_of = None
+
+            self.docs[docid] = {'bytes': num_bytes, 'duplicate_of': duplicate_of}
+            if duplicate_of is None:
+                self.signatures[docid] = signature
+                self._index(docid, signature)
+            else:
+                self.stats['near_duplicates'] += 1
+                self.stats['bytes_saved'] += num_bytes
+                self.stats['chunks_saved'] += self._chunks(num_bytes)
+            if save:
+                self.save()
+            return duplicate_of
+
+    def bootstrap(self, textdir):
+        """
+        Register the converted documents already in `textdir`, for indexes built before the registry.
+        Near duplicates among them are removed from the index, their JSON stays in the raw directory.
+        """
+        if not os.path.isdir(textdir):
+            return
+        admitted = 0
+        for filename in sorted(os.listdir(textdir)):
+            docid = filename[:-len('.txt')]
+            if not filename.endswith('.txt') or docid in self.docs:
+                continue
+            textpath = os.path.join(textdir, filename)
+            with open(textpath, 'r', encoding='utf-8') as text_file:
+                duplicate_of = self.admit(docid, text_file.read(), save=False)
+            admitted += 1
+            if duplicate_of is not None:
+                logger.info(f"Removing docid {docid} from the index, near duplicate of docid {duplicate_of}.")
+                os.remove(textpath)
+        if admitted:
+            with self._lock:
+                self.save()
+
+    def report(self):
+        """Docs ingested and duplicates skipped, with the bytes and (estimated) chunks they would have cost"""
+        with self._lock:
+            return {
+                'documents': len(self.docs),
+                'indexed': len(self.signatures),
+                **self.stats,
+            }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def shared_registry(path, textdir=None):
+    """
+    The process-wide registry kept in `path`, loaded (and bootstrapped from `textdir`) on first use.
+    Concurrent trials share it, separate instances would overwrite each other's updates.
+    """
+    path = os.path.abspath(path)
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = _registries[path] = DedupRegistry(path)
+            if textdir:
+                registry.bootstrap(textdir)
+        return registry
@@ -1,13 +1,18 @@
 import logging
+import os
 import http.client
 import json
 import ssl
 import time
 import urllib.parse
 
+from core.telemetry import KANOON, span
+
+from .kanoon_text import convert_json_file
+
 
 class IKApi:
-    def __init__(self, args, storage):
+    def __init__(self, args, storage, dedup=None):
         
         # Initialize logger for debugging
         self.logger = logging.getLogger('ikapi')
@@ -28,7 +33,22 @@ class IKApi:
         self.maxpages = min(args.maxpages, 100)  # Limit maxpages to 100
         self.pathbysrc = args.pathbysrc
 
+        # directory the clean text of every downloaded document is written to, None to keep only the JSON
+        self.textdir = getattr(args, 'textdir', None)
+
+        # registry of documents already ingested, skips their fetch and near duplicates, None to disable
+        self.dedup = dedup
+
     def call_api(self, url):
+        """Makes an API call, timed as a span per endpoint (search, doc, origdoc...)."""
+        with span(KANOON, url.strip('/').split('/')[0]) as attrs:
+            result = self._call_api(url)
+            attrs["bytes"] = len(result) if result else 0
+            if result is None:
+                attrs["outcome"] = "error"
+        return result
+
+    def _call_api(self, url):
         """Makes an API call with retries in case of SSL or HTTP errors."""
         max_retries = 3
         for attempt in range(max_retries):
@@ -148,6 +168,12 @@ class IKApi:
                         'date': doc['publishdate'], 'court': doc['docsource']}
                     tocwriter.writerow(toc)
 
+                    # already ingested for another keyword or an earlier trial
+                    if self.dedup and self.dedup.has_doc(docid):
+                        self.logger.info(f"Skipping docid {docid}, already ingested.")
+                        current += 1
+                        continue
+
                     # Download and save document content
                     docpath = self.storage.get_docpath(keyword_dir, doc['docsource'], doc['publishdate'])
                     if self.download_doc(docid, docpath):
@@ -197,6 +223,11 @@ class IKApi:
                 self.logger.error(f"An error occurred while fetching or processing docid {docid}: {e}")
                 return success
 
+        # convert as soon as the document lands, the index picks it up without waiting for the whole search
+        if self.textdir and self.storage.exists(jsonpath) and not self.storage.exists(self.get_textpath(docid)):
+            if not convert_json_file(jsonpath, self.textdir, self.dedup):
+                self.logger.info(f"No text indexed for docid {docid}.")
+
         if orig_needed and not self.storage.exists_original(origpath):
             try:
                 # Fetch original document content
@@ -210,6 +241,10 @@ class IKApi:
         return success
 
 
+    def get_textpath(self, docid):
+        """Path of the clean text of a document, one file per docid whichever search found it."""
+        return os.path.join(self.textdir, f'{docid}.txt')
+
     def fetch_orig_doc(self, docid):
         """Fetch the original version of a document."""
         url = f'/origdoc/{docid}/'
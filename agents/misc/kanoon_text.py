@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import re
+from html.parser import HTMLParser
+
+logger = logging.getLogger('ikapi')
+
+# tags that start a new line in the extracted text
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'pre', 'blockquote', 'li', 'ul', 'ol', 'tr', 'table',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article',
+}
+SKIP_TAGS = {'script', 'style', 'head'}
+HEADER_FIELDS = ('title', 'court', 'date', 'docid')
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the text of an HTML fragment, one line per block element"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+        self._pre = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'pre':
+            self._pre += 1
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag == 'pre':
+            self._pre = max(self._pre - 1, 0)
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        # whitespace is only meaningful inside <pre>, elsewhere it is source formatting
+        self.parts.append(data if self._pre else re.sub(r'\s+', ' ', data))
+
+
+def html_to_text(html):
+    """Plain text of an HTML fragment, markup and scripts stripped, paragraphs kept apart by a blank line"""
+    parser = _TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    lines = [line.strip() for line in ''.join(parser.parts).split('\n')]
+    text = '\n'.join(lines)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def kanoon_metadata(doc):
+    """title, court, date and docid of a document returned by the /doc/ endpoint"""
+    return {
+        'title': html_to_text(doc.get('title', '')),
+        'court': doc.get('docsource', ''),
+        'date': doc.get('publishdate', ''),
+        'docid': str(doc.get('tid', '')),
+    }
+
+
+def kanoon_to_text(doc):
+    """
+    Clean text of a Kanoon document: a 'Field: value' header with its metadata, a blank line,
+    then the judgment text without HTML.
+
+    Args:
+        doc (dict): parsed JSON of the /doc/ endpoint
+
+    Returns:
+        str: header and judgment text, empty if the document has no text
+    """
+    fields = kanoon_metadata(doc)
+    body = html_to_text(doc.get('doc', ''))
+    if not body:
+        return ''
+    header = '\n'.join(f'{key.capitalize()}: {fields[key]}' for key in HEADER_FIELDS if fields.get(key))
+    return f'{header}\n\n{body}\n'
+
+
+def write_text(text, textpath):
+    """
+    Write a converted document. It is written to a dotfile next to it and moved in place, so the
+    Pathway reader watching the text directory, which skips dotfiles, never picks up a half written
+    file. The move stays on one filesystem, where it is atomic.
+    """
+    os.makedirs(os.path.dirname(textpath), exist_ok=True)
+    tmppath = os.path.join(os.path.dirname(textpath), f'.{os.path.basename(textpath)}.tmp')
+    with open(tmppath, 'w', encoding='utf-8') as text_file:
+        text_file.write(text)
+    os.replace(tmppath, textpath)
+
+
+def convert_json_file(jsonpath, textdir, dedup=None):
+    """
+    Convert one stored Kanoon JSON document to text in `textdir`, named after its docid.
+    With a `dedup` registry, near duplicates of an indexed document are not written.
+
+    Returns:
+        str: path of the text file, None if the document could not be converted or is a duplicate
+    """
+    try:
+        with open(jsonpath, 'r', encoding='utf-8') as json_file:
+            doc = json.load(json_file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read Kanoon document {jsonpath}: {e}")
+        return None
+    if 'errmsg' in doc or 'tid' not in doc:
+        return None
+    text = kanoon_to_text(doc)
+    if not text:
+        return None
+    duplicate_of = dedup.admit(doc['tid'], text) if dedup else None
+    if duplicate_of is not None:
+        logger.info(f"Docid {doc['tid']} is a near duplicate of docid {duplicate_of}, not indexed.")
+        return None
+    textpath = os.path.join(textdir, f"{doc['tid']}.txt")
+    write_text(text, textpath)
+    return textpath
+
+
+def migrate_json_dumps(srcdir, rawdir, textdir, dedup=None):
+    """
+    Move raw JSON dumps left in an indexed directory by earlier versions out of it.
+    Every *.json document (and its toc.csv) under `srcdir` is converted to text in `textdir`
+    and moved with its directory layout to `rawdir`, which is not indexed.
+
+    Returns:
+        int: number of documents converted
+    """
+    converted = 0
+    moved_from = set()
+    for dirpath, dirnames, filenames in os.walk(srcdir, topdown=False):
+        if os.path.abspath(dirpath).startswith(os.path.abspath(textdir)):
+            continue
+        for filename in filenames:
+            if not (filename.endswith('.json') or filename == 'toc.csv'):
+                continue
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.json') and convert_json_file(path, textdir, dedup):
+                converted += 1
+            target = os.path.join(rawdir, os.path.relpath(path, srcdir))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            moved_from.add(dirpath)
+        # drop the keyword/court/year/date directories emptied by the move
+        emptied = dirpath in moved_from or any(os.path.join(dirpath, name) in moved_from for name in dirnames)
+        if emptied and dirpath != srcdir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+            moved_from.add(dirpath)
+    return converted
@@ -3,7 +3,9 @@ from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.tools import BaseTool
-from .base import AgentState
+from .base import AgentState, RESEARCH_STEP, current_task, research_response
+from core.llm_gateway import as_gateway
+from core.context import ContextCompactor
 from pydantic import BaseModel, Field
 from langchain_groq import ChatGroq
 import os
@@ -22,9 +24,11 @@ class ProsecutorAgent:
         self,
         llms,
         tools: Optional[List[BaseTool]] = None,
+        context_budget: int = 6000,
     ):
         # self.llm = llm or ChatGroq(model="llama-3.1-70b-versatile", api_key=os.getenv('GROQ_API_KEY'))
-        self.llms = llms 
+        self.llm = as_gateway(llms)  # shared gateway, fallback ordered by model health
+        self.context = ContextCompactor(self.llm, budget=context_budget)  # estimated tokens of transcript per call
         self.tools = tools or []
         
         self.system_prompt = """
@@ -55,17 +59,13 @@ IMPORTANT NOTE: Do only 'current_task' at a time, other task will be done in nex
     async def process(self, state: AgentState) -> AgentState:
         """Process current state with prosecutor-specific logic"""
         
+        # older turns summarized and old evidence referenced, within the context budget
+        history, context = await self.context.compact("prosecutor", state)
         messages = [
-            {"role": "system", "content": self.system_prompt + "\n'current_task': " + self.get_thought_steps()[state["thought_step"]]}
-        ] + state["messages"]
+            {"role": "system", "content": self.system_prompt + "\n'current_task': " + current_task(self.get_thought_steps(), state)}
+        ] + history
 
-        for i,llm in enumerate(self.llms):
-            try:
-                result = llm.invoke(messages)
-                break
-            except Exception as e:
-                print(f"LLM {i} failed with error: {e}")
-                continue
+        result = await self.llm.ainvoke(messages)
     
         # result = self.llm.invoke(messages)
         
@@ -76,6 +76,8 @@ IMPORTANT NOTE: Do only 'current_task' at a time, other task will be done in nex
                 "thought_step": state["thought_step"]+1,
                 "caller": "prosecutor"
             }
+        elif state["thought_step"] == RESEARCH_STEP and state.get("parallel_research"):
+            response = research_response(result.content, "prosecutor")
         elif state["thought_step"] == 1 :
             response = {
                 "messages": [HumanMessage(content=result.content, name="prosecutor")],
@@ -100,6 +102,7 @@ IMPORTANT NOTE: Do only 'current_task' at a time, other task will be done in nex
         else:
             raise ValueError("Invalid thought step")
             
+        response.update(context)
         return response
     
     def is_web_search_needed(self, content: str) -> Literal["self", "web_searcher"]:
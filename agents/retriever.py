@@ -5,7 +5,18 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
 from core.pathway_store import PathwayVectorStore
-from .base import AgentState
+from core.embedding_cache import EmbeddingCache
+from core.ipc_parser import IPCSectionIndex
+from core.async_client import gather_with_timeout
+from core.retrieval_cache import RetrievalCache, normalize_query
+from core.chunk_metadata import MetadataFilter
+from core.llm_gateway import as_gateway
+from core.context import ContextCompactor
+from core.streaming import token_stream
+from core.telemetry import VECTOR_QUERY, span
+import asyncio
+from langchain_core.documents import Document
+from .base import AgentState, parse_structured_output, structured_output_instructions
 from langchain_groq import ChatGroq
 from langchain_core.messages.utils import get_buffer_string
 import os
@@ -14,44 +25,83 @@ load_dotenv()
 import re
 
 
-def create_law_retriever(private=False) -> BaseTool:
-    """Create vector store retriever for legal documents"""
-    vector_store = None
-    if private:
-        vector_store = PathwayVectorStore('private', './private_documents', 8765)
-    else:
-        vector_store = PathwayVectorStore('public', './public_documents', 8766)
+LAW_COLLECTIONS = {
+    "private": "./private_documents",  # user case files or documents
+    "public": "./public_documents",  # IPC, legal case precedents etc.
+}
+
+
+def create_law_store(embedding_cache=None) -> PathwayVectorStore:
+    """Create the vector store holding the private and public legal documents as collections"""
+    return PathwayVectorStore(
+        LAW_COLLECTIONS,
+        8765,
+        embedding_cache=embedding_cache,
+        # workers attach to the snapshots at startup and serve from them while the live index builds,
+        # only collections whose files changed since the last snapshot are re-chunked and re-embedded
+        snapshot_dir=os.getenv("INDEX_SNAPSHOT_DIR", ".index_snapshots"),
+    )
 
-    client = vector_store.get_client()
-    
-    retriever = client.as_retriever()
+
+def create_law_retriever(vector_store: PathwayVectorStore, collection: str, mode="hybrid") -> BaseTool:
+    """Create vector store retriever for one collection of legal documents"""
+    retriever = vector_store.as_retriever(collection, mode=mode)
 
     return retriever
+
+
+def create_section_index(path="./public_documents/IndianPenalCode.txt") -> IPCSectionIndex:
+    """Exact IPC section lookup index, empty if the IPC is not in the public documents"""
+    if not os.path.exists(path):
+        return IPCSectionIndex([])
+    return IPCSectionIndex.from_file(path)
    
 # class RetrieverResponse(BaseModel):
 #     """Structured retriever response"""
 #     # response: str = Field(description="The retriever's assessment of the retrieved content")
 #     is_enough: bool = Field(description="Whether the retrieved content is enough to answer the request")
 
-# class Queries(BaseModel):
-#     private_query: str = Field(description="Query for private retriever (user case files or documents). 'none' if not needed")  
-#     public_query: str = Field(description="Query for public retriever (public docs like IPC, legal case precedents, etc) 'none' if not needed")
+class Queries(BaseModel):
+    """Query plan for both retrievers, formed in one call"""
+    private_query: str = Field(description="Query for private retriever (user case files or documents). 'none' if not needed")
+    public_query: str = Field(description="Query for public retriever (public docs like IPC, legal case precedents, etc) 'none' if not needed")
+
+
 class RetrieverAgent:
     """Agent for retrieving and analyzing legal documents from vector store"""
     
     def __init__(
         self,
         llms,
+        retrieval_mode: str = "hybrid",
+        retrieval_timeout: float = 20.0,
+        retrieval_cache: Optional[RetrievalCache] = None,
+        context_budget: int = 4000,
         # **kwargs
     ):
-        self.private_retriever = create_law_retriever(private=True)
-        self.public_retriever = create_law_retriever(private=False)
+        """
+        Args:
+            llms: shared LLMGateway, or LLMs to use in order of fallback
+            retrieval_mode: 'vector', 'lexical' (BM25) or 'hybrid' retrieval over the collections
+            retrieval_timeout: seconds each collection query may take before it is given up on
+            retrieval_cache: cache of retrieval results shared across turns and trials, a new one if None
+            context_budget: estimated tokens of transcript sent per call, older turns are summarized over it
+        """
+        embedding_cache = EmbeddingCache(os.getenv("EMBEDDING_CACHE_PATH", ".embedding_cache/embeddings.sqlite"))
+        self.vector_store = create_law_store(embedding_cache=embedding_cache)
+        self.private_retriever = create_law_retriever(self.vector_store, "private", mode=retrieval_mode)
+        self.public_retriever = create_law_retriever(self.vector_store, "public", mode=retrieval_mode)
+        self.section_index = create_section_index()
+        self.retrieval_timeout = retrieval_timeout
+        self.retrieval_mode = retrieval_mode
+        self.retrieval_cache = retrieval_cache or RetrievalCache()
         # self.llm = llm or ChatGroq(model="llama-3.1-70b-versatile", api_key=os.getenv('GROQ_API_KEY'))
-        self.llms = llms
+        self.llm = as_gateway(llms)
+        self.context = ContextCompactor(self.llm, budget=context_budget)
         self.system_prompt = """
 "You are a legal research assistant specializing in retrieving relevant legal provisions, case laws, and statutes from a vector database of the Indian Penal Code (IPC) and related legal documents."
 "Formulate queries based on inputs from the judge, lawyer, or prosecutor, ensuring precision in the retrieval process."
-"Evaluate the retrieved text for relevance and clarity before sharing it with the requesting agent. If the retrieval is insufficient, refine the query and attempt again."
+"Evaluate the retrieved text for relevance and clarity before sharing it with the requesting agent."
 "you have acsess to private retrierver (contains user case files or documents) and public retriever (contains public docs like IPC, legal case precedents, etc)"
 "Your role is critical in supporting the legal arguments by providing accurate and contextually appropriate legal references."
 "Ensure that your outputs are succinct, relevant, and formatted for easy understanding by the requesting agent."
@@ -59,86 +109,133 @@ class RetrieverAgent:
 you will go through the following chain of thought steps:
 1. Analyze the information request.
 2. Form the queries.
-3. Assess the retrieved results.
-4. Provide accurate excerpts of information
+3. Provide accurate excerpts of information
 
 IMPORTANT NOTE: Do only 'current_task' at a time, other task will be done in next steps or other agents. Avoid very long responses.
 """
 
+    def get_index_progress(self) -> dict:
+        """Build progress and readiness of the backing vector store, and retrieval cache metrics"""
+        return {**self.vector_store.get_progress(), "retrieval_cache": self.retrieval_cache.stats()}
+
+    async def _cached(self, collection: str, query: str, retrieve,
+                      filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """
+        Serve a retrieval from the cache, or run `retrieve(query, filters)` and cache its result.
+        Entries of a collection are invalidated as soon as one of its files changes.
+        Failed retrievals are not cached.
+        """
+        with span(VECTOR_QUERY, collection) as attrs:
+            version = await asyncio.to_thread(self.vector_store.collection_version, collection)
+            key = (collection, self.retrieval_mode, normalize_query(query), filters or None)
+            documents = self.retrieval_cache.get(key, version)
+            if documents is None:
+                documents = await retrieve(query, filters)
+                self.retrieval_cache.put(key, version, documents)
+            else:
+                attrs["outcome"] = "cached"
+            attrs["bytes"] = sum(len(document.page_content.encode("utf-8")) for document in documents)
+        return documents
+
+    def _exact_sections(self, query: str) -> List[Document]:
+        sections = self.section_index.lookup(query)
+        return [Document(page_content=section.to_text(), metadata=section.metadata()) for section in sections]
+
+    def _merge_public(self, exact: List[Document], similar: List[Document]) -> List[Document]:
+        found = {doc.metadata["ipc_section"] for doc in exact}
+        return exact + [doc for doc in similar if doc.metadata.get("ipc_section") not in found]
+
+    def retrieve_public(self, query: str, filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """
+        Retrieve from the public documents. Sections referenced in the query ("Section 499", "IPC 345")
+        are resolved from the section index, pure section references skip the vector search altogether.
+        `filters` restrict the search, explicitly referenced sections are returned regardless.
+        """
+        exact = self._exact_sections(query)
+        if exact and self.section_index.is_exact_query(query):
+            return exact
+        return self._merge_public(exact, self.public_retriever.invoke(query, filters=filters))
+
+    async def aretrieve_public(self, query: str, filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """Async retrieve_public, the vector search goes through the pooled async client"""
+        exact = self._exact_sections(query)
+        if exact and self.section_index.is_exact_query(query):
+            return exact
+        similar = await self.public_retriever.ainvoke(query, timeout=self.retrieval_timeout, filters=filters)
+        return self._merge_public(exact, similar)
+
+    async def retrieve(self, private_query: str, public_query: str,
+                       public_filters: Optional[MetadataFilter] = None):
+        """
+        Query the private and public collections concurrently, 'none' skips a collection.
+        A collection that fails or times out yields 'None' rather than failing the other one.
+        `public_filters` (eg. Supreme Court only, after 2010) are applied inside the index, when
+        nothing matches them no public documents are returned.
+
+        Returns:
+        (private_retrieved_content, public_retrieved_content)
+        """
+        async def skipped():
+            return 'None'
+
+        async def private_retrieve(query, filters):
+            return await self.private_retriever.ainvoke(query, timeout=self.retrieval_timeout, filters=filters)
+
+        private = (self._cached("private", private_query, private_retrieve)
+                   if private_query.lower() != 'none' else skipped())
+        public = (self._cached("public", public_query, self.aretrieve_public, public_filters or None)
+                  if public_query.lower() != 'none' else skipped())
+        # the outer bound also covers the lexical search and the exact section lookup
+        return await gather_with_timeout(private, public, timeout=self.retrieval_timeout, default='None')
+
     def get_thought_steps(self) -> List[str]:
         """Get retriever-specific chain of thought steps"""
         return [
             "1. Analyze the information request received from the lawyer or prosecutor and Note the key words and points.",
-            "2. Accordiing to the resqusted information, if private_retriever(user case files or user documents) is needed, form a query for it. if not respond with only 'none'",
-            "3. Accordiing to the resqusted information, if public_retriever(contains public docs like IPC, legal case precedents, etc) is needed, form a query for it. if not respond with only 'none'",
-            "4. Assess the retrieved results and determine If they are relevent and enough. if yes, respond with keyword 'is_enough', if not respond with keyword 'not_enough'",
-            "5. Provide the lawyer or prosecutor with accurate excerpts of relevant laws based on the request, ensuring clarity.If no relevant law is found, respond with 'No relevant law found in database.'"
+            "2. Accordiing to the resqusted information, form a query for the private_retriever(user case files or user documents) if it is needed and a query for the public_retriever(contains public docs like IPC, legal case precedents, etc) if it is needed, 'none' for a retriever that is not needed. " + structured_output_instructions(Queries),
+            "3. Provide the lawyer or prosecutor with accurate excerpts of relevant laws based on the request, ensuring clarity.If no relevant law is found, respond with 'No relevant law found in database.'"
         ]
 
+    async def plan_queries(self, messages) -> Queries:
+        """
+        Form the private and public queries in one call. A response that is not the expected JSON
+        is used as the query for both retrievers, like two free-text answers would have been.
+        """
+        response = await self.llm.ainvoke(messages)
+        queries = parse_structured_output(response.content, Queries)
+        if queries is None:
+            print(f"Retriever query plan is not valid JSON, using it as both queries: {response.content[:200]}")
+            query = response.content.strip()
+            queries = Queries(private_query=query, public_query=query)
+        return queries
+
     async def process(self, state: AgentState) -> AgentState:
         """Process current state with retriever-specific logic"""
         
+        # older turns summarized and old evidence referenced, within the context budget
+        history, context = await self.context.compact("retriever", state)
         messages = [
             {"role": "system", "content": self.system_prompt + f"\n'current_task': {self.get_thought_steps()[0]}"}
-        ] + state["messages"]
-
-        # info_analysis = self.llm.invoke(messages)
+        ] + history
 
-        for i,llm in enumerate(self.llms):
-            try:
-                info_analysis = llm.invoke(messages)
-                break
-            except Exception as e:
-                print(f"LLM {i} failed with error: {e}")
-                continue
+        # analysis and query plan are internal steps, only the excerpts are streamed to the UI
+        with token_stream(None):
+            info_analysis = await self.llm.ainvoke(messages)
 
-            
-        for i in range(1): # max 5 iterations
-            #formulate query
+            #formulate both queries in one structured call
             messages.append({"role": "system", "content": "need_info: " + info_analysis.content + "\n" + "current_task: " + self.get_thought_steps()[1]})
-            # queries = self.llm.with_structured_output(Queries).invoke(messages)
-            for i,llm in enumerate(self.llms):
-                try:
-                    private_query = llm.invoke(messages)
-                    public_query = llm.invoke(messages)
-                    break
-                except Exception as e:
-                    print(f"LLM {i} failed with error: {e}")
-
-            #retrieve
-            private_retrieved_content = self.private_retriever.invoke(private_query.content) if private_query.content.lower() != 'none' else 'None'
-            public_retrieved_content = self.public_retriever.invoke(public_query.content) if public_query.content.lower() != 'none' else 'None'
-
-            #assess
-            messages.append({"role": "system", "content": "private_retrieved_content: " + str(private_retrieved_content) + "\npublic_retrieved_content: " + str(public_retrieved_content) + "\ncurrent_task: " + self.get_thought_steps()[2]})
-            # assessment = self.llm.with_structured_output(RetrieverResponse).invoke(messages)
-            for i,llm in enumerate(self.llms):
-                try:
-                    assessment = llm.invoke(messages)
-                    break
-                except Exception as e:
-                    print(f"LLM {i} failed with error: {e}")
-                    continue
-
-            #continue
-            if not re.search(r"not_enough", assessment.content, re.IGNORECASE):
-                break
-
-                
-            
-        
-        messages.append({"role": "system", "content": "private_retrieved_content: " + str(private_retrieved_content) + "\npublic_retrieved_content: " + str(public_retrieved_content) + "\ncurrent_task: " + self.get_thought_steps()[3]})
-        # result = self.llm.invoke(messages)
-        for i,llm in enumerate(self.llms):
-            try:
-                result = llm.invoke(messages)
-                break
-            except Exception as e:
-                print(f"LLM {i} failed with error: {e}")
-                continue
+            queries = await self.plan_queries(messages)
+
+        #retrieve, both collections concurrently
+        # court and year restrictions in the request are pushed down into the index
+        public_filters = MetadataFilter.from_text(queries.public_query)
+        private_retrieved_content, public_retrieved_content = await self.retrieve(
+            queries.private_query, queries.public_query, public_filters
+        )
+
+        messages.append({"role": "system", "content": "private_retrieved_content: " + str(private_retrieved_content) + "\npublic_retrieved_content: " + str(public_retrieved_content) + "\ncurrent_task: " + self.get_thought_steps()[2]})
+        result = await self.llm.ainvoke(messages)
 
-        
-        
         response = {
             "messages": [HumanMessage(content=result.content, name="retriever")],
             "next": state["caller"],
@@ -147,6 +244,7 @@ IMPORTANT NOTE: Do only 'current_task' at a time, other task will be done in nex
         }
    
             
+        response.update(context)
         return response
     
                     
@@ -1,6 +1,7 @@
 from .Internet_data_retriever.internet_data import DataRetrievalCrew
 from .base import AgentState
 from langchain_core.messages import HumanMessage
+from core.telemetry import WEB_SEARCH, span
 
 class WebSearcherAgent:
     def __init__(self, llm):
@@ -8,7 +9,9 @@ class WebSearcherAgent:
         self.llm = llm
 
     async def process(self, state: AgentState) -> AgentState:
-        result = await self.data_retriever_crew(state["messages"][-1].content, llm=self.llm).run()
+        with span(WEB_SEARCH, "crew") as attrs:
+            result = await self.data_retriever_crew(state["messages"][-1].content, llm=self.llm).run()
+            attrs["bytes"] = len(result.raw.encode("utf-8"))
      
         return {
             "messages": [HumanMessage(content=result.raw, name="web_searcher")],
@@ -1,12 +1,21 @@
 from core.workflow import TrialWorkflow
+from core.llm_gateway import LLMGateway
+from core.llm_cache import LLMResponseCache
+from core.rate_limiter import RateLimiter, INTERACTIVE, BATCH
+from core.checkpoint import SqliteDeltaSaver
+from core.events import SCHEMA_VERSION, EVENT_TYPES
+from core.telemetry import METRICS
 from agents import LawyerAgent, ProsecutorAgent, JudgeAgent, RetrieverAgent, FetchingAgent, WebSearcherAgent
+from agents.judge import JUDGE_MODES
 import asyncio
+import contextlib
 from langchain_groq import ChatGroq
 import os
-from fastapi import FastAPI, Body
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Body, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from langchain_huggingface import HuggingFaceEndpoint
 import json
+from typing import Optional
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -22,28 +31,152 @@ llms =[
     # HuggingFaceEndpoint(repo_id ="Qwen/QwQ-32B-Preview", huggingfacehub_api_token=os.environ['HUGGINGFACE_API_KEY'])
 ]
 
+# Repeated calls (demo and regression runs of the same case file) answered from disk, LLM_CACHE=1 to enable
+llm_cache = LLMResponseCache(os.getenv("LLM_CACHE_PATH", ".llm_cache/responses.sqlite")) if os.getenv("LLM_CACHE") == "1" else None
+
+# Requests and tokens per minute of every model (Groq free tier), calls wait or go elsewhere before a 429
+rate_limiter = RateLimiter({
+    "llama-3.1-8b-instant": (30, 20_000),
+    "llama-3.1-70b-versatile": (30, 6_000),
+    "gemma2-9b-it": (30, 15_000),
+    "gemma-7b-it": (30, 15_000),
+    "mixtral-8x7b-32768": (30, 5_000),
+})
+
+# $ per million prompt and completion tokens, eg. LLM_PRICES='{"llama-3.1-70b-versatile": [0.59, 0.79]}'
+METRICS.set_prices({model: tuple(price) for model, price in json.loads(os.getenv("LLM_PRICES", "{}")).items()})
+
+# One gateway shared by all agents, so a failing model is detected once and skipped by everyone
+gateway = LLMGateway(llms, cache=llm_cache, rate_limiter=rate_limiter)
+
+# Trial checkpoints on disk, message deltas per step, completed trials compacted to their final state
+checkpointer = SqliteDeltaSaver(os.getenv("CHECKPOINT_PATH", ".checkpoints/trials.sqlite"))
+
 # Initialize Workflow
+retriever = RetrieverAgent(llms=gateway)
 workflow = TrialWorkflow(
-    lawyer=LawyerAgent(llms=llms),
-    prosecutor=ProsecutorAgent(llms=llms),
-    judge=JudgeAgent(llms=llms),
-    retriever=RetrieverAgent(llms=llms),
-    kanoon_fetcher=FetchingAgent(llms=llms),
+    lawyer=LawyerAgent(llms=gateway),
+    prosecutor=ProsecutorAgent(llms=gateway),
+    judge=JudgeAgent(llms=gateway, mode=os.getenv("JUDGE_MODE", "stepwise")),  # JUDGE_MODE=fused: one call per turn, two with research
+    retriever=retriever,
+    kanoon_fetcher=FetchingAgent(llms=gateway),
     web_searcher=WebSearcherAgent(llm=llm_0),
+    # retriever and web searcher asked in turn, PARALLEL_RESEARCH=1 to ask them in one step and run them concurrently
+    parallel_research=os.getenv("PARALLEL_RESEARCH", "0") == "1",
+    # trials run concurrently, each in its own session, the next ones wait for a slot
+    max_sessions=int(os.getenv("MAX_TRIALS", "4")),
+    checkpointer=checkpointer,
 )
 
 # Visualize workflow
 workflow.visualize()
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once the vector store finished its initial index build, 503 before"""
+    # the probe uses the blocking stats client, keep it off the event loop
+    progress = await asyncio.to_thread(retriever.get_index_progress)
+    status_code = 200 if progress["ready"] else 503
+    return JSONResponse(content=progress, status_code=status_code)
+
+@app.get("/llm_health")
+async def llm_health():
+    """Error rate, latency and circuit state of every model behind the gateway"""
+    return JSONResponse(content=gateway.stats())
+
+@app.get("/llm_cache")
+async def llm_cache_stats():
+    """Hit/miss counters and size of the LLM response cache"""
+    return JSONResponse(content=llm_cache.stats() if llm_cache else {"enabled": False})
+
+@app.get("/events/schema")
+async def events_schema():
+    """Version and event types of the trial streams, for clients other than the Streamlit app"""
+    return JSONResponse(content={"version": SCHEMA_VERSION, "types": EVENT_TYPES})
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: durations of nodes, LLM calls and searches, tokens, cost, trials"""
+    sessions = workflow.session_report()
+    store = checkpointer.stats()
+    text = METRICS.render({
+        "trials": ("gauge", "Trials running and waiting for a slot",
+                   {"running": sessions["running"], "queued": sessions["queued"]}),
+        "trial_sessions_total": ("counter", "Trial streams by outcome",
+                                 {state: sessions[state] for state in ("completed", "parked", "resumed", "cancelled", "failed")}),
+        "checkpoint_threads": ("gauge", "Trials in the checkpoint store, active ones include the parked",
+                               {"active": store["active_threads"], "completed": store["completed_threads"]}),
+    })
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+@app.get("/sessions")
+async def sessions():
+    """Trials running and waiting for a slot, completed, cancelled and failed counts, checkpoint store size"""
+    return JSONResponse(content={**workflow.session_report(), "checkpoints": checkpointer.stats()})
+
+@app.on_event("startup")
+async def prune_parked_trials():
+    """
+    Trials parked for feedback and never resumed are dropped after PARKED_TRIAL_TTL seconds (default
+    a week), checked every PARKED_TRIAL_PRUNE_INTERVAL seconds (default an hour)
+    """
+    ttl = float(os.getenv("PARKED_TRIAL_TTL", 7 * 24 * 3600))
+    interval = float(os.getenv("PARKED_TRIAL_PRUNE_INTERVAL", 3600))
+
+    async def prune():
+        while True:
+            pruned = await workflow.prune_idle(ttl)
+            print(f"Pruned {pruned} abandoned trials")
+            await asyncio.sleep(interval)
+
+    app.state.pruner = asyncio.create_task(prune())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.pruner.cancel()
+    await retriever.vector_store.aclose()
+
 @app.post("/stream_workflow")
-async def stream_workflow(user_prompt: str = Body(..., embed=True)):
+async def stream_workflow(request: Request, user_prompt: str = Body(..., embed=True), use_cache: bool = Body(True, embed=True),
+                          batch: bool = Body(False, embed=True), judge_mode: Optional[str] = Body(None, embed=True)):
+    if judge_mode is not None and judge_mode not in JUDGE_MODES:
+        return JSONResponse(content={"error": f"judge_mode must be one of {', '.join(JUDGE_MODES)}"}, status_code=422)
+
+    async def event_generator():
+        priority = BATCH if batch else INTERACTIVE
+        trial = workflow.run(user_prompt=user_prompt, use_cache=use_cache, priority=priority, judge_mode=judge_mode)
+        # leaving the loop closes the trial, its running agent call is cancelled and its slot freed
+        async with contextlib.aclosing(trial):
+            async for state in trial:
+                if await request.is_disconnected():
+                    break
+                # # Ensure state is serialized properly
+                # if isinstance(state["state"], str):
+                #     # Parse string-like dictionaries back into JSON
+                #     state["state"] = json.loads(state["state"].replace("'", '"'))  # Convert single quotes to double quotes if needed
+                yield f"data: {json.dumps(state)}\n\n"
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.post("/trials/{session_id}/feedback")
+async def trial_feedback(session_id: str, request: Request, feedback: str = Body(..., embed=True),
+                         use_cache: bool = Body(True, embed=True), batch: bool = Body(False, embed=True)):
+    """Resume a trial parked for user feedback, streams like /stream_workflow"""
+    priority = BATCH if batch else INTERACTIVE
+    try:
+        # reserves the trial before the response starts, a second request for it is refused here
+        trial = await workflow.resume(session_id, feedback, use_cache=use_cache, priority=priority)
+    except ValueError as e:
+        status_code = 409 if session_id in workflow.sessions else 404
+        return JSONResponse(content={"error": str(e)}, status_code=status_code)
+
     async def event_generator():
-        async for state in workflow.run(user_prompt=user_prompt):
-            # # Ensure state is serialized properly
-            # if isinstance(state["state"], str):
-            #     # Parse string-like dictionaries back into JSON
-            #     state["state"] = json.loads(state["state"].replace("'", '"'))  # Convert single quotes to double quotes if needed
-            yield f"data: {json.dumps(state)}\n\n"
+        async with contextlib.aclosing(trial):
+            async for state in trial:
+                if await request.is_disconnected():
+                    break
+                yield f"data: {json.dumps(state)}\n\n"
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
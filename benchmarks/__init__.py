@@ -0,0 +1 @@
+"""Benchmarks and load tests for the Legal RAG system, run with `python -m benchmarks.<name>`"""
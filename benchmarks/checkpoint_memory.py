@@ -0,0 +1,82 @@
+"""
+Process memory and checkpoint storage over hundreds of trials, MemorySaver against SqliteDeltaSaver.
+
+Trials run one after the other through the real TrialWorkflow, with the stub model and agents of
+benchmarks.trial_stress. The MemorySaver baseline keeps every checkpoint of every trial in the
+process, like the workflow did before; SqliteDeltaSaver writes message deltas to disk and compacts
+each completed trial to its final state. Python heap in use (tracemalloc) is sampled every
+`--every` trials. Run from the project root:
+
+    python -m benchmarks.checkpoint_memory
+    python -m benchmarks.checkpoint_memory --trials 500 --every 100
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from langgraph.checkpoint.memory import MemorySaver
+
+# core before agents, like app.py: core imports the agents package through the workflow
+from core.checkpoint import SqliteDeltaSaver
+from core.llm_gateway import LLMGateway
+from benchmarks.trial_stress import EchoStubModel, build_workflow, play
+
+
+class KeepAllMemorySaver(MemorySaver):
+    """MemorySaver as the workflow used it before: checkpoints of finished trials were never dropped"""
+
+    def delete_thread(self, thread_id: str) -> None:
+        pass
+
+
+async def run(args, name: str, checkpointer) -> list:
+    workflow = build_workflow(LLMGateway([EchoStubModel(args.latency)]), args.latency, 1, checkpointer)
+    samples = []
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.monotonic()
+    for index in range(1, args.trials + 1):
+        async for _ in play(workflow, index):
+            pass
+        if index % args.every == 0:
+            gc.collect()
+            heap_mb = (tracemalloc.get_traced_memory()[0] - baseline) / 2 ** 20
+            disk_mb = os.path.getsize(checkpointer.path) / 2 ** 20 if isinstance(checkpointer, SqliteDeltaSaver) else 0.0
+            samples.append((name, index, heap_mb, disk_mb, time.monotonic() - started))
+    tracemalloc.stop()
+    return samples
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=300, help="trials played one after the other")
+    parser.add_argument("--every", type=int, default=50, help="trials between two memory samples")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds a model or tool call takes")
+    parser.add_argument("--keep-completed", type=int, default=100, help="completed trials kept by SqliteDeltaSaver")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        delta = SqliteDeltaSaver(os.path.join(directory, "trials.sqlite"), keep_completed=args.keep_completed)
+        # the workflow prints every state update, keep the table readable
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            samples = await run(args, "memory", KeepAllMemorySaver())
+            samples += await run(args, "sqlite", delta)
+        print(f"{args.trials} trials, SqliteDeltaSaver keeping the last {args.keep_completed} completed\n")
+        print(f"{'saver':<7} {'trials':>6} {'heap MB':>8} {'disk MB':>8} {'wall s':>7}")
+        for name, trials, heap_mb, disk_mb, wall in samples:
+            print(f"{name:<7} {trials:>6} {heap_mb:>8.2f} {disk_mb:>8.2f} {wall:>7.1f}")
+        print(f"\nsqlite saver: {delta.stats()}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
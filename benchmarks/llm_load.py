@@ -0,0 +1,100 @@
+"""
+Throughput of concurrent trial sessions on one event loop, against a stubbed chat model.
+
+Every session plays `--turns` agent turns (lawyer, prosecutor, judge in turn), one LLM call each,
+through the agents' real process() and the shared LLMGateway. The stub answers after `--latency`
+seconds, like a hosted model would. Run from the project root:
+
+    python -m benchmarks.llm_load                      # 1, 10 and 50 concurrent sessions
+    python -m benchmarks.llm_load --blocking           # same, with a blocking model call (the old behaviour)
+    python -m benchmarks.llm_load --max-concurrency 64 # the model's share of a larger quota
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+# core before agents, like app.py: core imports the agents package through the workflow
+from core.llm_gateway import LLMGateway
+from agents.judge import JudgeAgent
+from agents.lawyer import LawyerAgent
+from agents.prosecutor import ProsecutorAgent
+
+
+class StubChatModel:
+    """Chat model answering after a fixed latency with a little jitter, optionally blocking the caller"""
+
+    def __init__(self, latency: float, blocking: bool = False, model_name: str = "stub"):
+        self.latency = latency
+        self.blocking = blocking
+        self.model_name = model_name
+
+    def _delay(self) -> float:
+        return self.latency * random.uniform(0.8, 1.2)
+
+    def invoke(self, messages, **kwargs):
+        time.sleep(self._delay())
+        return AIMessage(content="lawyer")
+
+    async def ainvoke(self, messages, **kwargs):
+        if self.blocking:
+            return self.invoke(messages, **kwargs)
+        await asyncio.sleep(self._delay())
+        return AIMessage(content="lawyer")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def session(agents, turns, latencies):
+    state = {"messages": [HumanMessage(content="The accused is charged under Section 499.")], "thought_step": 0,
+             "caller": "judge", "next": "lawyer"}
+    for turn in range(turns):
+        agent = agents[turn % len(agents)]
+        started = time.perf_counter()
+        await agent.process({**state, "thought_step": 0})
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(num_sessions, turns, gateway):
+    agents = [LawyerAgent(llms=gateway), ProsecutorAgent(llms=gateway), JudgeAgent(llms=gateway)]
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(session(agents, turns, latencies) for _ in range(num_sessions)))
+    elapsed = time.perf_counter() - started
+    return {
+        "wall_s": elapsed,
+        "calls_per_s": len(latencies) / elapsed,
+        "sessions_per_min": num_sessions / elapsed * 60,
+        "p50_s": statistics.median(latencies),
+        "p95_s": percentile(latencies, 0.95),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 10, 50])
+    parser.add_argument("--turns", type=int, default=6, help="agent turns (LLM calls) per session")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the stub takes to answer")
+    # the gateway default, which app.py runs with
+    parser.add_argument("--max-concurrency", type=int, default=8, help="in-flight calls allowed per model")
+    parser.add_argument("--blocking", action="store_true", help="stub blocks the event loop while answering")
+    args = parser.parse_args()
+
+    gateway = LLMGateway([StubChatModel(args.latency, args.blocking)], max_concurrency=args.max_concurrency)
+    print(f"{args.turns} turns per session, {args.latency}s per call, "
+          f"{'blocking' if args.blocking else 'async'} model, {args.max_concurrency} calls in flight max\n")
+    print(f"{'sessions':>8} {'wall s':>8} {'calls/s':>8} {'sess/min':>9} {'p50 s':>7} {'p95 s':>7}")
+    for num_sessions in args.sessions:
+        result = await run(num_sessions, args.turns, gateway)
+        print(f"{num_sessions:>8} {result['wall_s']:>8.2f} {result['calls_per_s']:>8.1f} "
+              f"{result['sessions_per_min']:>9.1f} {result['p50_s']:>7.2f} {result['p95_s']:>7.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Simulated provider quotas: 429s and latency of interactive and batch trials, with and without the rate limiter.
+
+Stub models enforce requests and tokens per period like Groq does per minute, answering 429 with
+a retry delay when a call goes over. Interactive and batch sessions make their calls through the
+shared LLMGateway, once without and once with a RateLimiter knowing the quotas. The period is
+shortened so a run takes seconds. Run from the project root:
+
+    python -m benchmarks.rate_limit_sim
+    python -m benchmarks.rate_limit_sim --interactive 4 --batch 12 --period 5
+"""
+import argparse
+import asyncio
+import collections
+import random
+import statistics
+import time
+
+from langchain_core.messages import AIMessage
+
+# core before agents, like app.py: core imports the agents package through the workflow
+from core.llm_gateway import LLMGateway
+from core.rate_limiter import BATCH, INTERACTIVE, RateLimiter, request_priority
+
+
+class QuotaStubModel:
+    """Chat model with a sliding window quota of requests and tokens, answering 429 over it"""
+
+    def __init__(self, model_name: str, rpm: int, tpm: int, period: float, latency: float):
+        self.model_name = model_name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.period = period
+        self.latency = latency
+        self.window = collections.deque()  # (time, tokens) of the calls accepted in the last period
+        self.rejected = 0
+
+    async def ainvoke(self, messages, **kwargs):
+        now = time.monotonic()
+        while self.window and self.window[0][0] <= now - self.period:
+            self.window.popleft()
+        prompt = sum(len(str(message.get("content", ""))) for message in messages) // 4
+        tokens = prompt + 300
+        if len(self.window) >= self.rpm or sum(t for _, t in self.window) + tokens > self.tpm:
+            self.rejected += 1
+            retry = self.window[0][0] + self.period - now if self.window else 1.0
+            raise Exception(f"Error code: 429 - Rate limit reached for model `{self.model_name}`. "
+                            f"Please try again in {retry:.2f}s.")
+        self.window.append((now, tokens))
+        await asyncio.sleep(self.latency * random.uniform(0.8, 1.2))
+        return AIMessage(content="ok", usage_metadata={"input_tokens": prompt, "output_tokens": 300,
+                                                        "total_tokens": tokens})
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))] if values else 0.0
+
+
+async def session(gateway, priority, calls, prompt_chars, results):
+    messages = [{"role": "user", "content": "x" * prompt_chars}]
+    with request_priority(priority):
+        for _ in range(calls):
+            started = time.monotonic()
+            try:
+                await gateway.ainvoke(messages)
+                results[priority].append(time.monotonic() - started)
+            except RuntimeError:
+                results["failed"].append(priority)
+
+
+async def run(args, limited: bool):
+    quotas = {"fast-model": (args.rpm, args.tpm), "backup-model": (args.rpm // 2, args.tpm // 2)}
+    models = [QuotaStubModel(name, rpm, tpm, args.period, args.latency) for name, (rpm, tpm) in quotas.items()]
+    limiter = RateLimiter(quotas, period=args.period, completion_tokens=300) if limited else None
+    gateway = LLMGateway(models, cooldown=args.period / 2, max_cooldown=args.period, rate_limiter=limiter)
+    results = {INTERACTIVE: [], BATCH: [], "failed": []}
+    started = time.monotonic()
+    await asyncio.gather(
+        *(session(gateway, INTERACTIVE, args.calls, args.prompt_chars, results) for _ in range(args.interactive)),
+        *(session(gateway, BATCH, args.calls, args.prompt_chars, results) for _ in range(args.batch)),
+    )
+    rerouted = sum(quota["rerouted"] for quota in limiter.stats().values()) if limiter else 0
+    return {
+        "wall_s": time.monotonic() - started,
+        "http_429": sum(model.rejected for model in models),
+        "failed": len(results["failed"]),
+        "rerouted": rerouted,
+        "interactive_p50": statistics.median(results[INTERACTIVE]) if results[INTERACTIVE] else 0.0,
+        "interactive_p95": percentile(results[INTERACTIVE], 0.95),
+        "batch_p50": statistics.median(results[BATCH]) if results[BATCH] else 0.0,
+        "batch_p95": percentile(results[BATCH], 0.95),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--interactive", type=int, default=3, help="interactive sessions")
+    parser.add_argument("--batch", type=int, default=10, help="batch sessions")
+    parser.add_argument("--calls", type=int, default=6, help="LLM calls per session")
+    parser.add_argument("--rpm", type=int, default=20, help="requests per period of the preferred model")
+    parser.add_argument("--tpm", type=int, default=30_000, help="tokens per period of the preferred model")
+    parser.add_argument("--period", type=float, default=4.0, help="seconds standing in for a minute")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds a model takes to answer")
+    parser.add_argument("--prompt-chars", type=int, default=6000, help="characters per prompt")
+    args = parser.parse_args()
+
+    print(f"{args.interactive} interactive and {args.batch} batch sessions, {args.calls} calls each, "
+          f"quota {args.rpm} requests and {args.tpm} tokens per {args.period}s (backup model half that)\n")
+    print(f"{'limiter':<8} {'wall s':>7} {'429s':>5} {'failed':>6} {'reroute':>7} "
+          f"{'int p50':>8} {'int p95':>8} {'bat p50':>8} {'bat p95':>8}")
+    for limited in (False, True):
+        r = await run(args, limited)
+        print(f"{'on' if limited else 'off':<8} {r['wall_s']:>7.2f} {r['http_429']:>5} {r['failed']:>6} "
+              f"{r['rerouted']:>7} {r['interactive_p50']:>8.2f} {r['interactive_p95']:>8.2f} "
+              f"{r['batch_p50']:>8.2f} {r['batch_p95']:>8.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Per-query latency and recall of vector, lexical (BM25) and hybrid retrieval over the IPC.
+
+Every parsed IPC section is a test case: the query is the section title and the relevant chunk
+is the one carrying that section's metadata. Run from the project root:
+
+    python -m benchmarks.retrieval                    # all modes, starts the vector store
+    python -m benchmarks.retrieval --modes lexical    # BM25 only, no vector store needed
+"""
+import argparse
+import statistics
+import time
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from core.ipc_parser import IPCSectionIndex, SectionAwareSplitter
+from core.lexical_index import LexicalIndex, HybridRetriever
+
+IPC_PATH = "./public_documents/IndianPenalCode.txt"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(retriever, cases, k):
+    latencies, hits = [], 0
+    for query, section in cases:
+        started = time.perf_counter()
+        documents = retriever.invoke(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += any(doc.metadata.get("ipc_section") == section for doc in documents[:k])
+    return {
+        "recall": hits / len(cases),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 0.95),
+        "mean_ms": statistics.mean(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["vector", "lexical", "hybrid"])
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N sections")
+    args = parser.parse_args()
+
+    sections = list(IPCSectionIndex.from_file(IPC_PATH).sections.values())
+    # one-word titles ("Gender", "Oath") are definitions, keep the ones that read like a query
+    cases = [(section.title, section.section) for section in sections if len(section.title.split()) >= 3]
+    if args.limit:
+        cases = cases[:args.limit]
+
+    lexical_index = LexicalIndex(
+        IPC_PATH, SectionAwareSplitter(RecursiveCharacterTextSplitter(chunk_size=5000, chunk_overlap=10))
+    )
+    vector_search = None
+    if {"vector", "hybrid"} & set(args.modes):
+        from core.pathway_store import PathwayVectorStore
+        store = PathwayVectorStore({"ipc": IPC_PATH}, 8770)
+        vector_search = lambda query, k, filters=None: store.similarity_search("ipc", query, k, filters)  # noqa: E731
+
+    print(f"{len(cases)} queries, {len(lexical_index)} chunks, recall@{args.k}\n")
+    print(f"{'mode':<8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8}")
+    for mode in args.modes:
+        retriever = HybridRetriever(vector_search, lexical_index, k=args.k, mode=mode)
+        result = run(retriever, cases, args.k)
+        print(f"{mode:<8} {result['recall']:>7.3f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['mean_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Concurrent trials through the real TrialWorkflow: session isolation, throughput and cancellation.
+
+Every trial's case file carries its own marker (TRIAL-<n>). The stub chat model answers with the
+markers it finds in the prompt, so a prompt mixing two trials' transcripts is counted as cross-talk
+and a trial receiving another trial's events is counted as a leak. The lawyer, prosecutor and judge
+are the real agents behind the shared LLMGateway; the document retriever, Kanoon fetcher and web
+searcher are stubs answering after the model latency. Each trial is parked once for user
+feedback and resumed with it, in a new stream, like the API client does.
+Run from the project root:
+
+    python -m benchmarks.trial_stress
+    python -m benchmarks.trial_stress --trials 40 --max-sessions 1 4 16 --cancel 5
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+# core before agents, like app.py: core imports the agents package through the workflow
+from core.checkpoint import SqliteDeltaSaver
+from core.llm_gateway import LLMGateway
+from core.workflow import TrialWorkflow
+from agents.judge import JudgeAgent
+from agents.lawyer import LawyerAgent
+from agents.prosecutor import ProsecutorAgent
+
+MARKER_RE = re.compile(r"TRIAL-\d+")
+FEEDBACK = "argument is not strong"
+
+
+def _text(messages) -> str:
+    return "\n".join(str(m.get("content", "")) if isinstance(m, dict) else str(m.content) for m in messages)
+
+
+class EchoStubModel:
+    """Chat model echoing the trial markers of its prompt, with the structured answers the agents parse"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.model_name = "stub"
+        self.calls = 0
+        self.cross_talk = 0  # prompts carrying the markers of more than one trial
+
+    async def ainvoke(self, messages, **kwargs):
+        prompt = _text(messages)
+        markers = sorted(set(MARKER_RE.findall(prompt)))
+        self.calls += 1
+        self.cross_talk += len(markers) > 1
+        await asyncio.sleep(self.latency * random.uniform(0.8, 1.2))
+        marker = " ".join(markers)
+        if "next_agent" in prompt:
+            # judge turn, the verdict comes once the lawyer answered the user's feedback
+            done = FEEDBACK in prompt
+            content = json.dumps({
+                "review": f"{marker} review", "legal_request": "none", "web_request": "none",
+                "ready_for_verdict": done, "response": f"{marker} {'verdict' if done else 'proceed'}",
+                "next_agent": "END" if done else "lawyer",
+            })
+        elif "legal_request" in prompt:
+            content = json.dumps({"legal_request": f"{marker} Section 499 IPC", "web_request": "none"})
+        else:
+            content = f"{marker} argument, web search: none"
+        return AIMessage(content=content)
+
+
+class StubAgent:
+    """Retriever, fetcher or web searcher answering the latest message after the model latency"""
+
+    def __init__(self, name: str, latency: float, routes: bool = True):
+        self.name = name
+        self.latency = latency
+        self.routes = routes
+
+    async def process(self, state):
+        await asyncio.sleep(self.latency)
+        if not self.routes:
+            return {}
+        markers = " ".join(sorted(set(MARKER_RE.findall(_text(state["messages"])))))
+        return {
+            "messages": [HumanMessage(content=f"{markers} documents", name=self.name)],
+            "next": state["caller"],
+            "thought_step": state["thought_step"],
+        }
+
+
+def build_workflow(gateway, latency: float, max_sessions: int, checkpointer) -> TrialWorkflow:
+    return TrialWorkflow(
+        lawyer=LawyerAgent(llms=gateway),
+        prosecutor=ProsecutorAgent(llms=gateway),
+        judge=JudgeAgent(llms=gateway, mode="fused"),
+        retriever=StubAgent("retriever", latency),
+        kanoon_fetcher=StubAgent("kanoon_fetcher", latency, routes=False),
+        web_searcher=StubAgent("web_searcher", latency),
+        parallel_research=True,
+        max_sessions=max_sessions,
+        checkpointer=checkpointer,
+    )
+
+
+async def play(workflow, index: int):
+    """Events of a trial, resumed with the feedback every time it is parked"""
+    stream = workflow.run(f"Case file TRIAL-{index}: State vs. Accused {index}, defamation under Section 499 IPC")
+    while stream is not None:
+        parked = None
+        async with contextlib.aclosing(stream):
+            async for event in stream:
+                if event["type"] == "awaiting_feedback":
+                    parked = event["session_id"]
+                yield event
+        stream = await workflow.resume(parked, FEEDBACK) if parked else None
+
+
+async def trial(workflow, index: int, cancel_after: int, results: dict):
+    marker = f"TRIAL-{index}"
+    started = time.monotonic()
+    events = 0
+    async with contextlib.aclosing(play(workflow, index)) as trial_events:
+        async for event in trial_events:
+            events += 1
+            foreign = set(MARKER_RE.findall(json.dumps(event, default=str))) - {marker}
+            results["leaks"] += bool(foreign)
+            if event["type"] == "done":
+                results["latency"].append(time.monotonic() - started)
+            if cancel_after and events >= cancel_after:
+                break  # the client went away
+
+
+async def run(args, max_sessions: int) -> dict:
+    model = EchoStubModel(args.latency)
+    directory = tempfile.mkdtemp()
+    checkpointer = SqliteDeltaSaver(os.path.join(directory, "trials.sqlite"))
+    workflow = build_workflow(LLMGateway([model]), args.latency, max_sessions, checkpointer)
+    results = {"leaks": 0, "latency": []}
+    cancelled = set(random.sample(range(args.trials), min(args.cancel, args.trials)))
+    started = time.monotonic()
+    await asyncio.gather(*(
+        trial(workflow, index, args.cancel_after if index in cancelled else 0, results)
+        for index in range(args.trials)
+    ))
+    wall = time.monotonic() - started
+    report = workflow.session_report()
+    # trials still holding checkpoints that are not the compacted final state
+    active_threads = checkpointer.stats()["active_threads"]
+    shutil.rmtree(directory)
+    return {
+        "wall_s": wall,
+        "trials_per_s": len(results["latency"]) / wall,
+        "p50": statistics.median(results["latency"]) if results["latency"] else 0.0,
+        "max": max(results["latency"], default=0.0),
+        "completed": report["completed"],
+        "cancelled": report["cancelled"],
+        "left_open": report["running"] + report["queued"] + active_threads,
+        "calls": model.calls,
+        "cross_talk": model.cross_talk,
+        "leaks": results["leaks"],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=24, help="trials started at once")
+    parser.add_argument("--max-sessions", type=int, nargs="+", default=[1, 4, 24], help="trial slots to compare")
+    parser.add_argument("--cancel", type=int, default=4, help="trials whose client disconnects mid-way")
+    parser.add_argument("--cancel-after", type=int, default=5, help="events a disconnecting client reads")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds a model or tool call takes")
+    args = parser.parse_args()
+
+    print(f"{args.trials} trials, {args.cancel} disconnecting after {args.cancel_after} events, "
+          f"{args.latency}s per call\n")
+    print(f"{'slots':>5} {'wall s':>7} {'trials/s':>8} {'p50 s':>6} {'max s':>6} {'done':>5} {'cancel':>6} "
+          f"{'open':>5} {'calls':>6} {'x-talk':>6} {'leaks':>5}")
+    for max_sessions in args.max_sessions:
+        r = await run(args, max_sessions)
+        print(f"{max_sessions:>5} {r['wall_s']:>7.2f} {r['trials_per_s']:>8.2f} {r['p50']:>6.2f} {r['max']:>6.2f} "
+              f"{r['completed']:>5} {r['cancelled']:>6} {r['left_open']:>5} {r['calls']:>6} "
+              f"{r['cross_talk']:>6} {r['leaks']:>5}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
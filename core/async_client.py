@@ -0,0 +1,87 @@
+import asyncio
+from typing import List, Optional
+
+import aiohttp
+from langchain_core.documents import Document
+
+
+class AsyncVectorStoreClient:
+    """
+    Async client for the Pathway VectorStoreServer REST API.
+
+    Keeps one aiohttp session with a keep-alive connection pool, so concurrent retrievals
+    from many trials reuse connections instead of blocking the event loop on a new
+    blocking HTTP request each.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, pool_size: int = 32,
+                 keepalive_timeout: float = 60.0, timeout: float = 30.0):
+        """
+        Parameters:
+        host, port: address of the VectorStoreServer - eg. 127.0.0.1, 8765
+        pool_size: max simultaneous connections to the server - eg. 32
+        keepalive_timeout: seconds an idle connection is kept open - eg. 60
+        timeout: default per-request timeout in seconds - eg. 30
+        """
+        self.url = f"http://{host}:{port}"
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily, a session is bound to the event loop it was created in
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _post(self, endpoint: str, payload: dict, timeout: Optional[float] = None):
+        session = self._get_session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with session.post(f"{self.url}{endpoint}", json=payload, timeout=client_timeout) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def similarity_search(self, query: str, k: int = 4, metadata_filter: Optional[str] = None,
+                                filepath_globpattern: Optional[str] = None,
+                                timeout: Optional[float] = None) -> List[Document]:
+        """
+        Top-k chunks for a query.
+
+        Raises:
+        asyncio.TimeoutError if the server does not answer within `timeout` seconds
+        """
+        payload = {"query": query, "k": k}
+        if metadata_filter is not None:
+            payload["metadata_filter"] = metadata_filter
+        if filepath_globpattern is not None:
+            payload["filepath_globpattern"] = filepath_globpattern
+        results = await self._post("/v1/retrieve", payload, timeout)
+        return [
+            Document(page_content=result["text"], metadata=result["metadata"])
+            for result in sorted(results, key=lambda result: result["dist"])
+        ]
+
+    async def get_vectorstore_statistics(self, timeout: Optional[float] = None) -> dict:
+        return await self._post("/v1/statistics", {}, timeout)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+async def gather_with_timeout(*aws, timeout: Optional[float] = None, default=None):
+    """
+    Run awaitables concurrently, each one bounded by `timeout`.
+    An awaitable that times out or fails yields `default` instead of failing the others.
+    """
+    async def bounded(aw):
+        try:
+            return await asyncio.wait_for(aw, timeout)
+        except Exception as e:
+            print(f"Retrieval failed with error: {e!r}")
+            return default
+
+    return await asyncio.gather(*(bounded(aw) for aw in aws))
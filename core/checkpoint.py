@@ -0,0 +1,447 @@
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+
+class SqliteDeltaSaver(BaseCheckpointSaver[str]):
+    """
+    LangGraph checkpointer on a local sqlite file, storing list channels as deltas.
+
+    Like MemorySaver, a checkpoint only stores the channels whose version changed. A list channel
+    (the trial's messages) is stored as the items appended since its previous version, with a
+    reference to it, and as a full snapshot every `snapshot_every` versions so a read follows a
+    bounded chain. A trial's storage grows with its transcript instead of with its square.
+
+    Completed trials are compacted to their last checkpoint with full values, only the
+    `keep_completed` most recent ones are kept. Only the last list value of the threads being
+    written stays in memory, to compute the next delta, parked trials are released from it.
+    """
+
+    def __init__(self, path: str = ".checkpoints/trials.sqlite", snapshot_every: int = 20,
+                 keep_completed: int = 500, serde=None):
+        """
+        Parameters:
+        path: sqlite file to store the checkpoints in - eg. .checkpoints/trials.sqlite
+        snapshot_every: list channel versions stored as deltas between two full snapshots - eg. 20
+        keep_completed: completed trials kept on disk, the oldest are pruned - eg. 500
+        """
+        super().__init__(serde=serde)
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.keep_completed = keep_completed
+        self.delta_bytes = 0
+        self.snapshot_bytes = 0
+        self.compacted = 0
+        self.pruned = 0
+        # (thread_id, checkpoint_ns, channel) -> (version, list value, deltas since the last snapshot)
+        self._last: Dict[Tuple[str, str, str], Tuple[str, list, int]] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # the graph runs sync checkpointer calls in worker threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # a checkpoint lost to a power cut only costs the trial's last step, no fsync per checkpoint
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " thread_id TEXT PRIMARY KEY,"
+            " updated REAL NOT NULL,"
+            " completed REAL);"
+            "CREATE INDEX IF NOT EXISTS idx_threads_completed ON threads(completed);"
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " checkpoint_id TEXT NOT NULL,"
+            " parent_id TEXT,"
+            " type TEXT NOT NULL,"
+            " checkpoint BLOB NOT NULL,"
+            " metadata_type TEXT NOT NULL,"
+            " metadata BLOB NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id));"
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " version TEXT NOT NULL,"
+            " base_version TEXT,"  # set for a delta: the value is the items appended to the base version's
+            " type TEXT NOT NULL,"
+            " value BLOB,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, channel, version));"
+            "CREATE TABLE IF NOT EXISTS writes ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL,"
+            " checkpoint_id TEXT NOT NULL,"
+            " task_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " type TEXT NOT NULL,"
+            " value BLOB,"
+            " task_path TEXT NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx));"
+        )
+        self._conn.commit()
+
+    # values
+
+    def _dump_blob(self, key: Tuple[str, str, str], version: str, value: Any) -> Tuple[Optional[str], str, bytes]:
+        """base version (None for a full value), type and bytes to store a channel value with"""
+        last = self._last.get(key)
+        if not isinstance(value, list):
+            self._last.pop(key, None)
+            type_, data = self.serde.dumps_typed(value)
+            self.snapshot_bytes += len(data)
+            return None, type_, data
+        if last is not None and last[2] < self.snapshot_every and _extends(value, last[1]):
+            base, previous, deltas = last
+            type_, data = self.serde.dumps_typed(value[len(previous):])
+            self._last[key] = (version, list(value), deltas + 1)
+            self.delta_bytes += len(data)
+            return base, type_, data
+        type_, data = self.serde.dumps_typed(value)
+        self._last[key] = (version, list(value), 0)
+        self.snapshot_bytes += len(data)
+        return None, type_, data
+
+    def _load_blob(self, thread_id: str, checkpoint_ns: str, channel: str, version: str) -> Tuple[bool, Any]:
+        """(found, value) of a channel version, deltas applied to their base"""
+        parts = []
+        while version is not None:
+            row = self._conn.execute(
+                "SELECT base_version, type, value FROM blobs"
+                " WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, version),
+            ).fetchone()
+            if row is None or row[1] == "empty":
+                return False, None
+            version = row[0]
+            parts.append(self.serde.loads_typed((row[1], row[2])))
+        value = parts.pop()
+        for delta in reversed(parts):
+            value = value + delta
+        return True, value
+
+    def _load_blobs(self, thread_id: str, checkpoint_ns: str, versions: ChannelVersions) -> Dict[str, Any]:
+        values = {}
+        for channel, version in versions.items():
+            found, value = self._load_blob(thread_id, checkpoint_ns, channel, version)
+            if found:
+                values[channel] = value
+        return values
+
+    # BaseCheckpointSaver
+
+    def _tuple(self, thread_id: str, checkpoint_ns: str, row) -> CheckpointTuple:
+        checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata = row
+        checkpoint_: Checkpoint = self.serde.loads_typed((type_, checkpoint))
+        writes = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM writes"
+            " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}},
+            checkpoint={
+                **checkpoint_,
+                "channel_values": self._load_blobs(thread_id, checkpoint_ns, checkpoint_["channel_versions"]),
+            },
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                  "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = ("SELECT checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata FROM checkpoints"
+                 " WHERE thread_id = ? AND checkpoint_ns = ?")
+        params: tuple = (thread_id, checkpoint_ns)
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            params += (checkpoint_id,)
+        else:
+            query += " ORDER BY checkpoint_id DESC LIMIT 1"
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+            return self._tuple(thread_id, checkpoint_ns, row) if row else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata"
+                 " FROM checkpoints WHERE 1 = 1")
+        params: tuple = ()
+        if config:
+            query += " AND thread_id = ?"
+            params += (config["configurable"]["thread_id"],)
+            if config["configurable"].get("checkpoint_ns") is not None:
+                query += " AND checkpoint_ns = ?"
+                params += (config["configurable"]["checkpoint_ns"],)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params += (checkpoint_id,)
+        if before and (before_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            params += (before_id,)
+        query += " ORDER BY checkpoint_id DESC"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        for row in rows:
+            if limit is not None and limit <= 0:
+                break
+            with self._lock:
+                checkpoint_tuple = self._tuple(row[0], row[1], row[2:])
+            if filter and not all(checkpoint_tuple.metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield checkpoint_tuple
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint_ = checkpoint.copy()
+        values: Dict[str, Any] = checkpoint_.pop("channel_values")  # type: ignore[misc]
+        with self._lock:
+            for channel, version in new_versions.items():
+                if channel in values:
+                    base, type_, data = self._dump_blob((thread_id, checkpoint_ns, channel), version, values[channel])
+                else:
+                    base, type_, data = None, "empty", None
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, base_version, type, value)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, channel, version, base, type_, data),
+                )
+            type_, data = self.serde.dumps_typed(checkpoint_)
+            metadata_type, metadata_data = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints"
+                " (thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, data, metadata_type, metadata_data),
+            )
+            self._conn.execute(
+                "INSERT INTO threads (thread_id, updated) VALUES (?, ?)"
+                " ON CONFLICT(thread_id) DO UPDATE SET updated = excluded.updated",
+                (thread_id, time.time()),
+            )
+            self._conn.commit()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                 "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for index, (channel, value) in enumerate(writes):
+            type_, data = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, index),
+                         channel, type_, data, task_path))
+        # special writes (errors, interrupts) replace the previous ones, regular writes are kept
+        verb = "REPLACE" if all(row[4] < 0 for row in rows) else "IGNORE"
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR {verb} INTO writes"
+                " (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._delete(thread_id)
+            self._conn.commit()
+
+    def _delete(self, thread_id: str):
+        for table in ("checkpoints", "blobs", "writes", "threads"):
+            self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+        for key in [key for key in self._last if key[0] == thread_id]:
+            del self._last[key]
+
+    # the sqlite work and its commits run on worker threads, the lock serializes them, so a
+    # checkpoint write does not stall the other trials' streams on the event loop
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # same versions as MemorySaver: increasing counter, random suffix
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # retention
+
+    def compact(self, thread_id: str):
+        """
+        The trial is over: keep its last checkpoint only, with full channel values, and prune the
+        oldest completed trials over `keep_completed`.
+        """
+        with self._lock:
+            latest = self._conn.execute(
+                "SELECT checkpoint_ns, checkpoint_id, type, checkpoint FROM checkpoints WHERE thread_id = ?"
+                " AND checkpoint_id = (SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ?"
+                " AND checkpoint_ns = '')",
+                (thread_id, thread_id),
+            ).fetchone()
+            if latest is None:
+                return
+            checkpoint_ns, checkpoint_id, type_, data = latest
+            versions = self.serde.loads_typed((type_, data))["channel_versions"]
+            values = self._load_blobs(thread_id, checkpoint_ns, versions)
+            # subgraph checkpoints (other namespaces) and the earlier steps are not read again
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id != ?",
+                               (thread_id, checkpoint_id))
+            self._conn.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_id != ?",
+                               (thread_id, checkpoint_id))
+            self._conn.execute("DELETE FROM blobs WHERE thread_id = ?", (thread_id,))
+            for channel, version in versions.items():
+                if channel in values:
+                    type_, data = self.serde.dumps_typed(values[channel])
+                else:
+                    type_, data = "empty", None
+                self._conn.execute(
+                    "INSERT INTO blobs (thread_id, checkpoint_ns, channel, version, base_version, type, value)"
+                    " VALUES (?, ?, ?, ?, NULL, ?, ?)",
+                    (thread_id, checkpoint_ns, channel, version, type_, data),
+                )
+            for key in [key for key in self._last if key[0] == thread_id]:
+                del self._last[key]
+            self._conn.execute("UPDATE threads SET completed = ? WHERE thread_id = ?", (time.time(), thread_id))
+            self.compacted += 1
+            overflow = self._conn.execute(
+                "SELECT thread_id FROM threads WHERE completed IS NOT NULL ORDER BY completed DESC LIMIT -1 OFFSET ?",
+                (self.keep_completed,),
+            ).fetchall()
+            for (old_thread,) in overflow:
+                self._delete(old_thread)
+            self.pruned += len(overflow)
+            self._conn.commit()
+
+    def release(self, thread_id: str):
+        """The trial is parked, free the values kept to compute its next deltas, it restarts from a snapshot"""
+        with self._lock:
+            for key in [key for key in self._last if key[0] == thread_id]:
+                del self._last[key]
+
+    def rewind(self, thread_id: str, checkpoint_id: str):
+        """
+        Drop the checkpoints written after `checkpoint_id`, and the channel versions only they used:
+        a resumed trial that did not get to its next feedback request is parked again where it was.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT type, checkpoint FROM checkpoints"
+                " WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id = ?",
+                (thread_id, checkpoint_id),
+            ).fetchone()
+            if row is None:
+                return
+            versions = self.serde.loads_typed(row)["channel_versions"]
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id > ?",
+                               (thread_id, checkpoint_id))
+            self._conn.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_id > ?",
+                               (thread_id, checkpoint_id))
+            # versions are zero padded counters, they compare as strings
+            for channel, version in self._conn.execute(
+                "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ''", (thread_id,)
+            ).fetchall():
+                if channel not in versions or version > versions[channel]:
+                    self._conn.execute(
+                        "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = '' AND channel = ? AND version = ?",
+                        (thread_id, channel, version),
+                    )
+            for key in [key for key in self._last if key[0] == thread_id]:
+                del self._last[key]
+            self._conn.execute("UPDATE threads SET updated = ? WHERE thread_id = ?", (time.time(), thread_id))
+            self._conn.commit()
+
+    def prune_idle(self, max_idle: float) -> int:
+        """Delete the trials not completed and not written for `max_idle` seconds, abandoned while parked"""
+        with self._lock:
+            idle = self._conn.execute(
+                "SELECT thread_id FROM threads WHERE completed IS NULL AND updated < ?", (time.time() - max_idle,)
+            ).fetchall()
+            for (thread_id,) in idle:
+                self._delete(thread_id)
+            self.pruned += len(idle)
+            self._conn.commit()
+        return len(idle)
+
+    def stats(self) -> dict:
+        """Threads, checkpoints and bytes on disk, bytes written as deltas and as full values"""
+        with self._lock:
+            threads, completed = self._conn.execute(
+                "SELECT COUNT(*), COUNT(completed) FROM threads").fetchone()
+            checkpoints = self._conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0]
+            blobs, blob_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM blobs").fetchone()
+            return {
+                "threads": threads,
+                "active_threads": threads - completed,
+                "completed_threads": completed,
+                "checkpoints": checkpoints,
+                "blobs": blobs,
+                "blob_bytes": blob_bytes,
+                "delta_bytes_written": self.delta_bytes,
+                "snapshot_bytes_written": self.snapshot_bytes,
+                "compacted": self.compacted,
+                "pruned": self.pruned,
+                "cached_values": len(self._last),
+            }
+
+
+def _extends(value: list, previous: list) -> bool:
+    """True if `value` is `previous` with items appended, the items are shared between versions"""
+    if len(value) < len(previous):
+        return False
+    return all(a is b or a == b for a, b in zip(value, previous))
@@ -0,0 +1,138 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union
+
+# header written by the Kanoon ingestion in front of every judgment, see agents/misc/kanoon_text.py
+KANOON_HEADER_RE = re.compile(r"\A((?:(?:Title|Court|Date|Docid): [^\n]*\n)+)\n")
+HEADER_LINE_RE = re.compile(r"^(Title|Court|Date|Docid): (.*)$", re.MULTILINE)
+
+# "Supreme Court", "Delhi High Court", "High Court of Kerala"
+COURT_QUERY_RE = re.compile(r"\b(supreme court|(?:[a-z]+ )?high court(?: of [a-z]+)?)\b", re.IGNORECASE)
+COURT_QUERY_FILLER_WORDS = {"the", "a", "an", "any", "by", "of", "in", "from"}
+YEAR_FROM_RE = re.compile(r"\b(?:after|since|from|post)\s+(\d{4})\b", re.IGNORECASE)
+YEAR_TO_RE = re.compile(r"\b(?:before|until|till|upto|up to|pre)\s+(\d{4})\b", re.IGNORECASE)
+YEAR_BETWEEN_RE = re.compile(r"\bbetween\s+(\d{4})\s+and\s+(\d{4})\b", re.IGNORECASE)
+
+
+def header_metadata(text: str) -> Dict[str, Union[str, int]]:
+    """
+    Structured metadata of a converted Kanoon judgment, read from its header.
+    Empty for any other document.
+    """
+    match = KANOON_HEADER_RE.match(text)
+    if not match:
+        return {}
+    fields = {key.lower(): value.strip() for key, value in HEADER_LINE_RE.findall(match.group(1))}
+    metadata = {"corpus": "kanoon"}
+    for key in ("court", "docid", "title"):
+        if fields.get(key):
+            metadata[key] = fields[key]
+    if fields.get("date"):
+        metadata["date"] = fields["date"]
+        if fields["date"][:4].isdigit():
+            # a number, the filters compare it as a range
+            metadata["year"] = int(fields["date"][:4])
+    return metadata
+
+
+def _literal(value) -> str:
+    # backticks are turned into quotes and double quotes are dropped by the server, see VectorStoreServer.merge_filters
+    return "`" + str(value).replace("`", "").replace('"', "") + "`"
+
+
+@dataclass(frozen=True)
+class MetadataFilter:
+    """
+    Restriction of a retrieval to chunks whose metadata matches, applied inside the index before top-k.
+    Every given field must match, a chunk lacking a filtered field does not match.
+
+    courts: substrings of the court name, any of them, case sensitive - eg. ("Supreme Court",)
+    year_from, year_to: inclusive range of the judgment year - eg. 2010, None
+    corpus: 'ipc', 'kanoon' or a collection name - eg. kanoon
+    docid: Kanoon document id - eg. 1766147
+    ipc_section: IPC section number - eg. 499
+    """
+    courts: Tuple[str, ...] = ()
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    corpus: Optional[str] = None
+    docid: Optional[str] = None
+    ipc_section: Optional[str] = None
+
+    def __bool__(self):
+        return any(value not in (None, ()) for value in (
+            self.courts, self.year_from, self.year_to, self.corpus, self.docid, self.ipc_section,
+        ))
+
+    def matches(self, metadata: dict) -> bool:
+        """Python evaluation of the filter, for the snapshot and BM25 indexes"""
+        if self.courts:
+            court = metadata.get("court") or ""
+            if not any(name in court for name in self.courts):
+                return False
+        if self.year_from is not None or self.year_to is not None:
+            year = metadata.get("year")
+            if not isinstance(year, int):
+                return False
+            if self.year_from is not None and year < self.year_from:
+                return False
+            if self.year_to is not None and year > self.year_to:
+                return False
+        for key in ("corpus", "docid", "ipc_section"):
+            value = getattr(self, key)
+            if value is not None and str(metadata.get(key)) != str(value):
+                return False
+        return True
+
+    def to_jmespath(self) -> Optional[str]:
+        """
+        The filter as a metadata_filter for the VectorStoreServer, None if it filters nothing.
+        The server evaluates it on every candidate inside the KNN index.
+        """
+        parts = []
+        if self.courts:
+            # jmespath's contains() fails on a missing field, guard it
+            courts = " || ".join(f"contains(court, {_literal(name)})" for name in self.courts)
+            parts.append(f"court && ({courts})")
+        # the server turns literals into strings, to_number() makes them comparable with the year
+        if self.year_from is not None:
+            parts.append(f"year >= to_number({_literal(self.year_from)})")
+        if self.year_to is not None:
+            parts.append(f"year <= to_number({_literal(self.year_to)})")
+        for key in ("corpus", "docid", "ipc_section"):
+            value = getattr(self, key)
+            if value is not None:
+                parts.append(f"{key} == {_literal(value)}")
+        if not parts:
+            return None
+        return " && ".join(f"({part})" for part in parts)
+
+    @classmethod
+    def from_text(cls, text: str) -> "MetadataFilter":
+        """
+        Court and year restrictions spelled out in a request, eg. "Supreme Court judgments after 2010".
+        Court names are matched as Kanoon spells them, whatever the case in the request.
+        """
+        courts = []
+        for match in COURT_QUERY_RE.finditer(text):
+            words = match.group(1).split()
+            # "the High Court" names no court in particular
+            if words[0].lower() in COURT_QUERY_FILLER_WORDS:
+                words = words[1:]
+            words = [word.lower() for word in words]
+            # court names are stored as Kanoon spells them, "Delhi High Court", "High Court of Kerala"
+            courts.append(" ".join(word if word.lower() == "of" else word.capitalize() for word in words))
+        courts = tuple(dict.fromkeys(courts))
+        year_from = year_to = None
+        between = YEAR_BETWEEN_RE.search(text)
+        if between:
+            year_from, year_to = sorted(int(year) for year in between.groups())
+        else:
+            after = YEAR_FROM_RE.search(text)
+            before = YEAR_TO_RE.search(text)
+            # "after 2010" excludes 2010, "since 2010" includes it
+            if after:
+                year_from = int(after.group(1)) + (after.group(0).lower().startswith(("after", "post")))
+            if before:
+                year_to = int(before.group(1)) - (before.group(0).lower().startswith(("before", "pre")))
+        return cls(courts=courts, year_from=year_from, year_to=year_to)
@@ -0,0 +1,164 @@
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from .streaming import token_stream
+
+CHARS_PER_TOKEN = 4  # rough token count of English text, good enough to budget prompts
+
+# agents whose messages carry retrieved documents and search reports rather than arguments
+EVIDENCE_SOURCES = ("retriever", "web_searcher", "kanoon_fetcher")
+
+SUMMARY_PROMPT = """You maintain the running summary of a courtroom simulation transcript.
+Update the summary with the new transcript turns below. Keep every claim, cited law, IPC section, precedent,
+objection and ruling, and who made it. Drop repetition and chain of thought. At most {words} words, plain text.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def estimate_tokens(content) -> int:
+    return len(str(content)) // CHARS_PER_TOKEN + 1
+
+
+def count_tokens(messages) -> int:
+    # a few tokens of role and name per message
+    return sum(estimate_tokens(_content(message)) + 4 for message in messages)
+
+
+def _content(message) -> str:
+    return message.content if isinstance(message, BaseMessage) else message.get("content", "")
+
+
+def _render(message) -> str:
+    name = (message.name if isinstance(message, BaseMessage) else message.get("name")) or "user"
+    return f"{name}: {_content(message)}"
+
+
+class ContextCompactor:
+    """
+    Bounds the transcript an agent sends with every thought step.
+
+    The case (first message) and the last `recent_turns` messages are sent verbatim. Evidence
+    older than that (retrieved documents, web search reports) is replaced by a short reference.
+    Over the agent's `budget`, so is the recent evidence but the latest one, and the turns before
+    the recent ones are folded into a running summary by one LLM call, kept in the state
+    (`summary`, `summarized`) so every agent reuses it and each turn is summarized once. Estimated prompt tokens, with and
+    without compaction, are accumulated per agent in the state's `context_stats`.
+    """
+
+    def __init__(self, llm, budget: int = 6000, recent_turns: int = 6, excerpt_chars: int = 300,
+                 evidence_tokens: int = 250, summary_words: int = 400):
+        """
+        Parameters:
+        llm: gateway or chat model writing the summaries - eg. LLMGateway(llms)
+        budget: estimated tokens of transcript sent per call, system prompt excluded - eg. 6000
+        recent_turns: latest messages always sent verbatim - eg. 6
+        excerpt_chars: characters of an evidence message kept in its reference - eg. 300
+        evidence_tokens: size from which a retriever or web search message counts as evidence - eg. 250
+        summary_words: length cap of the running summary - eg. 400
+        """
+        self.llm = llm
+        self.budget = budget
+        self.recent_turns = recent_turns
+        self.excerpt_chars = excerpt_chars
+        self.evidence_tokens = evidence_tokens
+        self.summary_words = summary_words
+
+    def is_evidence(self, message) -> bool:
+        return (
+            isinstance(message, BaseMessage)
+            and message.name in EVIDENCE_SOURCES
+            and estimate_tokens(message.content) > self.evidence_tokens
+        )
+
+    def reference(self, index: int, message: BaseMessage) -> HumanMessage:
+        """Stand-in for an evidence message, the full text stays in the state"""
+        excerpt = message.content[:self.excerpt_chars].strip()
+        return HumanMessage(
+            content=f"[evidence #{index} from {message.name}, {estimate_tokens(message.content)} tokens, "
+                    f"shown in full earlier in the trial. Excerpt: {excerpt} ...]",
+            name=message.name,
+        )
+
+    def _view(self, messages: List[BaseMessage], summary: Optional[str], start: int, keep_from: int) -> list:
+        """Case, summary of messages[1:start], then messages[start:] with evidence before `keep_from` referenced"""
+        view = list(messages[:1])
+        if summary:
+            view.append({"role": "system", "content": f"Summary of the earlier proceedings: {summary}"})
+        for index in range(start, len(messages)):
+            message = messages[index]
+            view.append(self.reference(index, message) if index < keep_from and self.is_evidence(message) else message)
+        return view
+
+    async def _summarize(self, summary: Optional[str], turns: List[BaseMessage], start: int) -> str:
+        rendered = "\n\n".join(
+            _render(self.reference(start + i, message) if self.is_evidence(message) else message)
+            for i, message in enumerate(turns)
+        )
+        prompt = SUMMARY_PROMPT.format(words=self.summary_words, summary=summary or "(none yet)", turns=rendered)
+        try:
+            # bookkeeping, not part of the agent's answer streamed to the UI
+            with token_stream(None):
+                result = await self.llm.ainvoke([{"role": "user", "content": prompt}])
+            return result.content.strip()
+        except Exception as e:
+            print(f"Transcript summary failed with error: {e}, keeping excerpts instead")
+            excerpts = "\n".join(_render(message)[:self.excerpt_chars] for message in turns)
+            kept = self.summary_words * 6  # characters of roughly `summary_words` words
+            return ((summary + "\n") if summary else "")[-kept:] + excerpts[-kept:]
+
+    async def compact(self, agent: str, state: dict) -> Tuple[list, Dict]:
+        """
+        Transcript to send for `agent`, in place of state["messages"].
+
+        Returns:
+        the messages, and the state update to return with the agent's response (summary, context_stats)
+        """
+        messages = state["messages"]
+        summary = state.get("summary")
+        start = max(state.get("summarized") or 1, 1)
+        recent_from = max(len(messages) - self.recent_turns, start)
+        update = {}
+
+        # evidence older than the recent turns is referenced
+        keep_from = recent_from
+        view = self._view(messages, summary, start, keep_from)
+        if count_tokens(view) > self.budget:
+            # then the evidence in the recent turns, but the latest one, which is being answered
+            latest = max((i for i in range(start, len(messages)) if self.is_evidence(messages[i])), default=keep_from)
+            keep_from = max(latest, recent_from)
+            view = self._view(messages, summary, start, keep_from)
+        summarized = False
+        if count_tokens(view) > self.budget:
+            foldable = count_tokens(view) - count_tokens(self._view(messages, summary, recent_from, keep_from))
+            # folding a turn or two at a time would cost a summary call on every step
+            if foldable >= self.budget // 4:
+                summary = await self._summarize(summary, messages[start:recent_from], start)
+                start = recent_from
+                update.update(summary=summary, summarized=start)
+                summarized = True
+                view = self._view(messages, summary, start, keep_from)
+
+        stats = {name: dict(values) for name, values in (state.get("context_stats") or {}).items()}
+        agent_stats = stats.setdefault(agent, {"calls": 0, "prompt_tokens": 0, "full_tokens": 0, "saved_tokens": 0, "summaries": 0})
+        prompt_tokens, full_tokens = count_tokens(view), count_tokens(messages)
+        agent_stats["calls"] += 1
+        agent_stats["prompt_tokens"] += prompt_tokens
+        agent_stats["full_tokens"] += full_tokens
+        agent_stats["saved_tokens"] += full_tokens - prompt_tokens
+        agent_stats["summaries"] += summarized
+        update["context_stats"] = stats
+        return view, update
+
+
+def context_report(context_stats: Optional[dict]) -> dict:
+    """Per agent and total estimated prompt tokens of a trial, sent and saved by the compaction"""
+    agents = context_stats or {}
+    total = {key: sum(values[key] for values in agents.values())
+             for key in ("calls", "prompt_tokens", "full_tokens", "saved_tokens", "summaries")}
+    total["saved_ratio"] = round(total["saved_tokens"] / total["full_tokens"], 3) if total["full_tokens"] else 0.0
+    return {"agents": agents, "total": total}
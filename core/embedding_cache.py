@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from array import array
+from typing import List, Optional
+
+from .sqlite_lru import SqliteLRU
+
+
+class EmbeddingCache:
+    """
+    Disk-backed, content-addressed cache of chunk embeddings.
+
+    Entries are keyed by sha256(model name + chunk text), so an unchanged chunk is never
+    embedded twice, across restarts and across containers sharing the cache directory.
+    The cache is bounded to `max_entries`, least recently used entries are evicted first.
+    """
+
+    def __init__(self, path: str = ".embedding_cache/embeddings.sqlite", max_entries: int = 200_000):
+        """
+        Parameters:
+        path: sqlite file to store the embeddings in - eg. .embedding_cache/embeddings.sqlite
+        max_entries: max number of embeddings kept on disk - eg. 200000
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # pathway calls the embedder from its own threads
+        self.store = SqliteLRU(path, "embeddings", ["vector BLOB NOT NULL"], "idx_last_used", max_entries)
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Cached vectors for the given texts, None where the text was not cached yet"""
+        keys = [self.key(model_name, text) for text in texts]
+        found = {key: array("f", row[0]).tolist() for key, row in self.store.get(keys).items()}
+        vectors = [found.get(key) for key in keys]
+        hits = sum(vector is not None for vector in vectors)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model_name: str, texts: List[str], vectors: List[List[float]]):
+        """Store vectors for the given texts and evict the least recently used ones over the limit"""
+        self.store.put([
+            (self.key(model_name, text), array("f", vector).tobytes())
+            for text, vector in zip(texts, vectors)
+        ])
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.store.evictions,
+                "entries": len(self.store),
+                "max_entries": self.max_entries,
+            }
+
+
+class CachedEmbeddings:
+    """
+    Wraps a langchain embeddings model, serving document embeddings from an EmbeddingCache
+    and only sending cache misses to the underlying model.
+    """
+
+    def __init__(self, embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def _missing(self, texts, cached) -> List[str]:
+        # unique texts that still need embedding, a batch can repeat the same chunk
+        return list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+
+    def _merge(self, texts, cached, missing, computed):
+        computed = dict(zip(missing, computed))
+        return [vector if vector is not None else computed[text] for text, vector in zip(texts, cached)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached = self.cache.get_many(self.model_name, texts)
+        missing = self._missing(texts, cached)
+        computed = self.embeddings.embed_documents(missing) if missing else []
+        if missing:
+            self.cache.put_many(self.model_name, missing, computed)
+        return self._merge(texts, cached, missing, computed)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        cached = self.cache.get_many(self.model_name, texts)
+        missing = self._missing(texts, cached)
+        computed = await self.embeddings.aembed_documents(missing) if missing else []
+        if missing:
+            self.cache.put_many(self.model_name, missing, computed)
+        return self._merge(texts, cached, missing, computed)
+
+    # queries are one-off, they go straight to the model
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
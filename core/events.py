@@ -0,0 +1,55 @@
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+# bumped when a field changes meaning or goes away, new fields and event types keep the version
+SCHEMA_VERSION = 1
+
+# event types of a trial stream and the fields they carry besides v, type and session_id
+EVENT_TYPES = {
+    "queued": {"content": "waiting for a free trial slot"},
+    "started": {"content": "trial started, or resumed with the user's feedback"},
+    "token": {"node": "agent generating", "thought_step": "its thought step", "delta": "text generated"},
+    "token_reset": {"node": "agent generating", "thought_step": "its thought step, its answer starts over"},
+    "step": {
+        "node": "graph node that ran",
+        "thought_step": "thought step the node moved to, null if unchanged",
+        "next": "routing decision: node or agent to run next, null if unchanged",
+        "messages": "messages the node added, [{name, text}]",
+    },
+    "awaiting_feedback": {"content": "prompt for the user", "argument": "lawyer's argument to give feedback on"},
+    "done": {
+        "content": "end of the trial",
+        "context": "prompt tokens per agent",
+        "judge": "judge calls per mode",
+        "timing": "wall time, seconds per node, per kind of span (llm, vector_query, kanoon, web_search) and per model",
+    },
+}
+
+
+def event(type_: str, session_id: Optional[str], **fields: Any) -> Dict[str, Any]:
+    """Stream event of the current schema version"""
+    return {"v": SCHEMA_VERSION, "type": type_, "session_id": session_id, **fields}
+
+
+def message_delta(message) -> Dict[str, Any]:
+    if isinstance(message, BaseMessage):
+        return {"name": message.name, "text": message.content}
+    return {"name": message.get("name"), "text": message.get("content", "")}
+
+
+def step_events(session_id: str, update: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One step event per node of a graph update, with what the node added rather than its whole output"""
+    events = []
+    for node, output in update.items():
+        if node.startswith("__"):  # interrupts, reported by the awaiting_feedback event
+            continue
+        output = output or {}  # nodes with nothing to add, eg. the fetcher or an idle research branch
+        events.append(event(
+            "step", session_id,
+            node=node,
+            thought_step=output.get("thought_step"),
+            next=output.get("next"),
+            messages=[message_delta(message) for message in output.get("messages") or []],
+        ))
+    return events
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import time
+from typing import Dict, List, Optional
+
+from .chunk_metadata import MetadataFilter
+
+import numpy as np
+from langchain_core.documents import Document
+
+MANIFEST = "manifest.json"
+EMBEDDINGS = "embeddings.npy"  # float32 (chunks x dim), rows L2-normalized
+TEXTS = "texts.bin"  # utf-8 chunk texts, back to back
+OFFSETS = "offsets.npy"  # int64 (chunks + 1), byte offsets into texts.bin
+METADATA = "metadata.json"
+# bumped when the chunking or the chunk metadata changes, older snapshots are rebuilt
+FORMAT_VERSION = 2
+
+
+def source_hashes(path: str) -> Dict[str, str]:
+    """sha256 of every file of a collection, keyed by path relative to the collection root"""
+    if os.path.isfile(path):
+        files = [path]
+        root = os.path.dirname(path)
+    else:
+        files = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(path) for name in names]
+        root = path
+    hashes = {}
+    for file_path in sorted(files):
+        with open(file_path, "rb") as file:
+            hashes[os.path.relpath(file_path, root)] = hashlib.sha256(file.read()).hexdigest()
+    return hashes
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class IndexSnapshot:
+    """
+    On-disk snapshot of one collection's vector index: the embeddings matrix, the chunk texts and
+    their metadata. Embeddings and texts are memory-mapped on load, so attaching is near instant
+    and workers on the same machine share the pages through the OS page cache.
+    """
+
+    def __init__(self, directory: str, manifest: dict, embeddings: np.ndarray, offsets: np.ndarray,
+                 texts: mmap.mmap, metadatas: List[dict]):
+        self.directory = directory
+        self.manifest = manifest
+        self.embeddings = embeddings
+        self.offsets = offsets
+        self.texts = texts
+        self.metadatas = metadatas
+        self._filtered_rows: Dict[MetadataFilter, np.ndarray] = {}
+
+    @staticmethod
+    def is_fresh(directory: str, path: str, model_name: str) -> bool:
+        """True if a snapshot exists in `directory` for the current content of `path` and the same model"""
+        try:
+            with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return (
+            manifest.get("format") == FORMAT_VERSION
+            and manifest.get("model") == model_name
+            and manifest.get("sources") == source_hashes(path)
+        )
+
+    @classmethod
+    def build(cls, directory: str, path: str, splitter, embeddings, model_name: str,
+              metadata: Optional[dict] = None) -> "IndexSnapshot":
+        """
+        Chunk and embed every file of a collection and write the snapshot to `directory`.
+        The snapshot is written next to the old one and swapped in, readers never see a partial one.
+        `metadata` is added to the metadata of every chunk, eg. {"corpus": "public"}.
+        """
+        hashes = source_hashes(path)
+        root = path if os.path.isdir(path) else os.path.dirname(path)
+        chunks: List[Document] = []
+        for relpath in hashes:
+            file_path = os.path.join(root, relpath)
+            with open(file_path, "rb") as file:
+                text = file.read().decode("utf-8", errors="ignore")
+            chunks.extend(splitter.split_documents(
+                [Document(page_content=text, metadata={**(metadata or {}), "path": file_path})]
+            ))
+
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks]) if chunks else []
+        matrix = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(chunks), -1))
+        encoded = [chunk.page_content.encode("utf-8") for chunk in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+
+        staging = f"{directory}.tmp-{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        np.save(os.path.join(staging, EMBEDDINGS), matrix)
+        np.save(os.path.join(staging, OFFSETS), offsets)
+        with open(os.path.join(staging, TEXTS), "wb") as file:
+            file.write(b"".join(encoded) or b"\0")  # an empty file can't be memory-mapped
+        with open(os.path.join(staging, METADATA), "w", encoding="utf-8") as file:
+            json.dump([chunk.metadata for chunk in chunks], file)
+        with open(os.path.join(staging, MANIFEST), "w", encoding="utf-8") as file:
+            json.dump({"format": FORMAT_VERSION, "model": model_name, "sources": hashes, "chunks": len(chunks), "created": time.time()}, file)
+
+        if os.path.exists(directory):
+            retired = f"{directory}.old-{os.getpid()}"
+            os.replace(directory, retired)
+            os.replace(staging, directory)
+            shutil.rmtree(retired, ignore_errors=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(directory)), exist_ok=True)
+            os.replace(staging, directory)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "IndexSnapshot":
+        with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        with open(os.path.join(directory, METADATA), "r", encoding="utf-8") as file:
+            metadatas = json.load(file)
+        embeddings = np.load(os.path.join(directory, EMBEDDINGS), mmap_mode="r")
+        offsets = np.load(os.path.join(directory, OFFSETS), mmap_mode="r")
+        with open(os.path.join(directory, TEXTS), "rb") as file:
+            texts = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(directory, manifest, embeddings, offsets, texts, metadatas)
+
+    @classmethod
+    def load_or_build(cls, directory: str, path: str, splitter, embeddings, model_name: str,
+                      metadata: Optional[dict] = None) -> "IndexSnapshot":
+        """Attach to the snapshot if the collection did not change since it was taken, rebuild it otherwise"""
+        if cls.is_fresh(directory, path, model_name):
+            return cls.load(directory)
+        print(f"Index snapshot '{directory}' is missing or stale, rebuilding...")
+        return cls.build(directory, path, splitter, embeddings, model_name, metadata)
+
+    def text(self, row: int) -> str:
+        return self.texts[int(self.offsets[row]):int(self.offsets[row + 1])].decode("utf-8")
+
+    def rows_matching(self, filters: MetadataFilter) -> np.ndarray:
+        """Rows whose metadata matches the filter, memoized per filter"""
+        rows = self._filtered_rows.get(filters)
+        if rows is None:
+            rows = np.array([row for row, metadata in enumerate(self.metadatas) if filters.matches(metadata)],
+                            dtype=np.int64)
+            if len(self._filtered_rows) >= 128:
+                self._filtered_rows.clear()
+            self._filtered_rows[filters] = rows
+        return rows
+
+    def search(self, query_vector: List[float], k: int = 4, rows: Optional[np.ndarray] = None,
+               filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """Top-k chunks by cosine similarity, restricted to the given rows or to the rows matching `filters`"""
+        if filters:
+            rows = self.rows_matching(filters) if rows is None else np.intersect1d(rows, self.rows_matching(filters))
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return []
+        query = _normalize(np.asarray(query_vector, dtype=np.float32))
+        candidates = self.embeddings if rows is None else self.embeddings[rows]
+        scores = candidates @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        if rows is not None:
+            best = rows[best]
+        return [Document(page_content=self.text(row), metadata=self.metadatas[row]) for row in best]
+
+    def __len__(self):
+        return len(self.metadatas)
@@ -0,0 +1,251 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from .chunk_metadata import header_metadata
+
+IPC_MARKER = "THE INDIAN PENAL CODE"
+# the arrangement of sections (table of contents) ends where the enacted text starts
+IPC_BODY_START = re.compile(r"^ACT NO\. 45 OF 1860", re.MULTILINE)
+
+CHAPTER_RE = re.compile(r"^CHAPTER ([IVXL]+A?)\s*$")
+# "499. Defamation.—Whoever..." or "[29A. “Electronic record”.—The words..."
+SECTION_RE = re.compile(r"^\[?(\d{1,3}[A-Z]{0,2})\.\s+(.+?)\.?\s*—\s*(.*)$", re.DOTALL)
+SECTION_START_RE = re.compile(r"^\[?\d{1,3}[A-Z]{0,2}\.\s+\S.*—")
+# first line of a heading wrapped before its "—", eg. "181. False statement on oath or affirmation to"
+HEADING_START_RE = re.compile(r"^\[?\d{1,3}[A-Z]{0,2}\.\s+[A-Z“\"\[]")
+# heading of a repealed section, complete without a "—", eg. "[216B. Definition of “harbour” ...] Rep. by"
+REPEALED_RE = re.compile(r"\]\s*Rep\.")
+# lines a wrapped heading spans at most, the blank lines and page breaks in between aside
+HEADING_MAX_LINES = 3
+# footnote reference numbers and page numbers, eg. "3 4" or "108"
+NUMBERS_ONLY_RE = re.compile(r"^\s*\d+(\s+\d+)*\s*$")
+# the blank line printed above every footnote block
+FOOTNOTE_RULE_RE = re.compile(r"^ {20,}$")
+
+# "Section 499", "sec. 29A", "s. 345", "u/s 420", "IPC 345", "345 IPC", "Sections 499 and 500", "ss. 120B, 420 IPC"
+SECTION_NUMBERS = r"\d{1,3}[A-Z]{0,2}(?:\s*(?:,|&|/|\band\b|\bor\b)\s*\d{1,3}[A-Z]{0,2}\b)*"
+SECTION_QUERY_RE = re.compile(
+    rf"\b(?:sections?|secs?\.?|ss?\.|u/s\.?|ipc)\s*({SECTION_NUMBERS})\b"
+    rf"|\b({SECTION_NUMBERS})\s*(?:of\s+(?:the\s+)?)?(?:IPC|Indian Penal Code)\b",
+    re.IGNORECASE,
+)
+SECTION_NUMBER_RE = re.compile(r"\d{1,3}[A-Z]{0,2}", re.IGNORECASE)
+# a reference to the section of another statute, eg. "section 3 of IT Act", "section 138 NI Act", "section 154 CrPC"
+OTHER_ACT_RE = re.compile(
+    r"\s*,?\s*(?:of\s+(?:the\s+)?)?(?:"
+    r"(?:(?!(?:and|or|with|read|under|in|is|are|was|for|to|a|an|any|this|that|ipc|indian|penal|code)\b)[\w.&'()-]+\s+){0,6}?act\b"
+    r"|cr\.?\s?p\.?\s?c\b|c\.?p\.?c\b|code\s+of\s+(?:criminal|civil)\s+procedure|constitution\b)",
+    re.IGNORECASE,
+)
+
+QUERY_FILLER_WORDS = {"and", "or", "of", "the", "ipc", "indian", "penal", "code", "under", "read", "with"}
+
+
+@dataclass
+class IPCSection:
+    """One section of the Indian Penal Code"""
+    chapter: str  # eg. XXI
+    chapter_title: str  # eg. OF DEFAMATION
+    section: str  # eg. 499 or 29A
+    title: str  # eg. Defamation
+    body: str
+
+    def to_text(self) -> str:
+        return f"Section {self.section}. {self.title}.—{self.body}"
+
+    def metadata(self) -> dict:
+        return {
+            "corpus": "ipc",
+            "ipc_section": self.section,
+            "ipc_title": self.title,
+            "ipc_chapter": self.chapter,
+        }
+
+
+def _section_number(section: str) -> int:
+    return int(re.match(r"\d+", section).group())
+
+
+def _clean_lines(text: str) -> List[str]:
+    """Drop page numbers, footnote blocks and footnote reference numbers"""
+    lines = []
+    in_footnotes = False
+    for line in text.splitlines():
+        if FOOTNOTE_RULE_RE.match(line):
+            in_footnotes = True  # runs until the page number closing the page
+            continue
+        if NUMBERS_ONLY_RE.match(line):
+            in_footnotes = False
+            continue
+        if not in_footnotes:
+            lines.append(line.rstrip())
+    return lines
+
+
+def _open_heading(current: List[str]) -> bool:
+    """True if the paragraph so far is a section heading wrapped before its "—" """
+    text = " ".join(current)
+    return (len(current) < HEADING_MAX_LINES and HEADING_START_RE.match(text) is not None
+            and "—" not in text and not REPEALED_RE.search(text))
+
+
+def _paragraphs(lines: List[str]) -> List[str]:
+    paragraphs, current = [], []
+    for line in lines:
+        # a heading can follow the previous section without a blank line in between, or a repealed
+        # section's heading that has no "—"
+        if current and (SECTION_START_RE.match(line) or (
+                _open_heading(current) and (HEADING_START_RE.match(line) or CHAPTER_RE.match(line)))):
+            paragraphs.append(" ".join(current))
+            current = []
+        if line.strip():
+            current.append(line.strip())
+        elif current and not _open_heading(current):
+            # a heading wrapping over a blank line or a page break goes on with its next line
+            paragraphs.append(" ".join(current))
+            current = []
+    if current:
+        paragraphs.append(" ".join(current))
+    return paragraphs
+
+
+def is_ipc_text(text: str) -> bool:
+    return IPC_MARKER in text[:2000] and IPC_BODY_START.search(text) is not None
+
+
+def parse_ipc(text: str) -> List[IPCSection]:
+    """
+    Parse the text of the Indian Penal Code into one record per section.
+
+    Section headings are recognised by "<number>. <title>.—", numbers must increase through
+    the code, which filters out footnotes and cross references that look like headings.
+    """
+    match = IPC_BODY_START.search(text)
+    if match:
+        text = text[match.end():]
+
+    sections: List[IPCSection] = []
+    chapter, chapter_title = "", ""
+    expect_chapter_title = False
+    last_number = 0
+
+    for paragraph in _paragraphs(_clean_lines(text)):
+        chapter_match = CHAPTER_RE.match(paragraph)
+        if chapter_match:
+            chapter, chapter_title = chapter_match.group(1), ""
+            expect_chapter_title = True
+            continue
+        if expect_chapter_title and paragraph.isupper():
+            chapter_title = paragraph
+            expect_chapter_title = False
+            continue
+        expect_chapter_title = False
+
+        section_match = SECTION_RE.match(paragraph)
+        if section_match:
+            number = _section_number(section_match.group(1))
+            # allow gaps for repealed sections, but not jumps backwards or far ahead
+            if last_number <= number <= last_number + 30:
+                last_number = number
+                sections.append(IPCSection(
+                    chapter=chapter,
+                    chapter_title=chapter_title,
+                    section=section_match.group(1).upper(),
+                    title=section_match.group(2).strip(" [].“”\""),
+                    body=section_match.group(3).strip(),
+                ))
+                continue
+
+        if sections:
+            sections[-1].body += "\n" + paragraph
+
+    return sections
+
+
+class IPCSectionIndex:
+    """In-memory index of IPC sections by section number, for exact lookups without embeddings"""
+
+    def __init__(self, sections: List[IPCSection]):
+        self.sections: Dict[str, IPCSection] = {section.section: section for section in sections}
+
+    @classmethod
+    def from_file(cls, path: str = "./public_documents/IndianPenalCode.txt") -> "IPCSectionIndex":
+        with open(path, "r", encoding="utf-8-sig") as file:
+            return cls(parse_ipc(file.read()))
+
+    def get(self, section: str) -> Optional[IPCSection]:
+        return self.sections.get(section.strip().upper())
+
+    def lookup(self, query: str) -> List[IPCSection]:
+        """
+        All sections referenced in a query like 'Section 499', 'IPC 345' or 'Sections 499 and 500',
+        in order of mention. Sections of another Act ('section 3 of the IT Act') are not IPC sections.
+        """
+        found = []
+        for match in SECTION_QUERY_RE.finditer(query):
+            if match.group(1) and OTHER_ACT_RE.match(query, match.end()):
+                continue
+            for number in SECTION_NUMBER_RE.findall(match.group(1) or match.group(2)):
+                section = self.get(number)
+                if section is not None and section not in found:
+                    found.append(section)
+        return found
+
+    def is_exact_query(self, query: str) -> bool:
+        """True if the query is only a reference to sections, eg. 'IPC 345' or 'Section 499 and 500'"""
+        rest = SECTION_QUERY_RE.sub(" ", query)
+        words = [word for word in re.findall(r"\w+", rest.lower()) if word not in QUERY_FILLER_WORDS]
+        return bool(self.lookup(query)) and not words
+
+    def __len__(self):
+        return len(self.sections)
+
+
+class SectionAwareSplitter:
+    """
+    Splitter for the vector store: the IPC is cut at section boundaries, one chunk per
+    section (long sections are split further by the fallback splitter, keeping the
+    section metadata). Any other document goes through the fallback splitter as is,
+    Kanoon judgments tagged with the court, year and docid of their header.
+    """
+
+    def __init__(self, fallback_splitter):
+        self.fallback_splitter = fallback_splitter
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        chunks = []
+        for document in documents:
+            if not is_ipc_text(document.page_content):
+                # Kanoon judgments carry court, year and docid on every chunk
+                metadata = {**document.metadata, **header_metadata(document.page_content)}
+                chunks.extend(self.fallback_splitter.split_documents(
+                    [Document(page_content=document.page_content, metadata=metadata)]
+                ))
+                continue
+            for section in parse_ipc(document.page_content):
+                section_doc = Document(
+                    page_content=section.to_text(),
+                    metadata={**document.metadata, **section.metadata()},
+                )
+                chunks.extend(self.fallback_splitter.split_documents([section_doc]))
+        return chunks
+
+    transform_documents = split_documents
+
+
+if __name__ == "__main__":    # example/test usage
+    index = IPCSectionIndex.from_file()
+    print(len(index), "sections")
+    # headings wrapped over a blank line or a page break before their "—"
+    for number in ("75", "133", "181", "182", "244", "249", "474"):
+        assert index.get(number) is not None, f"section {number} not parsed"
+    assert "False statement on oath" not in index.get("180").body
+    assert [s.section for s in index.lookup("Sections 499 and 500")] == ["499", "500"]
+    assert [s.section for s in index.lookup("ss. 120B, 420 IPC")] == ["120B", "420"]
+    assert index.is_exact_query("Section 499 and 500")
+    for query in ("section 3 of IT act", "Section 138 NI Act", "section 154 CrPC"):
+        assert index.lookup(query) == [] and not index.is_exact_query(query), query
+    print([(s.section, s.title) for s in index.lookup("Section 499 and 500")])
@@ -0,0 +1,217 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from .chunk_metadata import MetadataFilter
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "he", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "to", "was", "were", "which", "who", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, keeps numbers and section numbers like '29a' or '66a'"""
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = 60) -> List[Document]:
+    """
+    Fuse several ranked lists of documents into one, scoring each document by sum(1 / (k + rank)).
+    Documents are identified by their text, so the same chunk coming from two indexes is merged.
+    """
+    scores: Dict[str, float] = defaultdict(float)
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            scores[document.page_content] += 1.0 / (k + rank)
+            documents.setdefault(document.page_content, document)
+    return [documents[text] for text in sorted(scores, key=scores.get, reverse=True)]
+
+
+class BM25Index:
+    """In-memory inverted index ranking chunks with Okapi BM25"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)  # term -> chunk id -> term frequency
+        self.chunks: Dict[int, Document] = {}
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+        self._next_id = 0
+
+    def add(self, document: Document) -> int:
+        chunk_id = self._next_id
+        self._next_id += 1
+        terms = Counter(tokenize(document.page_content))
+        for term, frequency in terms.items():
+            self.postings[term][chunk_id] = frequency
+        self.chunks[chunk_id] = document
+        self.lengths[chunk_id] = sum(terms.values())
+        self.total_length += self.lengths[chunk_id]
+        return chunk_id
+
+    def remove(self, chunk_id: int):
+        document = self.chunks.pop(chunk_id)
+        for term in set(tokenize(document.page_content)):
+            self.postings[term].pop(chunk_id, None)
+            if not self.postings[term]:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(chunk_id)
+
+    def search(self, query: str, k: int = 4,
+               filters: Optional[MetadataFilter] = None) -> List[Tuple[Document, float]]:
+        """Top-k chunks by BM25, only chunks matching `filters` are scored"""
+        if not self.chunks:
+            return []
+        num_chunks = len(self.chunks)
+        avg_length = self.total_length / num_chunks
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, frequency in postings.items():
+                if filters and not filters.matches(self.chunks[chunk_id].metadata):
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / avg_length)
+                scores[chunk_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [(self.chunks[chunk_id], scores[chunk_id]) for chunk_id in best]
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+class LexicalIndex:
+    """
+    BM25 index over the files of one collection, chunked with the same splitter as the vector
+    index so both indexes rank the same chunks. New, changed and deleted files are picked up
+    by refresh(), at most once every `refresh_interval` seconds. `version` is bumped by every
+    refresh that found such a change.
+    """
+
+    def __init__(self, path: str, splitter, refresh_interval: float = 5.0, metadata: Optional[dict] = None):
+        self.path = path
+        self.metadata = metadata or {}
+        self.splitter = splitter
+        self.refresh_interval = refresh_interval
+        self.index = BM25Index()
+        self._files: Dict[str, Tuple[float, int, List[int]]] = {}  # path -> (mtime, size, chunk ids)
+        self._last_refresh = 0.0
+        self.version = 0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def _list_files(self) -> List[str]:
+        if os.path.isfile(self.path):
+            return [self.path]
+        return [os.path.join(root, name) for root, _, names in os.walk(self.path) for name in names]
+
+    def _chunk_file(self, file_path: str) -> List[Document]:
+        with open(file_path, "rb") as file:
+            # decoded like pathway's utf-8 parser so chunk texts match the vector index
+            text = file.read().decode("utf-8", errors="ignore")
+        return self.splitter.split_documents(
+            [Document(page_content=text, metadata={**self.metadata, "path": file_path})]
+        )
+
+    def refresh(self, force: bool = False):
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return
+            self._last_refresh = time.monotonic()
+
+            seen = set()
+            changed = False
+            for file_path in self._list_files():
+                seen.add(file_path)
+                stat = os.stat(file_path)
+                known = self._files.get(file_path)
+                if known and known[:2] == (stat.st_mtime, stat.st_size):
+                    continue
+                if known:
+                    for chunk_id in known[2]:
+                        self.index.remove(chunk_id)
+                chunk_ids = [self.index.add(chunk) for chunk in self._chunk_file(file_path)]
+                self._files[file_path] = (stat.st_mtime, stat.st_size, chunk_ids)
+                changed = True
+
+            for file_path in set(self._files) - seen:
+                for chunk_id in self._files.pop(file_path)[2]:
+                    self.index.remove(chunk_id)
+                changed = True
+
+            if changed:
+                self.version += 1
+
+    def search(self, query: str, k: int = 4, filters: Optional[MetadataFilter] = None) -> List[Document]:
+        self.refresh()
+        with self._lock:
+            return [document for document, _ in self.index.search(query, k, filters)]
+
+    def __len__(self):
+        return len(self.index)
+
+
+class HybridRetriever:
+    """
+    Retriever fusing the vector index ranking and the BM25 ranking of one collection
+    with reciprocal rank fusion. mode: 'vector', 'lexical' or 'hybrid'.
+    vector_search: callable (query, k, filters) -> top-k documents of the vector index matching filters
+    avector_search: optional async callable (query, k, timeout, filters) -> top-k documents, used by ainvoke
+    """
+
+    def __init__(self, vector_search: Callable[[str, int, Optional[MetadataFilter]], List[Document]],
+                 lexical_index: LexicalIndex,
+                 k: int = 4, mode: str = "hybrid", candidates: int = 10,
+                 avector_search: Optional[Callable[..., Awaitable[List[Document]]]] = None):
+        if mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown retrieval mode '{mode}'")
+        self.vector_search = vector_search
+        self.lexical_index = lexical_index
+        self.k = k
+        self.mode = mode
+        self.candidates = candidates
+        self.avector_search = avector_search
+
+    def invoke(self, query: str, filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """Top-k chunks for the query, only chunks matching `filters` are ranked"""
+        if self.mode == "vector":
+            return self.vector_search(query, self.k, filters)
+        if self.mode == "lexical":
+            return self.lexical_index.search(query, self.k, filters)
+        rankings = [
+            self.vector_search(query, self.candidates, filters),
+            self.lexical_index.search(query, self.candidates, filters),
+        ]
+        return reciprocal_rank_fusion(rankings)[:self.k]
+
+    async def _avector(self, query: str, k: int, timeout: Optional[float],
+                       filters: Optional[MetadataFilter]) -> List[Document]:
+        if self.avector_search is not None:
+            return await self.avector_search(query, k, timeout, filters)
+        return await asyncio.wait_for(asyncio.to_thread(self.vector_search, query, k, filters), timeout)
+
+    async def ainvoke(self, query: str, timeout: Optional[float] = None,
+                      filters: Optional[MetadataFilter] = None) -> List[Document]:
+        """Async invoke, the vector search runs concurrently with the BM25 search in hybrid mode"""
+        if self.mode == "vector":
+            return await self._avector(query, self.k, timeout, filters)
+        if self.mode == "lexical":
+            return await asyncio.to_thread(self.lexical_index.search, query, self.k, filters)
+        rankings = await asyncio.gather(
+            self._avector(query, self.candidates, timeout, filters),
+            asyncio.to_thread(self.lexical_index.search, query, self.candidates, filters),
+        )
+        return reciprocal_rank_fusion(list(rankings))[:self.k]
@@ -0,0 +1,145 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+from .sqlite_lru import SqliteLRU
+
+# sampling parameters of a chat model that change its answer, read from the model when it has them
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "max_tokens", "stop", "seed", "model_kwargs")
+
+# set for the sessions that must not be answered from the cache, eg. a trial asked to be re-run fresh
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+@contextlib.contextmanager
+def bypass_llm_cache(bypass: bool = True) -> Iterator[None]:
+    """Skip the LLM response cache for the calls made in this context, and the tasks started from it"""
+    token = _bypass.set(bypass)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def cache_bypassed() -> bool:
+    return _bypass.get()
+
+
+def _normalize_content(content: Any) -> Any:
+    if not isinstance(content, str):
+        return content
+    # trailing spaces and line endings differ between runs of the same prompt template
+    return re.sub(r"[ \t]+\n", "\n", content.replace("\r\n", "\n")).strip()
+
+
+def normalize_messages(messages) -> List[dict]:
+    """Role, name and content of every message, whatever form the agent built them in"""
+    if isinstance(messages, str):
+        messages = [{"role": "human", "content": messages}]
+    normalized = []
+    for message in messages:
+        if isinstance(message, BaseMessage):
+            role, name, content = message.type, message.name, message.content
+        else:
+            role, name, content = message.get("role"), message.get("name"), message.get("content")
+        # langchain reads "user" and "assistant" roles as human and ai messages
+        role = {"user": "human", "assistant": "ai"}.get(role, role)
+        normalized.append({"role": role, "name": name, "content": _normalize_content(content)})
+    return normalized
+
+
+def sampling_params(llm, **kwargs) -> dict:
+    params = {name: getattr(llm, name) for name in SAMPLING_PARAMS if getattr(llm, name, None) is not None}
+    params.update(kwargs)
+    return params
+
+
+class LLMResponseCache:
+    """
+    Disk-backed cache of chat model responses.
+
+    A response is keyed by sha256 of the model name, the normalized messages and the sampling
+    parameters, so re-running a case file with the same prompts and history is answered from disk.
+    Entries expire after `ttl` seconds, the least recently used ones are evicted over `max_entries`.
+    Lookups and stores hit sqlite, async callers run them on a worker thread.
+    """
+
+    def __init__(self, path: str = ".llm_cache/responses.sqlite", max_entries: int = 20_000,
+                 ttl: float = 7 * 24 * 3600.0):
+        """
+        Parameters:
+        path: sqlite file to store the responses in - eg. .llm_cache/responses.sqlite
+        max_entries: max number of responses kept on disk - eg. 20000
+        ttl: seconds a response is served for - eg. 604800
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+        self.store = SqliteLRU(
+            path, "responses",
+            ["model TEXT NOT NULL", "response TEXT NOT NULL", "created REAL NOT NULL"],
+            "idx_responses_last_used", max_entries,
+        )
+
+    @staticmethod
+    def key(model: str, messages, params: dict) -> str:
+        payload = json.dumps([model, params, normalize_messages(messages)], sort_keys=True, default=str,
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, messages, params: dict) -> Optional[BaseMessage]:
+        """Cached response of the call, None on a miss or when the session bypasses the cache"""
+        if cache_bypassed():
+            with self._lock:
+                self.bypassed += 1
+            return None
+        key = self.key(model, messages, params)
+        row = self.store.get([key]).get(key)
+        expired = row is not None and time.time() - row[2] > self.ttl
+        if expired:
+            self.store.delete([key])
+        with self._lock:
+            self.expirations += expired
+            if row is None or expired:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return messages_from_dict([json.loads(row[1])])[0]
+
+    def put(self, model: str, messages, params: dict, response):
+        """Store a response, chat model responses only, and evict the least recently used ones over the limit"""
+        if cache_bypassed() or not isinstance(response, BaseMessage):
+            return
+        payload = json.dumps(messages_to_dict([response])[0], default=str)
+        self.store.put([(self.key(model, messages, params), model, payload, time.time())])
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "expirations": self.expirations,
+                "evictions": self.store.evictions,
+                "entries": len(self.store),
+                "max_entries": self.max_entries,
+            }
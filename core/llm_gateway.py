@@ -0,0 +1,356 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+from .llm_cache import LLMResponseCache, sampling_params
+from .rate_limiter import RateLimiter, is_rate_limited
+from .streaming import emit_reset, emit_token, streaming
+from .telemetry import LLM, record, token_usage
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# errors after which a model is not worth retrying soon, its circuit opens with the longest cooldown
+PERMANENT_ERROR_MARKERS = ("decommissioned", "model_not_found", "does not exist", "invalid api key")
+
+
+def model_name(llm, index: int) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or f"llm-{index}"
+
+
+class ModelHealth:
+    """Exponentially weighted error rate and latency of one model, and the state of its circuit breaker"""
+
+    def __init__(self, name: str, index: int, alpha: float, cooldown: float):
+        self.name = name
+        self.index = index  # position in the configured fallback order
+        self.alpha = alpha
+        self.error_rate = 0.0
+        self.latency = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self.failed_at = 0.0
+        self.probing = False
+        self.last_error: Optional[str] = None
+
+    def record(self, ok: bool, latency: float):
+        self.calls += 1
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            # failed calls often return fast, only successes say how long an answer takes
+            self.latency = latency if self.latency == 0.0 else self.latency + self.alpha * (latency - self.latency)
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.failed_at = time.monotonic()
+
+    def recent_error_rate(self, half_life: float) -> float:
+        """Error rate fading with the time since the last failure, a model demoted by a burst of errors comes back"""
+        return self.error_rate * 0.5 ** ((time.monotonic() - self.failed_at) / half_life)
+
+    def retry_at(self) -> float:
+        return self.opened_at + self.cooldown
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate, 3),
+            "latency_s": round(self.latency, 3),
+            "calls": self.calls,
+            "failures": self.failures,
+            "retry_in_s": round(max(self.retry_at() - time.monotonic(), 0.0), 1) if self.state == OPEN else 0.0,
+            "last_error": self.last_error,
+        }
+
+
+class LLMGateway:
+    """
+    Single entry point for the chat models of all agents.
+
+    Tracks the error rate and latency of every model. A model failing `failure_threshold` times
+    in a row, or whose error rate climbs over `error_rate_threshold`, has its circuit opened and is
+    skipped until `cooldown` seconds passed, then one call probes it (half-open): success closes the
+    circuit, failure opens it again for twice as long, up to `max_cooldown`. Calls go to the
+    healthiest closed model first, the configured order breaks ties. With a `cache`, a call
+    already answered by a model is served from disk without calling it. With a `rate_limiter`,
+    calls wait for the quota of their model or go to one that has quota left, and a 429 is
+    not counted against the model's health.
+    """
+
+    def __init__(self, llms: List[Any], failure_threshold: int = 3, error_rate_threshold: float = 0.5,
+                 cooldown: float = 30.0, max_cooldown: float = 600.0, alpha: float = 0.2,
+                 slow_latency: float = 20.0, error_half_life: float = 120.0,
+                 max_concurrency: Union[int, Dict[str, int]] = 8, cache: Optional[LLMResponseCache] = None,
+                 rate_limiter: Optional[RateLimiter] = None):
+        """
+        Parameters:
+        llms: chat models, in order of preference - eg. [ChatGroq(model="llama-3.1-8b-instant"), ...]
+        failure_threshold: consecutive failures that open a circuit - eg. 3
+        error_rate_threshold: error rate (EWMA) that opens a circuit - eg. 0.5
+        cooldown: seconds before the first probe of an open circuit - eg. 30
+        max_cooldown: cap of the doubling cooldown - eg. 600
+        alpha: weight of the latest call in the error rate and latency averages - eg. 0.2
+        slow_latency: seconds above which a model is ranked after the responsive ones - eg. 20
+        error_half_life: seconds for the error rate used in the ranking to halve - eg. 120
+        max_concurrency: in-flight async calls per model, or per model name - eg. 8 or {"llama-3.1-8b-instant": 16}
+        cache: response cache shared by all models, None to always call them - eg. LLMResponseCache()
+        rate_limiter: requests and tokens per minute quota of the models - eg. RateLimiter({"gemma2-9b-it": (30, 15000)})
+        """
+        self.llms = list(llms)
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.max_cooldown = max_cooldown
+        self.slow_latency = slow_latency
+        self.error_half_life = error_half_life
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.health = [ModelHealth(model_name(llm, i), i, alpha, cooldown) for i, llm in enumerate(self.llms)]
+        self._lock = threading.Lock()
+        # async calls over the limit of a model wait for a slot, instead of piling up on its rate limits
+        self._semaphores = [
+            asyncio.Semaphore(max_concurrency.get(health.name, 8) if isinstance(max_concurrency, dict) else max_concurrency)
+            for health in self.health
+        ]
+
+    def _rank(self, health: ModelHealth):
+        return round(health.recent_error_rate(self.error_half_life), 1), health.latency > self.slow_latency, health.index
+
+    def _candidates(self) -> List[int]:
+        """Models to try for one call, best first. Claims the probe of circuits due for one."""
+        now = time.monotonic()
+        with self._lock:
+            closed, probes = [], []
+            for health in self.health:
+                if health.state == CLOSED:
+                    closed.append(health)
+                elif health.state == OPEN and now >= health.retry_at():
+                    health.state = HALF_OPEN
+                # one probe per call, tried first so a claimed probe is always attempted
+                if health.state == HALF_OPEN and not health.probing and not probes:
+                    health.probing = True
+                    probes.append(health)
+            candidates = probes + sorted(closed, key=self._rank)
+            if not candidates:
+                # every circuit is open: last resort, the model that would be probed next
+                soonest = min((h for h in self.health if h.state == OPEN), key=ModelHealth.retry_at, default=None)
+                candidates = [soonest] if soonest else []
+            return [health.index for health in candidates]
+
+    def _plan(self, messages, kwargs):
+        """Models to try, those out of quota moved last, and the tokens the call is estimated to use"""
+        candidates = self._candidates()
+        if self.rate_limiter is None or not candidates:
+            return candidates, 0
+        tokens = self.rate_limiter.estimate(messages, kwargs.get("max_tokens"))
+        # a claimed probe stays first, it has to be attempted
+        head = candidates[:1] if self.health[candidates[0]].probing else []
+        rest = sorted(candidates[len(head):],
+                      key=lambda index: self.rate_limiter.overloaded(self.health[index].name, tokens))
+        if rest and rest[0] != candidates[len(head)]:
+            self.rate_limiter.record_reroute(self.health[candidates[len(head)]].name)
+        return head + rest, tokens
+
+    def _rate_limited(self, index: int, error: Exception):
+        """A 429 is the quota, not the model failing, it only makes the limiter back off"""
+        self._release(index)
+        self.rate_limiter.record_rate_limited(self.health[index].name, error)
+        print(f"LLM {self.health[index].name} rate limited: {error}")
+
+    def _open(self, health: ModelHealth, cooldown: float):
+        health.state = OPEN
+        health.cooldown = min(cooldown, self.max_cooldown)
+        health.opened_at = time.monotonic()
+        print(f"LLM {health.name} circuit opened for {health.cooldown:.0f}s: {health.last_error}")
+
+    def _release(self, index: int):
+        with self._lock:
+            self.health[index].probing = False
+
+    def _record(self, index: int, ok: bool, latency: float, error: Optional[Exception] = None):
+        with self._lock:
+            health = self.health[index]
+            was_probe = health.probing
+            health.probing = False
+            health.record(ok, latency)
+            if ok:
+                if health.state != CLOSED:
+                    print(f"LLM {health.name} circuit closed")
+                health.state = CLOSED
+                health.cooldown = health.base_cooldown
+                return
+            health.last_error = f"{type(error).__name__}: {error}"[:300]
+            if any(marker in str(error).lower() for marker in PERMANENT_ERROR_MARKERS):
+                self._open(health, self.max_cooldown)
+            elif was_probe:
+                self._open(health, health.cooldown * 2)
+            elif health.state == CLOSED and (
+                health.consecutive_failures >= self.failure_threshold
+                or (health.calls >= self.failure_threshold and health.error_rate >= self.error_rate_threshold)
+            ):
+                self._open(health, health.base_cooldown)
+
+    def _cached(self, index: int, attempt: int, messages, kwargs):
+        """Cached response of a model to the call, and the sampling parameters it is keyed on"""
+        if self.cache is None:
+            return None, None
+        params = sampling_params(self.llms[index], **kwargs)
+        cached = self.cache.get(self.health[index].name, messages, params)
+        if cached is not None:
+            self._release(index)
+            record(LLM, self.health[index].name, 0.0, outcome="cached", fallback=attempt)
+        return cached, params
+
+    def _store(self, index: int, messages, params, result):
+        if self.cache is not None:
+            self.cache.put(self.health[index].name, messages, params, result)
+
+    def _trace(self, index: int, attempt: int, started: float, error: Optional[BaseException] = None,
+               messages=None, result=None):
+        """LLM span of one attempt, `attempt` is its position in the fallback order of the call"""
+        if error is not None:
+            if not isinstance(error, Exception):
+                outcome = "cancelled"
+            else:
+                outcome = "rate_limited" if is_rate_limited(error) else "error"
+            record(LLM, self.health[index].name, time.monotonic() - started, outcome=outcome, fallback=attempt)
+            return
+        prompt_tokens, completion_tokens, _ = token_usage(result, messages)
+        record(LLM, self.health[index].name, time.monotonic() - started, outcome="ok", fallback=attempt,
+               prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def _failed(self, index: int, attempt: int, started: float, error: BaseException) -> bool:
+        """
+        Account for a failed attempt: a 429 backs the limiter off, other errors count against the model.
+
+        Returns:
+        True to fall back to the next model, False if the error must propagate (the call was cancelled)
+        """
+        self._trace(index, attempt, started, error)
+        if not isinstance(error, Exception):  # cancelled, the trial went away
+            self._release(index)
+            return False
+        if self.rate_limiter is not None and is_rate_limited(error):
+            self._rate_limited(index, error)
+            return True
+        self._record(index, False, time.monotonic() - started, error)
+        print(f"LLM {self.health[index].name} failed with error: {error}")
+        return True
+
+    def _succeeded(self, index: int, attempt: int, started: float, messages, tokens: int, params, result):
+        self._trace(index, attempt, started, messages=messages, result=result)
+        self._record(index, True, time.monotonic() - started)
+        if self.rate_limiter is not None:
+            self.rate_limiter.record_usage(self.health[index].name, tokens, result)
+
+    def invoke(self, messages, **kwargs):
+        """
+        Invoke the healthiest available model, falling back to the next ones on failure.
+
+        Raises:
+        RuntimeError if every model failed or has its circuit open
+        """
+        last_error = None
+        candidates, tokens = self._plan(messages, kwargs)
+        for attempt, index in enumerate(candidates):
+            cached, params = self._cached(index, attempt, messages, kwargs)
+            if cached is not None:
+                return cached
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire_blocking(self.health[index].name, tokens)
+            started = time.monotonic()
+            try:
+                result = self.llms[index].invoke(messages, **kwargs)
+            except BaseException as e:
+                if not self._failed(index, attempt, started, e):
+                    raise
+                last_error = e
+                continue
+            self._succeeded(index, attempt, started, messages, tokens, params, result)
+            self._store(index, messages, params, result)
+            return result
+        raise RuntimeError(f"All LLMs failed or are unavailable, last error: {last_error}")
+
+    @staticmethod
+    async def _astream(llm, messages, **kwargs):
+        """ainvoke, emitting the tokens of the answer as they are generated"""
+        if not hasattr(llm, "astream"):
+            result = await llm.ainvoke(messages, **kwargs)
+            emit_token(result.content)
+            return result
+        result, emitted = None, False
+        try:
+            async for chunk in llm.astream(messages, **kwargs):
+                if isinstance(chunk.content, str) and chunk.content:
+                    emit_token(chunk.content)
+                    emitted = True
+                result = chunk if result is None else result + chunk
+        except Exception:
+            if emitted:
+                emit_reset()
+            raise
+        if result is None:
+            raise ValueError("Empty response stream")
+        return result
+
+    async def ainvoke(self, messages, **kwargs):
+        """
+        Async invoke, never blocks the event loop. At most `max_concurrency` calls are in flight per model.
+        Inside a token_stream (see core.streaming) the answer is streamed, its tokens emitted as they come.
+
+        Raises:
+        RuntimeError if every model failed or has its circuit open
+        """
+        last_error = None
+        candidates, tokens = self._plan(messages, kwargs)
+        for attempt, index in enumerate(candidates):
+            # the cache is sqlite on disk, kept off the event loop
+            cached, params = (await asyncio.to_thread(self._cached, index, attempt, messages, kwargs)
+                              if self.cache is not None else (None, None))
+            if cached is not None:
+                emit_token(cached.content)
+                return cached
+            started = time.monotonic()
+            try:
+                if self.rate_limiter is not None:
+                    # queued by priority, the wait is not part of the model's latency
+                    await self.rate_limiter.acquire(self.health[index].name, tokens)
+                async with self._semaphores[index]:
+                    # latency is measured from the call, not from the wait for a slot
+                    started = time.monotonic()
+                    if streaming():
+                        result = await self._astream(self.llms[index], messages, **kwargs)
+                    else:
+                        result = await self.llms[index].ainvoke(messages, **kwargs)
+            except BaseException as e:
+                if not self._failed(index, attempt, started, e):
+                    raise
+                last_error = e
+                continue
+            self._succeeded(index, attempt, started, messages, tokens, params, result)
+            if self.cache is not None:
+                await asyncio.to_thread(self._store, index, messages, params, result)
+            return result
+        raise RuntimeError(f"All LLMs failed or are unavailable, last error: {last_error}")
+
+    def stats(self) -> dict:
+        """Health and circuit state per model, and its quota when rate limited"""
+        with self._lock:
+            stats = {health.name: health.snapshot() for health in self.health}
+        if self.rate_limiter is not None:
+            for name, quota in self.rate_limiter.stats().items():
+                if name in stats:
+                    stats[name]["quota"] = quota
+        return stats
+
+
+def as_gateway(llms) -> LLMGateway:
+    """The shared gateway if one is given, a private one over the given models otherwise"""
+    return llms if isinstance(llms, LLMGateway) else LLMGateway(llms)
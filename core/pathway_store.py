@@ -2,53 +2,206 @@ import pathway as pw
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores.pathway import PathwayVectorClient
 from pathway.xpacks.llm.vector_store import VectorStoreServer
+import asyncio
+import fnmatch
+import os
+import threading
 import time
 from langchain_huggingface import HuggingFaceEmbeddings
+from .embedding_cache import EmbeddingCache, CachedEmbeddings
+from .ipc_parser import SectionAwareSplitter
+from .lexical_index import LexicalIndex, HybridRetriever
+from .index_snapshot import IndexSnapshot
+from .async_client import AsyncVectorStoreClient
+from .chunk_metadata import MetadataFilter
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# EMBEDDING_MODEL = "law-ai/InLegalBERT"
 
 # @pw.udf
 # def strip_metadata(docs: list[tuple[str, dict]]) -> list[str]:
 #     return [doc[0] for doc in docs]
 
+
+class IndexProgress:
+    """
+    Thread-safe counters describing how far the index build has got.
+    Updated from inside the Pathway dataflow by the tracking splitter/embedder below.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = 0  # documents parsed and split
+        self.chunks = 0  # chunks produced by the splitter
+        self.embedded = 0  # chunks that went through the embedder
+        self.last_update = time.monotonic()
+
+    def record_document(self, num_chunks: int):
+        with self._lock:
+            self.documents += 1
+            self.chunks += num_chunks
+            self.last_update = time.monotonic()
+
+    def record_embedded(self, num_chunks: int):
+        with self._lock:
+            self.embedded += num_chunks
+            self.last_update = time.monotonic()
+
+    def idle_for(self) -> float:
+        """Seconds since the dataflow last reported any progress."""
+        with self._lock:
+            return time.monotonic() - self.last_update
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "documents": self.documents,
+                "chunks": self.chunks,
+                "embedded": self.embedded,
+            }
+
+
+class _TrackingSplitter:
+    """Wraps a langchain splitter and reports every split document to an IndexProgress"""
+
+    def __init__(self, splitter, progress: IndexProgress):
+        self.splitter = splitter
+        self.progress = progress
+
+    def split_documents(self, documents):
+        chunks = self.splitter.split_documents(documents)
+        self.progress.record_document(len(chunks))
+        return chunks
+
+    # what pathway's VectorStoreServer.from_langchain_components calls
+    transform_documents = split_documents
+
+
+class _TrackingEmbeddings:
+    """Wraps a langchain embeddings model and reports every embedded chunk to an IndexProgress"""
+
+    def __init__(self, embeddings, progress: IndexProgress):
+        self.embeddings = embeddings
+        self.progress = progress
+
+    def embed_documents(self, texts):
+        vectors = self.embeddings.embed_documents(texts)
+        self.progress.record_embedded(len(texts))
+        return vectors
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        vectors = await self.embeddings.aembed_documents(texts)
+        self.progress.record_embedded(len(texts))
+        return vectors
+
+    async def aembed_query(self, text):
+        return await self.embeddings.aembed_query(text)
+
+
+def count_files(path: str) -> int:
+    """Number of files Pathway will pick up from the given directory (recursively)"""
+    if os.path.isfile(path):
+        return 1
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def collection_globpattern(path: str) -> str:
+    """Glob on the document path metadata that selects the files of one collection"""
+    name = os.path.basename(os.path.normpath(path))
+    return f"**/{name}" if os.path.isfile(path) else f"**/{name}/**"
+
+
+def collection_filter(path: str, filters: MetadataFilter = None) -> str:
+    """
+    jmespath metadata filter selecting the files of one collection, and the chunks matching `filters`.
+    langchain's PathwayVectorClient drops `filepath_globpattern`, the glob has to go through
+    `metadata_filter` like the server builds it.
+    """
+    parts = [f"globmatch(`{collection_globpattern(path)}`, path)"]
+    if filters:
+        parts.append(f"({filters.to_jmespath()})")
+    return " && ".join(parts)
+
+
 class PathwayVectorStore:
-    def __init__(self, name, path, port):
+    def __init__(self, collections, port, wait_ready=True, ready_timeout=300.0, poll_interval=1.0,
+                 embedding_cache=None, snapshot_dir=None, snapshot_collections=None):
         """
-        Initialize the Store with the docs from given path.
-        Parameters: 
-        name: name to give the database - eg. public
-        path: path to the directory containing the files to feed into db - eg. /data
+        Initialize the Store with the docs of several named collections, served by one
+        Pathway dataflow, one embedding model and one HTTP server.
+        Parameters:
+        collections: collection name -> path to the directory containing its files - eg. {"public": "./public_documents"}
         port: port to use for the vector store - eg. 8765
+        wait_ready: block until the initial index build has finished - eg. True
+        ready_timeout: max seconds to wait for the initial index build - eg. 300
+        poll_interval: seconds between readiness probes - eg. 1.0
+        embedding_cache: EmbeddingCache to use, a default on-disk one if None
+        snapshot_dir: directory for memory-mapped index snapshots, no snapshots if None - eg. .index_snapshots
+        snapshot_collections: collections to snapshot, all of them if None - eg. ["public"]
 
         """
-        self.name = name
-        self.path = path
+        self.collections = dict(collections)
         self.port = port
+        self.poll_interval = poll_interval
         self.vector_server = None
         self.client = None
+        self.async_client = None
+        self.progress = IndexProgress()
+        self.expected_files = {name: count_files(path) for name, path in self.collections.items()}
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.snapshots = {}
+        self._live = False
+        # collection -> (lexical index version, files of the live vector index, published version)
+        self._versions = {}
+        self._version_lock = threading.Lock()
+
+        # splitter to be used with VectorStore, the IPC is chunked per section
+        text_splitter = SectionAwareSplitter(
+            RecursiveCharacterTextSplitter(chunk_size=5000, chunk_overlap=10)
+        )
+        # BM25 indexes over the same chunks, for exact tokens like section numbers and party names
+        self.lexical_indexes = {
+            name: LexicalIndex(path, text_splitter, metadata={"corpus": name})
+            for name, path in self.collections.items()
+        }
 
         try:
-            self.data_sources = pw.io.fs.read(
-                path,
-                format="binary",
-                mode="streaming",
-                with_metadata=True,
-            )
+            # one model instance for all collections
+            embeddings_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+            # unchanged chunks are served from disk instead of being re-embedded on every boot
+            self.embeddings = CachedEmbeddings(embeddings_model, self.embedding_cache, EMBEDDING_MODEL)
 
-            # splitter to be used with VectorStore
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=5000, chunk_overlap=10)   
-           
-            embeddings_model = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/all-MiniLM-L6-v2"
-                # model_name = "law-ai/InLegalBERT"
-            )
+            # collections with an up to date snapshot are served from it until the live index is built
+            if snapshot_dir:
+                for name in snapshot_collections or self.collections:
+                    self.snapshots[name] = IndexSnapshot.load_or_build(
+                        os.path.join(snapshot_dir, name), self.collections[name],
+                        text_splitter, self.embeddings, EMBEDDING_MODEL, metadata={"corpus": name},
+                    )
 
-            print(f"\nmaking VectorStore: '{self.name}'... with docs {self.data_sources}\n")
+            self.data_sources = [
+                pw.io.fs.read(
+                    path,
+                    format="binary",
+                    mode="streaming",
+                    with_metadata=True,
+                )
+                for path in self.collections.values()
+            ]
+
+            print(f"\nmaking VectorStore with collections: {list(self.collections)}...\n")
             self.vector_server = VectorStoreServer.from_langchain_components(
-                self.data_sources,
-                splitter=text_splitter,
-                embedder=embeddings_model,
+                *self.data_sources,
+                splitter=_TrackingSplitter(text_splitter, self.progress),
+                embedder=_TrackingEmbeddings(self.embeddings, self.progress),
+                # every chunk is tagged with its collection, the splitter refines it to 'ipc' or 'kanoon'
+                doc_post_processors=[self._tag_corpus],
             )
 
-            # print(f"Starting VectorStoreServer: '{self.name}'...")
+            # print(f"Starting VectorStoreServer...")
             self.vector_server.run_server(
                 host="127.0.0.1",
                 port=port,
@@ -56,18 +209,90 @@ class PathwayVectorStore:
                 with_cache=False,
             )
 
-            time.sleep(30)
-            
             # making client using langchain's pathwayvectorclient..
             self.client = PathwayVectorClient(
                 host="127.0.0.1",
                 port=port,
-            )   
+            )
+            # pooled keep-alive client for the async agents, the blocking client above is kept for scripts
+            self.async_client = AsyncVectorStoreClient(host="127.0.0.1", port=port)
 
+            if wait_ready:
+                self.wait_until_ready(timeout=ready_timeout)
 
         except Exception as e:
             raise RuntimeError(f"Failed to initialize vector store: {str(e)}")
 
+    def _tag_corpus(self, text, metadata):
+        path = os.path.abspath(metadata.get("path", ""))
+        for name, collection_path in self.collections.items():
+            if fnmatch.fnmatch(path, collection_globpattern(collection_path)):
+                return text, {**metadata, "corpus": name}
+        return text, metadata
+
+    def _probe(self) -> bool:
+        """
+        Single readiness probe: the server answers and every file present at startup
+        has been split and all of its chunks embedded.
+        """
+        try:
+            stats = self.client.get_vectorstore_statistics()
+        except Exception:
+            return False  # server not accepting connections yet
+
+        progress = self.progress.snapshot()
+        return (
+            stats.get("file_count", 0) >= sum(self.expected_files.values())
+            and progress["documents"] >= sum(self.expected_files.values())
+            and progress["embedded"] >= progress["chunks"]
+            # the dataflow has gone quiet, no chunk is still on its way to the embedder
+            and self.progress.idle_for() >= self.poll_interval
+        )
+
+    def is_live(self) -> bool:
+        """Non-blocking check whether the initial build of the live Pathway index has finished"""
+        if not self._live:
+            self._live = self._probe()
+        return self._live
+
+    def is_ready(self) -> bool:
+        """Non-blocking check whether every collection can be queried, from the live index or a snapshot"""
+        return all(name in self.snapshots for name in self.collections) or self.is_live()
+
+    def wait_until_ready(self, timeout=300.0):
+        """
+        Poll the server until the initial index build finishes, or return right away if
+        every collection is served from a snapshot in the meantime.
+
+        Raises:
+        TimeoutError if the index is not ready within `timeout` seconds
+        """
+        started = time.monotonic()
+        while not self.is_ready():
+            if time.monotonic() - started > timeout:
+                raise TimeoutError(
+                    f"VectorStore not ready after {timeout}s, progress: {self.get_progress()}"
+                )
+            time.sleep(self.poll_interval)
+        print(f"VectorStore ready in {time.monotonic() - started:.1f}s: {self.get_progress()}")
+
+    def get_progress(self) -> dict:
+        """
+        Build progress of the index, for readiness endpoints.
+
+        Returns:
+        dict with ready flag, expected files per collection and documents/chunks ingested so far
+        """
+        return {
+            "collections": list(self.collections),
+            "ready": self.is_ready(),
+            "live": self.is_live(),
+            "expected_files": self.expected_files,
+            **self.progress.snapshot(),
+            "embedding_cache": self.embedding_cache.stats(),
+            "lexical_chunks": {name: len(index) for name, index in self.lexical_indexes.items()},
+            "snapshot_chunks": {name: len(snapshot) for name, snapshot in self.snapshots.items()},
+        }
 
     def get_client(self):
         """
@@ -77,13 +302,110 @@ class PathwayVectorStore:
         PathwayVectorClient
         """
         return self.client
-    
+
+    def similarity_search(self, collection, query, k=4, filters=None):
+        """
+        Top-k chunks of one collection by embedding similarity. Served by the live index once it is
+        built, by the collection's snapshot before that.
+
+        Parameters:
+        filters: MetadataFilter evaluated inside the index, only matching chunks compete for the top-k
+        """
+        if collection not in self.collections:
+            raise ValueError(f"Unknown collection '{collection}', expected one of {list(self.collections)}")
+        if collection in self.snapshots and not self.is_live():
+            return self.snapshots[collection].search(self.embeddings.embed_query(query), k, filters=filters)
+        return self.client.similarity_search(
+            query, k=k, metadata_filter=collection_filter(self.collections[collection], filters)
+        )
+
+    def _vector_files(self, collection):
+        """Files of the collection as the live vector index has ingested them, None before it is live"""
+        if not self.is_live():
+            return None
+        try:
+            files = self.client.get_input_files(metadata_filter=collection_filter(self.collections[collection]))
+        except Exception:
+            return None
+        return frozenset((entry.get("path"), entry.get("modified_at")) for entry in files)
+
+    def collection_version(self, collection) -> int:
+        """
+        Counter bumped whenever a file of the collection is added, changed or removed, once the
+        change has reached both the lexical index (within its refresh interval) and the live vector
+        index, so results cached under a version never predate it in either index. Also bumped
+        when the live index takes over from the snapshot.
+        """
+        index = self.lexical_indexes[collection]
+        index.refresh()
+        with self._version_lock:
+            lexical, vector_files, version = self._versions.get(collection, (index.version, None, 0))
+            if lexical == index.version and (vector_files is not None or not self.is_live()):
+                return version
+            current = self._vector_files(collection)
+            if current is not None and current != vector_files:
+                version += 1
+                self._versions[collection] = (index.version, current, version)
+            else:
+                # the vector index has not ingested the change yet, keep serving the current version
+                self._versions[collection] = (lexical, vector_files, version)
+            return version
+
+    async def asimilarity_search(self, collection, query, k=4, timeout=None, filters=None):
+        """
+        Async similarity_search over the pooled client, does not block the event loop.
+        Snapshot searches embed the query on a worker thread.
+
+        Parameters:
+        timeout: per-request timeout in seconds, the client default if None - eg. 10
+        """
+        if collection not in self.collections:
+            raise ValueError(f"Unknown collection '{collection}', expected one of {list(self.collections)}")
+        if collection in self.snapshots and not self._live:
+            # is_live() probes the server with the blocking client, keep it off the event loop
+            if not await asyncio.to_thread(self.is_live):
+                return await asyncio.wait_for(
+                    asyncio.to_thread(self.similarity_search, collection, query, k, filters), timeout
+                )
+        return await self.async_client.similarity_search(
+            query, k=k, filepath_globpattern=collection_globpattern(self.collections[collection]),
+            metadata_filter=filters.to_jmespath() if filters else None, timeout=timeout,
+        )
+
+    async def aclose(self):
+        """Close the pooled connections of the async client"""
+        if self.async_client is not None:
+            await self.async_client.close()
+
+    def as_retriever(self, collection, mode="vector", k=4):
+        """
+        get a retriever over one collection, routed by the document path inside the shared index.
+        Parameters:
+        collection: name of the collection - eg. public
+        mode: 'vector', 'lexical' (BM25) or 'hybrid' (both fused with reciprocal rank fusion)
+        k: number of chunks to return - eg. 4
+
+        Returns:
+        HybridRetriever
+        """
+        if collection not in self.collections:
+            raise ValueError(f"Unknown collection '{collection}', expected one of {list(self.collections)}")
+        return HybridRetriever(
+            lambda query, k, filters=None: self.similarity_search(collection, query, k, filters),
+            self.lexical_indexes[collection],
+            k=k,
+            mode=mode,
+            avector_search=lambda query, k, timeout=None, filters=None: self.asimilarity_search(
+                collection, query, k, timeout, filters
+            ),
+        )
 
 
 
 if __name__ == "__main__":    # example/test usage
-    public_db = PathwayVectorStore('xyztest', './public_documents', 8765)
+    db = PathwayVectorStore({'public': './public_documents', 'private': './private_documents'}, 8765)
+    print(db.get_progress())
     print('making a query')
-    result = public_db.get_client().as_retriever().invoke("IPC 345")
+    result = db.as_retriever('public', mode='hybrid').invoke("IPC 345")
     for entry in result:
         print(entry, "\n")
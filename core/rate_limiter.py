@@ -0,0 +1,261 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .context import count_tokens
+
+INTERACTIVE = 0  # a user is watching the trial
+BATCH = 1  # regression and demo runs, served when interactive trials leave quota
+
+# priority of the LLM calls made in this context, set per trial by the workflow
+_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+RATE_LIMIT_MARKERS = ("rate limit", "rate_limit", "429", "too many requests")
+RETRY_AFTER_RE = re.compile(r"try again in (?:(\d+)m)?(\d+(?:\.\d+)?)(ms|s)", re.IGNORECASE)
+
+
+@contextlib.contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """Schedule the LLM calls made in this context, and the tasks started from it, with `priority`"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return any(marker in str(error).lower() for marker in RATE_LIMIT_MARKERS)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked to wait, from messages like 'Please try again in 1m7.5s'"""
+    match = RETRY_AFTER_RE.search(str(error))
+    if not match:
+        return None
+    minutes, value, unit = match.groups()
+    seconds = float(value) / 1000 if unit.lower() == "ms" else float(value)
+    return int(minutes or 0) * 60 + seconds
+
+
+def usage_tokens(response) -> Optional[int]:
+    """Total tokens a response reports, None if the provider did not say"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("total_tokens"):
+        return usage["total_tokens"]
+    usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+class TokenBucket:
+    """Bucket of `capacity` units refilled continuously over `period` seconds"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # a request larger than the bucket waits for a full one instead of forever
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount  # may go negative, actual usage above the estimate is paid back by waiting
+
+    def drain(self, seconds: float, now: float):
+        """Empty the bucket for `seconds`, the provider told us to back off"""
+        self._refill(now)
+        self.level = min(self.level, -seconds * self.rate)
+
+
+class ModelQuota:
+    """Requests and tokens per minute left for one model, with the calls waiting for them"""
+
+    def __init__(self, rpm: float, tpm: float, period: float):
+        self.requests = TokenBucket(rpm, period)
+        self.tokens = TokenBucket(tpm, period)
+        self.waiters: List[Tuple[int, int, float, asyncio.Future]] = []  # heap of (priority, seq, tokens, future)
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.granted = 0
+        self.queued = 0
+        self.rerouted = 0
+        self.rate_limited = 0
+        self.wait_s = 0.0
+
+    def wait_time(self, tokens: float, now: float) -> float:
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def take(self, tokens: float, now: float):
+        self.requests.take(1, now)
+        self.tokens.take(tokens, now)
+        self.granted += 1
+
+
+class RateLimiter:
+    """
+    Local view of the requests-per-minute and tokens-per-minute quota of every model.
+
+    A call reserves one request and its estimated tokens (prompt plus expected completion) before
+    it is sent, the estimate is corrected with the usage the response reports. A call that does
+    not fit waits in a queue per model, interactive trials ahead of batch runs, or is rerouted by
+    the gateway to a model with quota left. A 429 empties the model's buckets for the time the
+    provider asked to wait. Models without a configured quota are not limited.
+    """
+
+    def __init__(self, quotas: Dict[str, Tuple[float, float]], period: float = 60.0,
+                 completion_tokens: int = 512, max_wait: float = 2.0):
+        """
+        Parameters:
+        quotas: requests and tokens per period per model name - eg. {"llama-3.1-8b-instant": (30, 20000)}
+        period: seconds the quotas are given for, shorter in simulations - eg. 60
+        completion_tokens: tokens expected in an answer, when the call sets no max_tokens - eg. 512
+        max_wait: seconds a call rather waits for its preferred model than is rerouted - eg. 2
+        """
+        self.quotas = {name: ModelQuota(rpm, tpm, period) for name, (rpm, tpm) in quotas.items()}
+        self.completion_tokens = completion_tokens
+        self.max_wait = max_wait
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def estimate(self, messages, max_tokens: Optional[int] = None) -> int:
+        """Tokens a call is expected to use, prompt and answer"""
+        if isinstance(messages, str):
+            messages = [{"content": messages}]
+        return count_tokens(messages) + (max_tokens or self.completion_tokens)
+
+    def wait_time(self, model: str, tokens: float) -> float:
+        quota = self.quotas.get(model)
+        if quota is None:
+            return 0.0
+        with self._lock:
+            # calls already queued go first
+            queued = sum(waiter[2] for waiter in quota.waiters if not waiter[3].done())
+            return quota.wait_time(tokens + queued, time.monotonic())
+
+    def overloaded(self, model: str, tokens: float) -> bool:
+        """True if a call to the model would wait for quota longer than `max_wait`, it should go elsewhere"""
+        return self.wait_time(model, tokens) > self.max_wait
+
+    def record_reroute(self, model: str):
+        quota = self.quotas.get(model)
+        if quota is not None:
+            with self._lock:
+                quota.rerouted += 1
+
+    def _grant(self, model: str):
+        """Let the queued calls of a model through, in priority order, as far as its quota allows"""
+        quota = self.quotas[model]
+        with self._lock:
+            if quota.timer is not None:
+                quota.timer.cancel()
+                quota.timer = None
+            now = time.monotonic()
+            while quota.waiters:
+                priority, seq, tokens, future = quota.waiters[0]
+                if future.done():  # cancelled or timed out
+                    heapq.heappop(quota.waiters)
+                    continue
+                wait = quota.wait_time(tokens, now)
+                if wait > 0:
+                    quota.timer = asyncio.get_running_loop().call_later(wait, self._grant, model)
+                    return
+                heapq.heappop(quota.waiters)
+                quota.take(tokens, now)
+                future.set_result(None)
+
+    async def acquire(self, model: str, tokens: float, priority: Optional[int] = None):
+        """Wait until `model` has quota for one call of `tokens` tokens"""
+        quota = self.quotas.get(model)
+        if quota is None:
+            return
+        priority = current_priority() if priority is None else priority
+        with self._lock:
+            now = time.monotonic()
+            if not any(not waiter[3].done() for waiter in quota.waiters) and quota.wait_time(tokens, now) == 0:
+                quota.take(tokens, now)
+                return
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(quota.waiters, (priority, next(self._seq), tokens, future))
+            quota.queued += 1
+        started = time.monotonic()
+        # the new call may have to go before the ones already waiting, re-plan the grants
+        self._grant(model)
+        try:
+            await future
+        finally:
+            if not future.done():
+                future.cancel()
+            with self._lock:
+                quota.wait_s += time.monotonic() - started
+
+    def acquire_blocking(self, model: str, tokens: float):
+        """Sync calls wait without a queue, they are not used for trials"""
+        quota = self.quotas.get(model)
+        if quota is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = quota.wait_time(tokens, now)
+                if wait == 0:
+                    quota.take(tokens, now)
+                    return
+            time.sleep(wait)
+
+    def record_usage(self, model: str, estimated: float, response):
+        """Correct the reserved tokens with the usage the response reports"""
+        quota = self.quotas.get(model)
+        actual = usage_tokens(response)
+        if quota is None or actual is None:
+            return
+        with self._lock:
+            quota.tokens.take(actual - estimated, time.monotonic())
+
+    def record_rate_limited(self, model: str, error: Exception):
+        """The provider refused a call, no more calls to the model until it said to retry"""
+        quota = self.quotas.get(model)
+        if quota is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # queued calls are granted again when the timer of the model fires
+            quota.requests.drain(retry_after(error) or 1.0, now)
+            quota.rate_limited += 1
+
+    def stats(self) -> dict:
+        """Quota left, calls queued and rerouted and 429s per model"""
+        with self._lock:
+            now = time.monotonic()
+            stats = {}
+            for name, quota in self.quotas.items():
+                quota.requests._refill(now)
+                quota.tokens._refill(now)
+                stats[name] = {
+                    "requests_left": round(quota.requests.level, 1),
+                    "tokens_left": round(quota.tokens.level),
+                    "granted": quota.granted,
+                    "queued": quota.queued,
+                    "waiting": sum(not waiter[3].done() for waiter in quota.waiters),
+                    "rerouted": quota.rerouted,
+                    "rate_limited": quota.rate_limited,
+                    "wait_s": round(quota.wait_s, 2),
+                }
+            return stats
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of a query, 'Section  499 ' and 'section 499' share an entry"""
+    return " ".join(query.lower().split())
+
+
+class RetrievalCache:
+    """
+    In-memory LRU cache of retrieval results with a time to live.
+
+    Every entry remembers the version of the collection it was retrieved from, a lookup with
+    a newer version (a document was added, changed or removed since) is a miss and drops the entry.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 900.0):
+        """
+        Parameters:
+        max_entries: max number of cached results - eg. 1024
+        ttl: seconds a result is served from the cache - eg. 900
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, float, List[Document]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[List[Document]]:
+        """Cached result for `key` retrieved at collection `version`, None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, stored_at, documents = entry
+                if entry_version != version:
+                    self.invalidations += 1
+                    entry = None
+                elif time.monotonic() - stored_at > self.ttl:
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    del self._entries[key]
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(documents)
+
+    def put(self, key: Hashable, version: Hashable, documents: List[Document]):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), list(documents))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+class SqliteLRU:
+    """
+    sqlite table of cache entries, keyed by a text key and bounded to `max_entries`: the least
+    recently used entries are evicted first.
+
+    Reads do not write: the entries they used are touched in memory, the touches are written with
+    the next put, or every `touch_batch` reads. The eviction order lags by at most that many reads.
+    Thread-safe, callers run it from worker threads.
+    """
+
+    def __init__(self, path: str, table: str, columns: Sequence[str], index: str, max_entries: int,
+                 touch_batch: int = 256):
+        """
+        Parameters:
+        path: sqlite file - eg. .embedding_cache/embeddings.sqlite
+        table: table of the entries - eg. embeddings
+        columns: definitions of the value columns, besides key and last_used - eg. ["vector BLOB NOT NULL"]
+        index: name of the index on last_used - eg. idx_last_used
+        max_entries: max number of entries kept - eg. 200000
+        touch_batch: reads whose touches are buffered before they are written - eg. 256
+        """
+        self.path = path
+        self.table = table
+        self.columns = [column.split()[0] for column in columns]
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.evictions = 0
+        self._touched: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, {', '.join(columns)}, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table}(last_used)")
+        self._conn.commit()
+
+    def get(self, keys: Iterable[str]) -> Dict[str, tuple]:
+        """Values (in column order) of the keys found, touched as used"""
+        with self._lock:
+            found = {}
+            for key in set(keys):
+                row = self._conn.execute(
+                    f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    found[key] = row
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if len(self._touched) >= self.touch_batch:
+                self._flush_touched()
+                self._conn.commit()
+            return found
+
+    def put(self, rows: List[Tuple]):
+        """Insert or replace entries, (key, *values in column order), and evict over `max_entries`"""
+        now = time.time()
+        placeholders = ", ".join("?" * (len(self.columns) + 2))
+        with self._lock:
+            self._flush_touched()
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self.columns)}, last_used)"
+                f" VALUES ({placeholders})",
+                [(*row, now) for row in rows],
+            )
+            overflow = self._count() - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def delete(self, keys: Iterable[str]):
+        with self._lock:
+            keys = list(keys)
+            for key in keys:
+                self._touched.pop(key, None)
+            self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(key,) for key in keys])
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _count(self) -> int:
+        return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
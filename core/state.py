@@ -8,4 +8,11 @@ class AgentState(MessagesState):
     """State for each agent node in the graph"""
     next: str  # Where to route to next
     thought_step: Optional[int] = 0  # Current step in chain of thought
-    caller: Optional[str] = None  # Who called the agent
\ No newline at end of file
+    caller: Optional[str] = None  # Who called the agent
+    summary: Optional[str] = None  # Running summary of the transcript, see core.context.ContextCompactor
+    summarized: Optional[int] = 0  # Number of leading messages covered by the summary
+    context_stats: Optional[dict] = None  # Estimated prompt tokens sent and saved, per agent
+    parallel_research: Optional[bool] = False  # Retriever and web searcher asked at once, see TrialWorkflow
+    research: Optional[dict] = None  # Requests of the current research fan-out, see agents.base.ResearchRequests
+    judge_mode: Optional[str] = None  # 'stepwise' or 'fused', overrides the JudgeAgent's mode for a trial
+    judge_stats: Optional[dict] = None  # Calls, tokens and latency of the judge per mode, see agents.judge.judge_report
\ No newline at end of file
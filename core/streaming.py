@@ -0,0 +1,48 @@
+import contextlib
+import contextvars
+from typing import Callable, Iterator, Optional
+
+from .events import event
+
+# receives the token events of the LLM calls made in this context, set per trial by the workflow
+_sink: contextvars.ContextVar[Optional[Callable[[dict], None]]] = contextvars.ContextVar("token_sink", default=None)
+# graph node and thought step the LLM calls are made for, set by the node wrappers
+_scope = contextvars.ContextVar("token_scope", default={})
+
+
+@contextlib.contextmanager
+def token_stream(sink: Optional[Callable[[dict], None]]) -> Iterator[None]:
+    """Send the token deltas of the LLM calls made in this context, and the tasks started from it, to `sink`"""
+    token = _sink.set(sink)
+    try:
+        yield
+    finally:
+        _sink.reset(token)
+
+
+@contextlib.contextmanager
+def token_scope(node: str, thought_step: Optional[int] = None) -> Iterator[None]:
+    """Label the token events emitted in this context with the agent node and its thought step"""
+    token = _scope.set({"node": node, "thought_step": thought_step})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def streaming() -> bool:
+    return _sink.get() is not None
+
+
+def emit_token(delta: str):
+    """Token delta of the running LLM call, nothing happens outside a token_stream"""
+    sink = _sink.get()
+    if sink is not None and delta:
+        sink(event("token", None, **_scope.get(), delta=delta))
+
+
+def emit_reset():
+    """The running LLM call failed after streaming some tokens, a fallback model starts the answer over"""
+    sink = _sink.get()
+    if sink is not None:
+        sink(event("token_reset", None, **_scope.get()))
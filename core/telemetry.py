@@ -0,0 +1,223 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+from .context import count_tokens, estimate_tokens
+
+# span kinds: graph nodes, and what they wait on
+NODE = "node"
+LLM = "llm"
+VECTOR_QUERY = "vector_query"
+KANOON = "kanoon"
+WEB_SEARCH = "web_search"
+
+# upper bounds in seconds of the span duration histogram, LLM calls and searches take seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# trace of the trial the spans of this context belong to, set per trial session by the workflow
+_trace = contextvars.ContextVar("trial_trace", default=None)
+
+
+def token_usage(response, messages=None) -> Tuple[int, int, bool]:
+    """Prompt and completion tokens of a response, estimated from the text when the provider did not say"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("input_tokens") is not None:
+        return usage["input_tokens"], usage.get("output_tokens", 0), True
+    usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        return usage["prompt_tokens"], usage.get("completion_tokens", 0), True
+    prompt = count_tokens(messages) if messages and not isinstance(messages, str) else estimate_tokens(messages or "")
+    return prompt, estimate_tokens(getattr(response, "content", "")), False
+
+
+class TrialTrace:
+    """Where the time of one trial goes: per node, per kind of span and per model"""
+
+    def __init__(self):
+        self.started: Optional[float] = None  # of the stream of the trial running, None while it is parked
+        self.wall_s = 0.0  # of the finished streams of the trial
+        self.nodes: Dict[str, dict] = {}
+        self.spans: Dict[str, dict] = {}
+        self.models: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, name: str, seconds: float, attrs: dict):
+        with self._lock:
+            if kind == NODE:
+                node = self.nodes.setdefault(name, {"calls": 0, "seconds": 0.0})
+                node["calls"] += 1
+                node["seconds"] += seconds
+                return
+            totals = self.spans.setdefault(kind, {"calls": 0, "seconds": 0.0, "errors": 0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["errors"] += attrs.get("outcome") == "error"
+            totals["bytes"] += attrs.get("bytes", 0)
+            if kind == LLM:
+                model = self.models.setdefault(name, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0,
+                                                      "completion_tokens": 0, "fallbacks": 0, "cached": 0,
+                                                      "errors": 0, "cost_usd": 0.0})
+                model["calls"] += 1
+                model["seconds"] += seconds
+                model["prompt_tokens"] += attrs.get("prompt_tokens", 0)
+                model["completion_tokens"] += attrs.get("completion_tokens", 0)
+                model["fallbacks"] += attrs.get("fallback", 0) > 0
+                model["cached"] += attrs.get("outcome") == "cached"
+                model["errors"] += attrs.get("outcome") == "error"
+                model["cost_usd"] += attrs.get("cost_usd", 0.0)
+
+    def pause(self):
+        """End of a stream of the trial, the time it waits for feedback does not count"""
+        if self.started is not None:
+            self.wall_s += time.monotonic() - self.started
+            self.started = None
+
+    def resume(self):
+        self.started = time.monotonic()
+
+    def report(self) -> dict:
+        def rounded(values: dict) -> dict:
+            return {key: round(value, 3) if isinstance(value, float) else value for key, value in values.items()}
+
+        running = time.monotonic() - self.started if self.started is not None else 0.0
+        with self._lock:
+            return {
+                "wall_s": round(self.wall_s + running, 3),
+                "nodes": {name: rounded(values) for name, values in self.nodes.items()},
+                "spans": {kind: rounded(values) for kind, values in self.spans.items()},
+                "llm": {name: rounded(values) for name, values in self.models.items()},
+            }
+
+
+class MetricsRegistry:
+    """Aggregates of all spans of the process, exported in the Prometheus text format"""
+
+    def __init__(self, prefix: str = "pathrag"):
+        self.prefix = prefix
+        # $ per million prompt and completion tokens by model, calls to other models cost nothing
+        self.prices: Dict[str, Tuple[float, float]] = {}
+        self.histograms: Dict[Tuple[str, str], list] = {}  # (kind, name) -> [bucket counts..., sum, count]
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    def set_prices(self, prices: Dict[str, Tuple[float, float]]):
+        self.prices = dict(prices)
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+    def _count(self, metric: str, value: float = 1, **labels: str):
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, kind: str, name: str, seconds: float, attrs: dict):
+        with self._lock:
+            # a count per bucket and +Inf, then the sum and the count
+            histogram = self.histograms.setdefault((kind, name), [0] * (len(BUCKETS) + 3))
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            if attrs.get("outcome") == "error":
+                self._count("span_errors_total", kind=kind, name=name)
+            if attrs.get("bytes"):
+                self._count("retrieved_bytes_total", attrs["bytes"], kind=kind)
+            if kind == LLM:
+                self._count("llm_calls_total", model=name, fallback=str(attrs.get("fallback", 0)),
+                            outcome=attrs.get("outcome", "ok"))
+                self._count("llm_tokens_total", attrs.get("prompt_tokens", 0), model=name, type="prompt")
+                self._count("llm_tokens_total", attrs.get("completion_tokens", 0), model=name, type="completion")
+                if attrs.get("cost_usd"):
+                    self._count("llm_cost_usd_total", attrs["cost_usd"], model=name)
+
+    def render(self, extra: Optional[Dict[str, Tuple[str, str, Dict[str, float]]]] = None) -> str:
+        """
+        Prometheus exposition text.
+
+        Parameters:
+        extra: metrics read at scrape time, name -> (type, help, {label value of 'state': value})
+            - eg. {"trials": ("gauge", "Trials by state", {"running": 2, "queued": 0})}
+        """
+        p = self.prefix
+        lines = [f"# HELP {p}_span_seconds Duration of graph nodes, LLM calls, vector queries, Kanoon calls and web searches",
+                 f"# TYPE {p}_span_seconds histogram"]
+        with self._lock:
+            for (kind, name), histogram in sorted(self.histograms.items()):
+                labels = f'kind="{_escape(kind)}",name="{_escape(name)}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{p}_span_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{p}_span_seconds_sum{{{labels}}} {histogram[-2]:.6f}")
+                lines.append(f"{p}_span_seconds_count{{{labels}}} {histogram[-1]}")
+            helps = {
+                "span_errors_total": "Spans that ended in an error",
+                "retrieved_bytes_total": "Bytes of documents and search results retrieved",
+                "llm_calls_total": "LLM calls by model, position in the fallback order and outcome",
+                "llm_tokens_total": "Prompt and completion tokens by model, estimated when not reported",
+                "llm_cost_usd_total": "Cost of the LLM calls in USD, for the models with a configured price",
+            }
+            for metric, help_text in helps.items():
+                samples = [(labels, value) for (name, labels), value in sorted(self.counters.items()) if name == metric]
+                if not samples:
+                    continue
+                lines += [f"# HELP {p}_{metric} {help_text}", f"# TYPE {p}_{metric} counter"]
+                for labels, value in samples:
+                    rendered = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels)
+                    lines.append(f"{p}_{metric}{{{rendered}}} {value:g}")
+        for metric, (type_, help_text, values) in (extra or {}).items():
+            lines += [f"# HELP {p}_{metric} {help_text}", f"# TYPE {p}_{metric} {type_}"]
+            lines += [f'{p}_{metric}{{state="{_escape(state)}"}} {value:g}' for state, value in values.items()]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def trial_trace(trace: TrialTrace) -> Iterator[TrialTrace]:
+    """Add the spans of this context, and of the tasks and threads started from it, to `trace`"""
+    token = _trace.set(trace)
+    trace.resume()
+    try:
+        yield trace
+    finally:
+        trace.pause()
+        _trace.reset(token)
+
+
+def record(kind: str, name: str, seconds: float, **attrs):
+    """
+    A finished span, to the process metrics and to the trace of the current trial.
+
+    attrs: outcome (ok, error, cached, rate_limited), bytes retrieved, and for LLM calls
+    fallback (0 for the first model tried), prompt_tokens and completion_tokens.
+    """
+    if kind == LLM and "cost_usd" not in attrs:
+        attrs["cost_usd"] = METRICS.cost(name, attrs.get("prompt_tokens", 0), attrs.get("completion_tokens", 0))
+    METRICS.add(kind, name, seconds, attrs)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(kind, name, seconds, attrs)
+
+
+@contextlib.contextmanager
+def span(kind: str, name: str, **attrs) -> Iterator[dict]:
+    """Time the block as a span, the attributes yielded can be completed in it (bytes, outcome)"""
+    started = time.monotonic()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["outcome"] = "error" if isinstance(e, Exception) else "cancelled"
+        raise
+    finally:
+        attrs.setdefault("outcome", "ok")
+        record(kind, name, time.monotonic() - started, **attrs)
@@ -1,13 +1,26 @@
-from typing import Dict, Any, List, Optional, TypedDict, Literal
+from typing import Dict, Any, List, Optional, Tuple, TypedDict, Literal
+import asyncio
+import contextlib
 from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage, AIMessage
 from pydantic import BaseModel
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.base import BaseCheckpointSaver
 import os
 import json
+import time
+import uuid
+import weakref
 
 from agents import LawyerAgent, ProsecutorAgent, JudgeAgent, RetrieverAgent, FetchingAgent, WebSearcherAgent
 from agents import AgentState
+from agents.judge import judge_report
+from .llm_cache import bypass_llm_cache
+from .context import context_report
+from .streaming import token_scope, token_stream
+from .rate_limiter import INTERACTIVE, request_priority
+from .checkpoint import SqliteDeltaSaver
+from .events import event as stream_event, step_events
+from .telemetry import NODE, TrialTrace, span, trial_trace
 
 class TrialWorkflow:
     """
@@ -23,7 +36,10 @@ class TrialWorkflow:
         judge: JudgeAgent,
         retriever: RetrieverAgent,
         kanoon_fetcher: FetchingAgent,
-        web_searcher: WebSearcherAgent
+        web_searcher: WebSearcherAgent,
+        parallel_research: bool = False,
+        max_sessions: int = 4,
+        checkpointer: Optional[BaseCheckpointSaver] = None
     ):
         """
         Initialize the trial workflow with required agents.
@@ -35,6 +51,10 @@ class TrialWorkflow:
             retriever: Agent for retrieving relevant legal information
             kanoon_fetcher: Agent for fetching case-specific data
             web_searcher: Agent for web searches
+            parallel_research: Ask the retriever and the web searcher in one planning step and run
+                them concurrently, instead of retrieving first and deciding on a web search after
+            max_sessions: Trials run concurrently, the next ones wait for one to finish
+            checkpointer: Store of the trials' checkpoints, a SqliteDeltaSaver in .checkpoints if None
         """
         self.lawyer = lawyer
         self.prosecutor = prosecutor
@@ -42,7 +62,13 @@ class TrialWorkflow:
         self.retriever = retriever
         self.kanoon_fetcher = kanoon_fetcher
         self.web_searcher = web_searcher
-        self.memory = MemorySaver()  # For checkpointing workflow state
+        self.parallel_research = parallel_research
+        self.max_sessions = max_sessions
+        self._session_slots = asyncio.Semaphore(max_sessions)
+        self.sessions: Dict[str, dict] = {}  # trials running or waiting for a slot, by session id
+        self._traces: Dict[str, Tuple[float, TrialTrace]] = {}  # (parked at, timing) of the parked trials, continued when resumed
+        self.session_stats = {"completed": 0, "parked": 0, "resumed": 0, "cancelled": 0, "failed": 0}
+        self.memory = checkpointer or SqliteDeltaSaver()  # For checkpointing workflow state, one thread per trial
         self.graph = self._create_graph()
     
     def _create_graph(self) -> StateGraph:
@@ -61,6 +87,14 @@ class TrialWorkflow:
         workflow.add_node("retriever", self._retriever_node)
         workflow.add_node("web_searcher", self._web_search_node)
         workflow.add_node("user_feedback", self._user_feedback_node)
+        # research fan-out: both nodes run in the same step, the join waits for both
+        research_routes = {}
+        if self.parallel_research:
+            workflow.add_node("research_retriever", self._research_retriever_node)
+            workflow.add_node("research_web_searcher", self._research_web_search_node)
+            workflow.add_node("research_join", self._research_join_node)
+            workflow.add_edge(["research_retriever", "research_web_searcher"], "research_join")
+            research_routes = {"research_retriever": "research_retriever", "research_web_searcher": "research_web_searcher"}
         
         # Define initial workflow path
         workflow.add_edge(START, "kanoon_fetcher")
@@ -78,7 +112,8 @@ class TrialWorkflow:
                 "retriever": "retriever",
                 "self": "judge",
                 "web_searcher": "web_searcher",
-                "END": END
+                "END": END,
+                **research_routes
             }
         )
         
@@ -91,7 +126,8 @@ class TrialWorkflow:
                 "retriever": "retriever",
                 "web_searcher": "web_searcher",
                 "user_feedback": "user_feedback",
-                "self": "lawyer"  # For chain of thought reasoning
+                "self": "lawyer",  # For chain of thought reasoning
+                **research_routes
             }
         )
         
@@ -103,7 +139,8 @@ class TrialWorkflow:
                 "judge": "judge",
                 "retriever": "retriever",
                 "web_searcher": "web_searcher",
-                "self": "prosecutor"  # For chain of thought reasoning
+                "self": "prosecutor",  # For chain of thought reasoning
+                **research_routes
             }
         )
         
@@ -128,112 +165,361 @@ class TrialWorkflow:
                 "prosecutor": "prosecutor"
             }
         )
+
+        # Joined research routes back to calling agent
+        if self.parallel_research:
+            workflow.add_conditional_edges(
+                "research_join",
+                self._route_from_retriever,
+                {
+                    "judge": "judge",
+                    "lawyer": "lawyer",
+                    "prosecutor": "prosecutor"
+                }
+            )
         
         return workflow.compile(checkpointer=self.memory, interrupt_before=["user_feedback"])
     
+    @contextlib.contextmanager
+    def _node_scope(self, node: str, state: AgentState, agent: Optional[str] = None):
+        """Label the token events of the node with its agent, and time the node as a span"""
+        with token_scope(agent or node, state.get("thought_step")), span(NODE, node):
+            yield
+
     # Agent node processing methods
     async def _kanoon_fetcher_node(self, state: AgentState) -> AgentState:
         """Kanoon Fetcher node processing"""
-        return await self.kanoon_fetcher.process(state)
+        with self._node_scope("kanoon_fetcher", state):
+            return await self.kanoon_fetcher.process(state)
     
     async def _judge_node(self, state: AgentState) -> AgentState:
         """Judge node processing"""
         # print(f"Judge node processing with state: {state}")
-        return await self.judge.process(state)
+        with self._node_scope("judge", state):
+            return await self.judge.process(state)
     
     async def _lawyer_node(self, state: AgentState) -> AgentState:
         """Lawyer node processing"""
         # print(f"Lawyer node processing with state: {state}")
-        return await self.lawyer.process(state)
+        with self._node_scope("lawyer", state):
+            return await self.lawyer.process(state)
     
     async def _prosecutor_node(self, state: AgentState) -> AgentState:
         """Prosecutor node processing"""
         # print(f"Prosecutor node processing with state: {state}")
-        return await self.prosecutor.process(state)
+        with self._node_scope("prosecutor", state):
+            return await self.prosecutor.process(state)
     
     async def _retriever_node(self, state: AgentState) -> AgentState:
         """Retriever node processing"""
         # print(f"Retriever node processing with state: {state}")
-        return await self.retriever.process(state)
+        with self._node_scope("retriever", state):
+            return await self.retriever.process(state)
     
     async def _web_search_node(self, state: AgentState) -> AgentState:
         """Web Search node processing"""
         # print(f"Web Search node processing with state: {state}")
-        return await self.web_searcher.process(state)
+        with self._node_scope("web_searcher", state):
+            return await self.web_searcher.process(state)
     
+    async def _research_retriever_node(self, state: AgentState) -> AgentState:
+        """Retriever branch of the research fan-out, answers the legal request only"""
+        request = (state.get("research") or {}).get("legal_request", "none")
+        if request.strip().lower().startswith("none"):
+            return {}
+        messages = state["messages"][:-1] + [HumanMessage(content=request, name=state["caller"])]
+        with self._node_scope("research_retriever", state, agent="retriever"):
+            update = await self.retriever.process({**state, "messages": messages})
+        # routing is left to the join, both branches write in the same step
+        return {key: value for key, value in update.items() if key not in ("next", "thought_step", "caller")}
+
+    async def _research_web_search_node(self, state: AgentState) -> AgentState:
+        """Web searcher branch of the research fan-out, answers the web request only"""
+        request = (state.get("research") or {}).get("web_request", "none")
+        if request.strip().lower().startswith("none"):
+            return {}
+        with self._node_scope("research_web_searcher", state, agent="web_searcher"):
+            update = await self.web_searcher.process({**state, "messages": [HumanMessage(content=request)]})
+        return {"messages": update["messages"]}
+
+    async def _research_join_node(self, state: AgentState) -> AgentState:
+        """Both research branches are done, back to the agent that asked"""
+        return {"next": state["caller"], "research": None}
+
     async def _user_feedback_node(self, state: AgentState) -> AgentState:
         """User feedback node processing"""
         # print(f"User feedback node processing with state: {state}")
         pass
     
     # Routing logic methods
-    def _route_from_judge(self, state: AgentState) -> str:
+    def _route_from_judge(self, state: AgentState):
         """Determine next agent based on judge's decision"""
-        return state["next"]
+        return self._fan_out(state)
     
-    def _route_from_agent(self, state: AgentState) -> str:
+    def _route_from_agent(self, state: AgentState):
         """Determine next step from lawyer or prosecutor actions"""
+        return self._fan_out(state)
+
+    def _fan_out(self, state: AgentState):
+        """Both research branches for a research request, they run concurrently"""
+        if state["next"] == "research":
+            return ["research_retriever", "research_web_searcher"]
         return state["next"]
     
     def _route_from_retriever(self, state: AgentState) -> str:
         """Route back to the agent that called the retriever"""
         return state["next"]
     
-    async def run(self, user_prompt: str):
+    async def _astream(self, input, thread):
+        """
+        Graph updates as ("state", update), with the token events of the agents' LLM calls
+        interleaved as ("token", event) while they are generated, see core.streaming.
+        """
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for state in self.graph.astream(input, thread):
+                    queue.put_nowait(("state", state))
+            finally:
+                queue.put_nowait(("end", None))
+
+        # the graph task inherits the sink, the agents' LLM calls stream into this queue
+        with token_stream(lambda event: queue.put_nowait(("token", event))):
+            task = asyncio.create_task(pump())
+        try:
+            while True:
+                kind, item = await queue.get()
+                if kind == "end":
+                    break
+                yield kind, item
+            await task  # raise what the graph raised
+        finally:
+            if not task.done():
+                # the trial was closed, wait for the running node to stop before its checkpoints are dropped
+                task.cancel()
+                await asyncio.wait([task])
+
+    async def run(self, user_prompt: str, use_cache: bool = True, priority: int = INTERACTIVE,
+                  judge_mode: Optional[str] = None, session_id: Optional[str] = None):
         """
         Run the trial workflow as an async generator.
-        Handles the main execution loop including user feedback.
+        Streams the trial until the lawyer asks for user feedback or the judge ends it.
         
+        Every trial is its own checkpoint thread, at most `max_sessions` run at once, the others
+        wait for a slot. Closing the generator (the client went away) cancels the trial. A trial
+        waiting for feedback ends its stream with an 'awaiting_feedback' event and is parked in
+        the checkpoint store, holding no slot, until resume() is called with the feedback.
+
         Args:
             user_prompt: Initial prompt to start the trial
+            use_cache: Serve repeated LLM calls from the gateway's response cache, False to always call the models
+            priority: INTERACTIVE, or BATCH for runs nobody watches, their LLM calls wait when quota is short
+            judge_mode: 'stepwise' or 'fused' judge turns for this trial, the judge's own mode if None
+            session_id: Checkpoint thread of the trial, a new one if None
         """
+        session_id = session_id or uuid.uuid4().hex
         # Set up initial state
         initial_state = AgentState(
             messages=[HumanMessage(content=user_prompt)],
             next="kanoon_fetcher",
             thought_step=0,
+            parallel_research=self.parallel_research,
+            judge_mode=judge_mode,
         )
 
         print(f"Initial state: {initial_state}")
 
-        thread = {"configurable": {"thread_id": "1"}}
+        # closed with the trial, not when garbage collected
+        async with contextlib.aclosing(self._session(session_id, initial_state, use_cache, priority)) as events:
+            async for event in events:
+                yield event
 
-        yield {
-            "status": "progress",
-            "content": "Initializing workflow...",
-        }
+    async def resume(self, session_id: str, feedback: str, use_cache: bool = True, priority: int = INTERACTIVE):
+        """
+        Continue a parked trial with the user's feedback, the lawyer refines its argument with it.
+        Returns an async generator streaming like run() until the next feedback request or the end
+        of the trial. The trial is reserved before this returns, a concurrent resume of it is
+        refused. A resumed trial that is cancelled or fails is parked again at the same request.
 
-        # Stream initial workflow states
-        async for state in self.graph.astream(initial_state, thread):
-            print(state)
-            print("-" * 100)
-            yield {
-                "status": "progress",
-                "content": repr(state)
-            }
+        Args:
+            session_id: Trial parked by run() or a previous resume()
+            feedback: User feedback on the lawyer's argument
+            use_cache: Serve repeated LLM calls from the gateway's response cache, False to always call the models
+            priority: INTERACTIVE, or BATCH for runs nobody watches, their LLM calls wait when quota is short
 
-        # Simulate user feedback loop
-        user_input = "argument is not strong"
+        Raises:
+            ValueError: the trial is already running, or is not waiting for feedback
+        """
+        if session_id in self.sessions:
+            raise ValueError(f"Trial {session_id} is already running")
+        session = self.sessions[session_id] = {"status": "reserved", "created": time.time()}
+        try:
+            snapshot = await self.graph.aget_state({"configurable": {"thread_id": session_id}})
+        except BaseException:
+            self._unreserve(session_id, session)
+            raise
+        if snapshot.next != ("user_feedback",):
+            self._unreserve(session_id, session)
+            raise ValueError(f"Trial {session_id} is not waiting for feedback")
+        events = self._session(session_id, None, use_cache, priority, feedback=feedback, session=session,
+                               parked_at=snapshot.config["configurable"]["checkpoint_id"])
+        # a stream dropped before it started never runs its cleanup, the reservation goes with it
+        weakref.finalize(events, self._unreserve, session_id, session)
+        return events
+
+    def _unreserve(self, session_id: str, session: dict):
+        if self.sessions.get(session_id) is session and session["status"] == "reserved":
+            del self.sessions[session_id]
+
+    async def awaiting_feedback(self, session_id: str) -> bool:
+        """True if the trial is parked, interrupted before user_feedback and not being streamed"""
+        if session_id in self.sessions:
+            return False
+        snapshot = await self.graph.aget_state({"configurable": {"thread_id": session_id}})
+        return snapshot.next == ("user_feedback",)
+
+    async def _session(self, session_id: str, graph_input, use_cache: bool, priority: int,
+                       feedback: Optional[str] = None, session: Optional[dict] = None,
+                       parked_at: Optional[str] = None):
+        """
+        Stream the graph of one trial in a session slot, from `graph_input` or its checkpoint if None.
+        `session` is the entry reserved by resume(), `parked_at` the checkpoint the trial was parked at.
+        """
+        if session is None:
+            if session_id in self.sessions:
+                raise ValueError(f"Trial {session_id} is already running")
+            session = self.sessions[session_id] = {"created": time.time()}
+        session["status"] = "queued"
+        parked = self._traces.pop(session_id, None)
+        trace = parked[1] if parked else TrialTrace()
+        if feedback is not None:
+            # applied once the trial is registered, a concurrent resume of it is refused
+            try:
+                # Process user feedback, the graph resumes after the user_feedback node
+                await self.graph.aupdate_state(
+                    {"configurable": {"thread_id": session_id}},
+                    values={"messages": [HumanMessage(content=feedback, name="user")]},
+                    as_node="user_feedback",
+                )
+            except BaseException:
+                self._traces[session_id] = parked or (time.time(), trace)
+                del self.sessions[session_id]
+                raise
+            self.session_stats["resumed"] += 1
+        try:
+            if self._session_slots.locked():
+                yield stream_event("queued", session_id, content="Waiting for a free trial slot...")
+            async with self._session_slots:
+                session.update(status="running", started=time.time())
+                # the agents run in tasks started from here, they inherit the cache and priority flags of this session
+                # the spans of the agents' nodes and calls go to the trace of this trial
+                with bypass_llm_cache(not use_cache), request_priority(priority), trial_trace(trace):
+                    async with contextlib.aclosing(self._run(graph_input, session_id, trace)) as events:
+                        async for event in events:
+                            if event["type"] in ("done", "awaiting_feedback"):
+                                session["status"] = event["type"]
+                            yield event
+            if session["status"] == "done":
+                self.session_stats["completed"] += 1
+            else:
+                self.session_stats["parked"] += 1
+        except (asyncio.CancelledError, GeneratorExit):
+            # the client went away, the running node is cancelled with it
+            self.session_stats["cancelled"] += 1
+            print(f"Trial {session_id} cancelled")
+            raise
+        except Exception:
+            self.session_stats["failed"] += 1
+            raise
+        finally:
+            try:
+                # sqlite work, on a worker thread like the checkpointer's own async methods
+                if session["status"] == "done" and hasattr(self.memory, "compact"):
+                    # the final state of the trial is kept, its intermediate steps are not read again
+                    await asyncio.to_thread(self.memory.compact, session_id)
+                elif session["status"] == "awaiting_feedback":
+                    self._traces[session_id] = (time.time(), trace)
+                    if hasattr(self.memory, "release"):
+                        # parked in the store, nothing of the trial is kept in memory until it is resumed
+                        await asyncio.to_thread(self.memory.release, session_id)
+                elif parked_at is not None:
+                    # the feedback and the steps after it are dropped, the user can send it again;
+                    # a checkpointer that cannot rewind keeps the trial where it stopped
+                    self._traces[session_id] = (time.time(), trace)
+                    if hasattr(self.memory, "rewind"):
+                        await asyncio.to_thread(self.memory.rewind, session_id, parked_at)
+                        print(f"Trial {session_id} parked again for feedback")
+                else:
+                    await asyncio.to_thread(self.memory.delete_thread, session_id)
+            finally:
+                # unregistered once the store is settled, a resume does not see a half-deleted trial
+                del self.sessions[session_id]
+
+    async def prune_idle(self, max_idle: float) -> int:
+        """
+        Drop the trials parked for feedback for more than `max_idle` seconds, from the checkpoint
+        store and with their timing. Returns the number of trials pruned from the store.
+        """
+        pruned = await asyncio.to_thread(self.memory.prune_idle, max_idle) if hasattr(self.memory, "prune_idle") else 0
+        idle_since = time.time() - max_idle
+        for session_id in [session_id for session_id, (parked, _) in self._traces.items()
+                           if parked < idle_since and session_id not in self.sessions]:
+            del self._traces[session_id]
+        return pruned
+
+    def session_report(self) -> dict:
+        """Trials running and waiting for a slot, and the outcome of the finished ones"""
+        now = time.time()
+        return {
+            "max_sessions": self.max_sessions,
+            "running": sum(session["status"] == "running" for session in self.sessions.values()),
+            "queued": sum(session["status"] == "queued" for session in self.sessions.values()),
+            **self.session_stats,
+            "sessions": {
+                session_id: {"status": session["status"], "age_s": round(now - session["created"], 1)}
+                for session_id, session in self.sessions.items()
+            },
+        }
 
-        while True:
-            # Process user feedback
-            self.graph.update_state(values={"user_feedback": user_input}, as_node="user_feedback")
+    async def _run(self, graph_input, session_id: str, trace: TrialTrace):
+        thread = {"configurable": {"thread_id": session_id}}
+
+        yield stream_event(
+            "started", session_id,
+            content="Initializing workflow..." if graph_input is not None else "Resuming with user feedback...",
+        )
 
-            async for state in self.graph.astream(None, thread):
+        async with contextlib.aclosing(self._astream(graph_input, thread)) as updates:
+            async for kind, state in updates:
+                if kind == "token":
+                    yield {**state, "session_id": session_id}
+                    continue
                 print(state)
                 print("-" * 100)
-                yield {
-                    "status": "progress",
-                    "content": repr(state)
-                }
-                
-            # Check for workflow completion
-            try:
-                if state.judge.next == 'END':
-                    yield {"status": "done", "content": "Workflow completed successfully"}
-                    break
-            except AttributeError:
-                pass
+                # what each node added, not its whole output
+                for event in step_events(session_id, state):
+                    yield event
+
+        # Check for workflow completion: the graph stopped without a node left to run
+        snapshot = await self.graph.aget_state(thread)
+        if snapshot.next:
+            # Interrupted before user_feedback: the trial waits in the checkpoint store
+            argument = next((message.content for message in reversed(snapshot.values["messages"])
+                             if message.name == "lawyer"), "")
+            yield stream_event("awaiting_feedback", session_id,
+                               content="The lawyer asks for your feedback on the argument", argument=argument)
+            return
+
+        # estimated prompt tokens sent by every agent, and saved by the transcript compaction
+        context = context_report(snapshot.values.get("context_stats"))
+        # calls, tokens and latency of the judge's turns, per mode (fused or stepwise)
+        judge = judge_report(snapshot.values.get("judge_stats"))
+        # time per node, per kind of call (LLM, vector query, Kanoon, web search) and per model
+        timing = trace.report()
+        print(f"Prompt tokens: {context['total']}, judge: {judge}, wall: {timing['wall_s']}s")
+        yield stream_event("done", session_id, content="Workflow completed successfully",
+                           context=context, judge=judge, timing=timing)
         
         # Run the workflow
         # final_state = await self.graph.ainvoke(initial_state)
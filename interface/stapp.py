@@ -2,17 +2,19 @@ import asyncio
 import aiohttp
 import streamlit as st
 import json
-import re
 from pathlib import Path
 
 # Create private_documents directory if it doesn't exist
 UPLOAD_DIR = Path("private_documents")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-async def fetch_stream(user_prompt):
-    url = "http://localhost:8000/stream_workflow"
+API_URL = "http://localhost:8000"
+# version of the server's event schema this client reads, see core/events.py
+EVENT_SCHEMA_VERSION = 1
+
+async def fetch_stream(url, payload):
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, json={"user_prompt": user_prompt}) as response:
+        async with session.post(url, json=payload) as response:
             if response.status != 200:
                 st.error(f"Failed to connect: {response.status}")
                 return
@@ -70,25 +72,8 @@ Punishment for sending offensive messages through communication service, etc., w
 """, height=200)
 
 
-def parse_current_and_message(content: str):
-    """
-    Extract the current (e.g., prosecutor, judge) and message from the raw `repr` string.
-    Infers "current" from the first key in the dictionary representation of the content.
-    """
-    # Match the first word (key) as the "current"
-    current_pattern = r"^\{'(\w+)'"
-    message_pattern = r"content=['\"](.*?)['\"], additional_kwargs"
-
-    current_match = re.search(current_pattern, content)
-    message_match = re.search(message_pattern, content, re.DOTALL)
-
-    # Extract current and message
-    current = current_match.group(1) if current_match else "N/A"
-    message = message_match.group(1) if message_match else "N/A"
-
-    return current, message
-
-if st.button("Run Workflow"):    
+def stream_trial(url, payload):
+    """Render the events of a trial stream, remember the trial when it stops for user feedback"""
     # Placeholders for streaming animation and results
     animation_placeholder = st.empty()
     agent_placeholder = st.empty()
@@ -105,24 +90,48 @@ if st.button("Run Workflow"):
 
     async def fetch_and_process_stream():
         animation_task = asyncio.create_task(animate_loading())
+        # answer being generated, shown token by token until its node finishes
+        streaming_key, streamed = None, ""
         try:
-            async for event in fetch_stream(user_prompt=user_prompt):
+            async for event in fetch_stream(url, payload):
                 if event.startswith("data: "):
                     # Remove `data: ` prefix and parse JSON
                     raw_data = event[6:].strip()
                     try:
                         parsed_data = json.loads(raw_data)
-                        content = parsed_data.get("content", "")
-
-                        # Parse the "Agent" (current) and message
-                        current, message = parse_current_and_message(content)
-                        agent_placeholder.write(f"Agent: {current}")
-                        
-                        # Convert raw \n into <br> for HTML rendering
-                        formatted_message = message.replace(r'\n', '\n').replace('\n', '<br>')
-                        
+                        if parsed_data.get("v") != EVENT_SCHEMA_VERSION:
+                            st.warning(f"Unsupported event schema version: {parsed_data.get('v')}")
+                            continue
+                        event_type = parsed_data["type"]
+                        if event_type == "token":
+                            key = (parsed_data.get("node"), parsed_data.get("thought_step"))
+                            if key != streaming_key:
+                                streaming_key, streamed = key, ""
+                            streamed += parsed_data.get("delta", "")
+                            agent_placeholder.write(f"Agent: {key[0]}")
+                            message_placeholder.markdown(streamed.replace('\n', '<br>'), unsafe_allow_html=True)
+                            continue
+                        if event_type == "token_reset":
+                            # the model failed mid-answer, a fallback model starts over
+                            streamed = ""
+                            continue
+                        if event_type == "awaiting_feedback":
+                            # the trial is parked on the server until the feedback is posted
+                            st.session_state["trial_id"] = parsed_data["session_id"]
+                            st.session_state["argument"] = parsed_data.get("argument", "")
+                            continue
+                        streaming_key, streamed = None, ""
+                        if event_type != "step":
+                            # queued, started, done
+                            st.caption(parsed_data.get("content", ""))
+                            continue
+                        if not parsed_data["messages"]:
+                            continue
+                        next_node = f" → {parsed_data['next']}" if parsed_data.get("next") else ""
+                        agent_placeholder.write(f"Agent: {parsed_data['node']}{next_node}")
+                        message = "\n\n".join(str(m["text"]) for m in parsed_data["messages"])
                         # Render using st.markdown with unsafe_allow_html=True
-                        message_placeholder.markdown(formatted_message, unsafe_allow_html=True)
+                        message_placeholder.markdown(message.replace('\n', '<br>'), unsafe_allow_html=True)
                     except json.JSONDecodeError as e:
                         st.error(f"Error decoding JSON: {e}")
                 else:
@@ -133,3 +142,15 @@ if st.button("Run Workflow"):
             animation_task.cancel()  # Stop the animation once streaming is complete
 
     asyncio.run(fetch_and_process_stream())
+
+if st.button("Run Workflow"):
+    st.session_state.pop("trial_id", None)
+    stream_trial(f"{API_URL}/stream_workflow", {"user_prompt": user_prompt})
+
+if st.session_state.get("trial_id"):
+    st.subheader("The lawyer asks for your feedback")
+    st.markdown(st.session_state.get("argument", ""))
+    feedback = st.text_area("Your feedback:", key="feedback", placeholder="eg. argument is not strong")
+    if st.button("Send feedback"):
+        trial_id = st.session_state.pop("trial_id")
+        stream_trial(f"{API_URL}/trials/{trial_id}/feedback", {"feedback": feedback})